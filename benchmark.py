@@ -0,0 +1,266 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+import models
+import misc.utils as utils
+
+# Micro benchmarks of the captioning models on random inputs, so they need no data/checkpoints:
+#   python benchmark.py decode   per-timestep CPU decode latency, eager vs --script_core
+#   python benchmark.py crit     training step memory, LanguageModelCriterion vs --crit_chunk_size
+#   python benchmark.py adaptive train/decode tokens/s and memory, dense vs --adaptive_softmax_cutoffs
+ALL_MODELS = ['show_tell', 'show_attend_tell', 'fc', 'att2in', 'att2in2', 'adaatt', 'adaattmo', 'topdown']
+
+
+def add_model_args(parser):
+    parser.add_argument('--caption_model', type=str, default=','.join(ALL_MODELS),
+                        help='comma separated list of caption models to benchmark')
+    parser.add_argument('--vocab_size', type=int, default=10000)
+    parser.add_argument('--seq_length', type=int, default=31)
+    parser.add_argument('--rnn_size', type=int, default=512)
+    parser.add_argument('--num_layers', type=int, default=1)
+    parser.add_argument('--input_encoding_size', type=int, default=512)
+    parser.add_argument('--att_hid_size', type=int, default=512)
+    parser.add_argument('--fc_feat_size', type=int, default=2048)
+    parser.add_argument('--att_feat_size', type=int, default=2048)
+    parser.add_argument('--att_size', type=int, default=7, help='side of the attention grid')
+    parser.add_argument('--sentence_embed', type=int, default=0,
+                        help='attend over article sentence embeddings in show_attend_tell (1 = yes, 0 = no)')
+    parser.add_argument('--sentence_length', type=int, default=54)
+    parser.add_argument('--sentence_embed_size', type=int, default=300)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=10, help='timed runs per setting')
+    parser.add_argument('--num_threads', type=int, default=0, help='torch cpu threads (0 = torch default)')
+    parser.add_argument('--cpu_fuser', type=int, default=0,
+                        help='let TorchScript fuse on the cpu too (1 = yes, 0 = no)? needs a torch build with LLVM')
+    parser.add_argument('--seed', type=int, default=123)
+
+
+def model_opt(args, caption_model, **kwargs):
+    opt = argparse.Namespace(caption_model=caption_model, vocab_size=args.vocab_size, seq_length=args.seq_length,
+                             rnn_size=args.rnn_size, num_layers=args.num_layers, rnn_type='lstm', drop_prob_lm=0.5,
+                             input_encoding_size=args.input_encoding_size, att_hid_size=args.att_hid_size,
+                             fc_feat_size=args.fc_feat_size, att_feat_size=args.att_feat_size,
+                             sentence_embed='', sentence_embed_att=False, sentence_embed_method='',
+                             sentence_length=args.sentence_length, sentence_embed_size=args.sentence_embed_size, id='')
+    if args.sentence_embed and caption_model == 'show_attend_tell':
+        opt.sentence_embed, opt.sentence_embed_att, opt.sentence_embed_method = 'random', True, 'fc'
+    for k, v in kwargs.items():
+        setattr(opt, k, v)
+    return opt
+
+
+def model_inputs(args, opt, batch_size):
+    fc_feats = torch.randn(batch_size, args.fc_feat_size)
+    att_feats = torch.randn(batch_size, args.att_size, args.att_size, args.att_feat_size)
+    extra = ()
+    if opt.sentence_embed:
+        extra = (torch.randn(batch_size, args.sentence_length, args.sentence_embed_size),)
+    return fc_feats, att_feats, extra
+
+
+def timeit(fn, repeat, warmup=3):
+    # warmup also lets the profiling executor specialize and fuse the scripted graphs
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return np.median(times)
+
+
+def model_labels(args, batch_size, word_probs=None):
+    # full length captions, so every time step is decoded
+    if word_probs is None:
+        labels = torch.randint(1, args.vocab_size + 1, (batch_size, args.seq_length + 2))
+    else:
+        labels = torch.multinomial(word_probs, batch_size * (args.seq_length + 2), replacement=True)
+        labels = labels.view(batch_size, -1) + 1
+    labels[:, 0] = 0
+    return labels, torch.ones(batch_size, args.seq_length + 2)
+
+
+def saved_tensor_bytes(fn):
+    # Bytes of the activations autograd keeps for backward (parameters excluded), counted per storage.
+    # Used on the cpu, where torch has no peak memory counter.
+    storages = {}
+
+    def pack(tensor):
+        storages[tensor.untyped_storage().data_ptr()] = tensor.untyped_storage().nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        out = fn()
+    return out, storages
+
+
+def train_step_memory(args, model, crit, batch_size, device, word_probs=None):
+    opt = model.opt
+    fc_feats, att_feats, extra = model_inputs(args, opt, batch_size)
+    labels, masks = model_labels(args, batch_size, word_probs)
+    fc_feats, att_feats, labels, masks = [_.to(device) for _ in [fc_feats, att_feats, labels, masks]]
+    extra = tuple(_.to(device) for _ in extra)
+
+    def step():
+        return crit(model(fc_feats, att_feats, labels, *extra), labels[:, 1:], masks[:, 1:])
+
+    model.zero_grad()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        start = time.time()
+        step().backward()
+        torch.cuda.synchronize()
+        return (torch.cuda.max_memory_allocated() - base) / 2.0 ** 20, time.time() - start
+    start = time.time()
+    loss, storages = saved_tensor_bytes(step)
+    params = set(p.untyped_storage().data_ptr() for p in model.parameters())
+    loss.backward()
+    activations = sum(v for k, v in storages.items() if k not in params)
+    return activations / 2.0 ** 20, time.time() - start
+
+
+def bench_crit(args):
+    device = args.device or ('cuda' if torch.cuda.is_available() else 'cpu')
+    what = 'peak MB' if device == 'cuda' else 'saved MB'
+    for caption_model in args.caption_model.split(','):
+        torch.manual_seed(args.seed)
+        opt = model_opt(args, caption_model)
+        model = models.setup(opt).to(device)
+        model.train()
+        model.opt = opt
+        print('%s, vocab %d, seq_length %d, %s (fwd+bwd memory above the model)' % (
+            caption_model, args.vocab_size, args.seq_length, device))
+        print('%8s %12s %12s %8s %10s %10s' % ('batch', 'crit ' + what, 'fused ' + what, 'ratio', 'crit s', 'fused s'))
+        for batch_size in [int(_) for _ in args.batch_sizes.split(',')]:
+            model.return_hidden = False
+            mem, sec = train_step_memory(args, model, utils.LanguageModelCriterion(), batch_size, device)
+            model.return_hidden = True
+            fused = utils.FusedLanguageModelCriterion(model.logit, args.crit_chunk_size)
+            fused_mem, fused_sec = train_step_memory(args, model, fused, batch_size, device)
+            print('%8d %12.1f %12.1f %7.2fx %10.3f %10.3f' % (batch_size, mem, fused_mem, mem / fused_mem, sec, fused_sec))
+
+
+def zipf_word_counts(args):
+    # Zipf distributed word frequencies over a vocabulary in arbitrary (prepro_labels dict) order
+    rng = np.random.RandomState(args.seed)
+    counts = 1e7 / np.arange(1, args.vocab_size + 1)
+    counts = counts[rng.permutation(args.vocab_size)]
+    return {i + 1: int(c) for i, c in enumerate(counts)}, torch.from_numpy(counts / counts.sum())
+
+
+def bench_adaptive(args):
+    device = args.device or ('cuda' if torch.cuda.is_available() else 'cpu')
+    what = 'peak MB' if device == 'cuda' else 'saved MB'
+    word_counts, word_probs = zipf_word_counts(args)
+    batch_size = args.batch_size
+
+    def sync():
+        if device == 'cuda':
+            torch.cuda.synchronize()
+
+    print('vocab %d, seq_length %d, batch %d, cutoffs %s, %s, labels drawn from a Zipf distribution' % (
+        args.vocab_size, args.seq_length, batch_size, args.adaptive_softmax_cutoffs, device))
+    print('%-18s %-8s %12s %12s %12s' % ('caption_model', 'head', 'train tok/s', what, 'decode tok/s'))
+    for caption_model in args.caption_model.split(','):
+        for cutoffs in ['', args.adaptive_softmax_cutoffs]:
+            torch.manual_seed(args.seed)
+            opt = model_opt(args, caption_model, adaptive_softmax_cutoffs=cutoffs,
+                            adaptive_softmax_div=args.adaptive_softmax_div)
+            model = models.setup(opt, word_counts).to(device)
+            model.opt = opt
+            if cutoffs:
+                model.return_hidden = True
+                crit = utils.AdaptiveLanguageModelCriterion(model.logit)
+            else:
+                crit = utils.LanguageModelCriterion()
+            fc_feats, att_feats, extra = model_inputs(args, opt, batch_size)
+            labels, masks = model_labels(args, batch_size, word_probs)
+            fc_feats, att_feats, labels, masks = [_.to(device) for _ in [fc_feats, att_feats, labels, masks]]
+            extra = tuple(_.to(device) for _ in extra)
+
+            def train_step():
+                model.zero_grad()
+                crit(model(fc_feats, att_feats, labels, *extra), labels[:, 1:], masks[:, 1:]).backward()
+                sync()
+
+            model.train()
+            train_seconds = timeit(train_step, args.repeat)
+            mem, _ = train_step_memory(args, model, crit, batch_size, device, word_probs)
+            model.return_hidden = False
+            model.eval()
+
+            def decode():
+                with utils.adaptive_decoding(model, {'beam_size': 1}):
+                    seq, _ = model.sample(fc_feats, att_feats, {'beam_size': 1}, *extra)
+                sync()
+                return seq
+
+            # the adaptive head has no bias to push <eos> away, so count the decoded steps instead
+            with torch.no_grad():
+                decode_seconds = timeit(decode, args.repeat)
+                decode_tokens = batch_size * (decode().size(1) + 1)
+            print('%-18s %-8s %12.0f %12.1f %12.0f' % (
+                caption_model, 'adaptive' if cutoffs else 'dense', batch_size * (args.seq_length + 1) / train_seconds,
+                mem, decode_tokens / decode_seconds))
+
+
+def bench_decode(args):
+    # Greedy decoding with the <eos> logit pushed to -inf, so every caption runs all seq_length steps
+    print('%-18s %14s %14s %8s' % ('caption_model', 'eager ms/step', 'script ms/step', 'speedup'))
+    for caption_model in args.caption_model.split(','):
+        variants = [0, 1] if caption_model in models.SCRIPTABLE_CORES else [0]
+        latency = []
+        for script_core in variants:
+            torch.manual_seed(args.seed)
+            opt = model_opt(args, caption_model, script_core=script_core)
+            model = models.setup(opt)
+            model.eval()
+            model.logit.bias.data[0] = -1e9
+            fc_feats, att_feats, extra = model_inputs(args, opt, args.batch_size)
+            steps = args.seq_length + 1
+            with torch.no_grad(), torch.jit.fuser('fuser1' if args.cpu_fuser else 'fuser0'):
+                seconds = timeit(lambda: model.sample(fc_feats, att_feats, {'beam_size': 1}, *extra), args.repeat)
+            latency.append(1000.0 * seconds / steps)
+        if len(latency) == 1:
+            print('%-18s %14.3f %14s %8s' % (caption_model, latency[0], '-', '-'))
+        else:
+            print('%-18s %14.3f %14.3f %7.2fx' % (caption_model, latency[0], latency[1], latency[0] / latency[1]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark')
+    decode_parser = subparsers.add_parser('decode', help='per-timestep greedy decode latency on the cpu')
+    add_model_args(decode_parser)
+    decode_parser.set_defaults(func=bench_decode)
+    crit_parser = subparsers.add_parser('crit', help='training step memory of the standard and the fused criterion')
+    add_model_args(crit_parser)
+    crit_parser.add_argument('--batch_sizes', type=str, default='16,32,64,128')
+    crit_parser.add_argument('--crit_chunk_size', type=int, default=4)
+    crit_parser.add_argument('--device', type=str, default='', help='cuda|cpu, empty = cuda if available')
+    crit_parser.set_defaults(func=bench_crit, caption_model='show_attend_tell')
+
+    adaptive_parser = subparsers.add_parser('adaptive', help='tokens/s and memory of the dense and the adaptive softmax head')
+    add_model_args(adaptive_parser)
+    adaptive_parser.add_argument('--adaptive_softmax_cutoffs', type=str, default='2000,10000')
+    adaptive_parser.add_argument('--adaptive_softmax_div', type=float, default=4.0)
+    adaptive_parser.add_argument('--device', type=str, default='', help='cuda|cpu, empty = cuda if available')
+    adaptive_parser.set_defaults(func=bench_adaptive, caption_model='show_attend_tell,topdown', vocab_size=50000,
+                                 batch_size=32)
+
+    args = parser.parse_args()
+    if args.benchmark is None:
+        parser.error('choose a benchmark: decode, crit, adaptive')
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    args.func(args)
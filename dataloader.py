@@ -65,6 +65,7 @@ class DataLoader:
         self.info = json.load(open(self.opt.input_json))
         self.ix_to_word = self.info['ix_to_word']
         self.vocab_size = len(self.ix_to_word)
+        self.word_counts = self.info.get('word_counts', None)
         print('vocab size is ', self.vocab_size)
 
 
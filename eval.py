@@ -37,6 +37,12 @@ parser.add_argument('--num_images', type=int, default=-1,
                 help='how many images to use when periodically evaluating the loss? (-1 = all)')
 parser.add_argument('--language_eval', type=int, default=1,
                 help='Evaluate language as well (1 = yes, 0 = no)? BLEU/CIDEr/METEOR/ROUGE_L? requires coco-caption code from Github.')
+parser.add_argument('--scorer', type=str, default='coco',
+                help='Bleu/ROUGE_L/CIDEr of language_eval from coco: pycocoevalcap, native: misc/scorer.py (same scores, vectorized over a process pool)')
+parser.add_argument('--scorer_processes', type=int, default=0,
+                help='processes of the native scorer. 0 = one per cpu')
+parser.add_argument('--score_cache', type=str, default='',
+                help='sqlite file memoizing the per caption scores of the native scorer, e.g. data/score_cache.sqlite. empty = off')
 parser.add_argument('--dump_images', type=int, default=0,
                 help='Dump images into vis/imgs folder for vis? (1=yes,0=no)')
 parser.add_argument('--dump_json', type=int, default=1,
@@ -75,6 +81,12 @@ parser.add_argument('--id', type=str, default='',
 parser.add_argument('--return_attention', type=bool, default=True,
                 help='This should only be run when sentence attention architecture is used. When set to True, '
                      'it will write the attention weights for article and images to json')
+parser.add_argument('--script_core', type=int, default=0,
+                help='Compile the decoder core with TorchScript (1 = yes, 0 = no)? Not for int8 checkpoints.')
+parser.add_argument('--cnn_inference_build', type=int, default=0,
+                help='Run the CNN as a BatchNorm-folded, channels_last, traced copy? (1 = yes, 0 = no)')
+parser.add_argument('--device', type=str, default='cuda',
+                help='cuda or cpu. int8 checkpoints written by quantize.py always run on the cpu.')
 
 opt = parser.parse_args()
 
@@ -105,14 +117,22 @@ for k in vars(infos['opt']).keys():
 vocab = infos['vocab'] # ix -> word mapping
 
 # Setup the model
-cnn_model = utils.build_cnn(opt)
-cnn_model.load_state_dict(torch.load(opt.cnn_model_path))
-cnn_model.cuda()
-cnn_model.eval()
 model = models.setup(opt)
-model.load_state_dict(torch.load(opt.model_path))
-model.cuda()
+# a trusted local checkpoint: int8 state dicts hold packed params, which the weights_only
+# default of torch >= 2.6 refuses to unpickle
+state_dict = torch.load(opt.model_path, map_location='cpu', weights_only=False)
+if utils.is_quantized_state_dict(state_dict):
+    model = utils.quantize_model(model)
+    opt.device = 'cpu'
+model.load_state_dict(state_dict)
+model.to(opt.device)
 model.eval()
+cnn_model = utils.build_cnn(opt)
+cnn_model.load_state_dict(torch.load(opt.cnn_model_path, map_location='cpu'))
+cnn_model.to(opt.device)
+cnn_model.eval()
+if opt.cnn_inference_build:
+    cnn_model = utils.build_inference_cnn(cnn_model)
 crit = utils.LanguageModelCriterion()
 opt.seq_per_img = 1
 # opt.sentence_embed = './data/data_news_compact_lda_label.h5'
@@ -20,9 +20,12 @@ from pycocoevalcap.rouge.rouge import Rouge
 from pycocoevalcap.cider.cider import Cider
 from pycocoevalcap.meteor.meteor import Meteor
 from pycocoevalcap.spice.spice import Spice
+from misc.ref_index import ReferenceIndex, IndexedScorer
+import misc.scorer as native_scorer
+from misc.score_cache import ScoreCache
 
 
-def language_eval(dataset, preds, model_id, split):
+def language_eval(dataset, preds, model_id, split, scorer='coco', scorer_processes=0, score_cache=''):
     import sys
     if 'coco' in dataset:
         sys.path.append("coco-caption")
@@ -31,18 +34,18 @@ def language_eval(dataset, preds, model_id, split):
         # TODO: NYTIMES
         if split == 'val':
             annFile = './data/val.json'
-            with open(annFile, 'rb') as f: dataset = json.load(f)
         else:
             annFile = './data/test.json'
-            with open(annFile, 'rb') as f: dataset = json.load(f)
+        index = ReferenceIndex.load(annFile)
 
         # TODO: BREAKINGNEWS
         # with open("/home/abiten/Desktop/Thesis/newspaper/breakingnews/bnews_caps.json", "rb") as f: dataset = json.load(f)
 
-        id_to_ix = {v['cocoid']: ix for ix, v in enumerate(dataset)}
+        start = time.time()
         hypo = {v['image_id']: [v['caption']] for v in preds}
-        ref = {k: [i['raw'] for i in dataset[id_to_ix[k]]['sentences']] for k in hypo.keys()}
-        final_scores = evaluate(ref, hypo)
+        ref = {k: index.refs[k] for k in hypo.keys()}
+        final_scores = evaluate(ref, hypo, index, scorer, scorer_processes, score_cache)
+        print('scored %d captions in %.2fs' % (len(hypo), time.time() - start))
         print('Bleu_1:\t', final_scores['Bleu_1'])
         print('Bleu_2:\t', final_scores['Bleu_2'])
         print('Bleu_3:\t', final_scores['Bleu_3'])
@@ -92,12 +95,23 @@ def language_eval(dataset, preds, model_id, split):
 
     return out
 
-def evaluate(ref, hypo):
+def evaluate(ref, hypo, index=None, scorer='coco', scorer_processes=0, score_cache=''):
+    # scorer 'native': Bleu, ROUGE_L and CIDEr of misc/scorer.py over scorer_processes processes (0 = all cpus),
+    # only for the captions not in the score_cache sqlite file if given.
+    # with the ReferenceIndex of ref, pycocoevalcap's Bleu and Cider use its prepared references
+    assert scorer in ['coco', 'native'], "scorer should be coco or native"
+    assert not score_cache or scorer == 'native', "score_cache needs the native scorer"
+    if scorer == 'native':
+        if score_cache:
+            final_scores, _ = ScoreCache.get(score_cache).score(ref, hypo, scorer_processes)
+        else:
+            final_scores, _ = native_scorer.score(ref, hypo, scorer_processes)
+        return {m: float(s) for m, s in final_scores.items()}
     scorers = [
-        (Bleu(4), ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"]),
+        (Bleu(4) if index is None else IndexedScorer(index, 'bleu'), ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"]),
         # (Meteor(), "METEOR"),
         (Rouge(), "ROUGE_L"),
-        (Cider(), "CIDEr")
+        (Cider() if index is None else IndexedScorer(index, 'cider'), "CIDEr")
         # (Spice(), "Spice")
     ]
     final_scores = {}
@@ -118,6 +132,7 @@ def eval_split(cnn_model, model, crit, loader, eval_kwargs={}, return_attention=
     lang_eval = eval_kwargs.get('language_eval', 0)
     dataset = eval_kwargs.get('dataset', 'news')
     beam_size = eval_kwargs.get('beam_size', 1)
+    device = eval_kwargs.get('device', 'cuda')
 
     # Make sure in the evaluation mode
     cnn_model.eval()
@@ -141,7 +156,7 @@ def eval_split(cnn_model, model, crit, loader, eval_kwargs={}, return_attention=
         # vis_attention, sen_attention = [], []
         # Get the image features first
         tmp = [data['images'], data.get('labels', np.zeros(1)), data.get('masks', np.zeros(1))]
-        tmp = [Variable(torch.from_numpy(_), requires_grad=False).cuda() for _ in tmp]
+        tmp = [Variable(torch.from_numpy(_), requires_grad=False).to(device) for _ in tmp]
         images, labels, masks = tmp
         with torch.no_grad():
             att_feats = cnn_model(images).permute(0, 2, 3, 1) # .contiguous()
@@ -158,10 +173,11 @@ def eval_split(cnn_model, model, crit, loader, eval_kwargs={}, return_attention=
             if sen_embed is not None:
                 with torch.no_grad():
                     sen_embed = np.array(sen_embed, dtype=np.float32)
-                    loss = crit(model(fc_feats, att_feats, labels, Variable(torch.from_numpy(sen_embed)).cuda()),
+                    loss = crit(model(fc_feats, att_feats, labels, Variable(torch.from_numpy(sen_embed)).to(device)),
                                 labels[:, 1:], masks[:, 1:])
             else:
-                loss = crit(model(fc_feats, att_feats, labels), labels[:,1:], masks[:,1:]).data[0]
+                with torch.no_grad():
+                    loss = crit(model(fc_feats, att_feats, labels), labels[:,1:], masks[:,1:]).item()
             loss_sum += loss
             loss_evals = loss_evals + 1
 
@@ -169,19 +185,21 @@ def eval_split(cnn_model, model, crit, loader, eval_kwargs={}, return_attention=
         # Only leave one feature for each image, in case duplicate sample
         # fc_feats, att_feats = _fc_feats, _att_feats
         # forward the model to also get generated samples for each image
-        if sen_embed is not None:
-            if return_attention:
-                seq, _, atts = model.sample(fc_feats, att_feats, eval_kwargs, Variable(torch.from_numpy(sen_embed)).cuda(),
-                                            return_attention)
-                vis_attention = np.array([att[0] for att in atts])
-                sen_attention = np.array([att[1] for att in atts])
-            else:
-                seq, _= model.sample(fc_feats, att_feats, eval_kwargs,
-                                            Variable(torch.from_numpy(sen_embed)).cuda(),
-                                            return_attention)
+        # an adaptive softmax head only computes the clusters greedy/beam search can pick from
+        with utils.adaptive_decoding(model, eval_kwargs):
+            if sen_embed is not None:
+                if return_attention:
+                    seq, _, atts = model.sample(fc_feats, att_feats, eval_kwargs, Variable(torch.from_numpy(sen_embed)).to(device),
+                                                return_attention)
+                    vis_attention = np.array([att[0] for att in atts])
+                    sen_attention = np.array([att[1] for att in atts])
+                else:
+                    seq, _= model.sample(fc_feats, att_feats, eval_kwargs,
+                                                Variable(torch.from_numpy(sen_embed)).to(device),
+                                                return_attention)
 
-        else:
-            seq, _ = model.sample(fc_feats, att_feats, eval_kwargs)
+            else:
+                seq, _ = model.sample(fc_feats, att_feats, eval_kwargs)
         #set_trace()
         sents = utils.decode_sequence(loader.get_vocab(), seq)
 
@@ -221,7 +239,9 @@ def eval_split(cnn_model, model, crit, loader, eval_kwargs={}, return_attention=
 
     lang_stats = None
     if lang_eval == 1:
-        lang_stats = language_eval(dataset, predictions, eval_kwargs['id'], split)
+        lang_stats = language_eval(dataset, predictions, eval_kwargs['id'], split,
+                                   eval_kwargs.get('scorer', 'coco'), eval_kwargs.get('scorer_processes', 0),
+                                   eval_kwargs.get('score_cache', ''))
 
     # if sen_embed is not None:
     #     atts = [{'file_path': d['file_path'], 'vis_att':vis_attention[i], 'sen_att':sen_attention[i]} for i, d in enumerate(data['infos'])]
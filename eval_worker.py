@@ -0,0 +1,146 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import time
+from six.moves import cPickle
+
+import torch
+
+import models
+from dataloader import *
+import eval_utils
+import misc.utils as utils
+from misc.checkpoint import atomic_link, suffixed
+from misc.history import HistoryLog
+from misc.tensorboard import SummaryWriter
+
+# Validation outside the training process. The worker follows history_<id>.jsonl of a
+# checkpoint directory, evaluates the latest checkpoint train.py logged (older pending
+# ones are skipped) with eval_split + language_eval, logs the results back to the history
+# and tensorboard, and hard links the checkpoint as model-best.pth etc. when it improves.
+# train.py --async_eval 1 starts it; it can also be run by hand on a running training:
+#   python eval_worker.py --checkpoint_dir save/show_attend_tell --device cpu
+parser = argparse.ArgumentParser()
+parser.add_argument('--checkpoint_dir', type=str, required=True,
+                help='checkpoint_path + caption_model of the training to follow')
+parser.add_argument('--id', type=str, default='',
+                help='id of the training run')
+parser.add_argument('--device', type=str, default='cuda',
+                help='cuda, cuda:1, cpu, ... to evaluate on')
+parser.add_argument('--poll_secs', type=float, default=10,
+                help='how often to look for new checkpoints')
+parser.add_argument('--offset', type=int, default=-1,
+                help='byte offset of the history log to follow from. 0 = also evaluate the checkpoints logged before, -1 = only new ones')
+parser.add_argument('--parent_pid', type=int, default=0,
+                help='exit when this process (the training) is gone. 0 = never')
+
+CHECKPOINT_FILES = ['model.pth', 'model-cnn.pth']
+
+
+def parent_alive(pid):
+    if not pid:
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+class EvalWorker(object):
+    def __init__(self, args):
+        self.args = args
+        self.history = HistoryLog(args.checkpoint_dir, args.id)
+        self.names = CHECKPOINT_FILES + ['infos_' + args.id + '.pkl']
+        self.opt = None
+
+    def path(self, name, suffix):
+        return os.path.join(self.args.checkpoint_dir, suffixed(name, suffix))
+
+    def setup(self, infos):
+        # the loader, models and summary writer are built once, from the options of the first checkpoint
+        opt = infos['opt']
+        opt.start_from = None
+        opt.device = self.args.device
+        self.opt = opt
+        self.loader = DataLoader(opt)
+        self.model = models.setup(opt)
+        self.cnn_model = utils.build_cnn(opt)
+        self.crit = utils.LanguageModelCriterion()
+        self.summary_writer = SummaryWriter(opt.checkpoint_path + 'tensorboard/')
+
+    def best_score(self, infos):
+        scores = [infos['best_val_score']] if infos.get('best_val_score', None) is not None else []
+        for result in self.history.histories()['val_result_history'].values():
+            if self.opt.language_eval == 1:
+                scores.append(result['lang_stats']['CIDEr'])
+            else:
+                scores.append(- result['loss'])
+        return max(scores) if scores else None
+
+    def evaluate(self, iteration):
+        # pin the files first, train.py removes old numbered checkpoints while we evaluate
+        try:
+            for name in self.names:
+                atomic_link(self.path(name, iteration), self.path(name, 'eval'))
+        except OSError:
+            print("checkpoint of iteration {} is gone, skipped".format(iteration))
+            return
+        with open(self.path(self.names[-1], 'eval'), 'rb') as f:
+            infos = cPickle.load(f)
+        if self.opt is None:
+            self.setup(infos)
+        opt = self.opt
+        # trusted local checkpoint, int8 ones do not load with the weights_only default of torch >= 2.6
+        state_dict = torch.load(self.path('model.pth', 'eval'), map_location='cpu', weights_only=False)
+        self.model.load_state_dict(state_dict)
+        self.model.to(opt.device)
+        self.cnn_model.load_state_dict(torch.load(self.path('model-cnn.pth', 'eval'), map_location='cpu'))
+        self.cnn_model.to(opt.device)
+        self.cnn_model.eval()
+        cnn_forward = utils.build_inference_cnn(self.cnn_model) if opt.cnn_inference_build else self.cnn_model
+
+        start = time.time()
+        eval_kwargs = {'split': 'val',
+                       'dataset': opt.input_json}
+        eval_kwargs.update(vars(opt))
+        val_loss, predictions, lang_stats = eval_utils.eval_split(cnn_forward, self.model, self.crit, self.loader, eval_kwargs)
+        print("iteration {} evaluated in {:.1f}s: loss {}, {}".format(iteration, time.time() - start, val_loss, lang_stats))
+
+        best_val_score = self.best_score(infos)
+        self.history.log_val(iteration, val_loss, lang_stats, predictions)
+        self.summary_writer.add_scalar('validation loss', val_loss, iteration)
+        for k, v in (lang_stats or {}).items():
+            self.summary_writer.add_scalar(k, v, iteration)
+        self.summary_writer.flush()
+
+        current_score = lang_stats['CIDEr'] if opt.language_eval == 1 else - val_loss
+        if best_val_score is None or current_score > best_val_score:
+            for name in self.names:
+                atomic_link(self.path(name, 'eval'), self.path(name, 'best'))
+            print("iteration {} is the best so far, linked as {}".format(iteration, self.path('model.pth', 'best')))
+
+    def run(self):
+        offset = self.args.offset
+        if offset < 0:
+            offset = os.path.getsize(self.history.path) if os.path.isfile(self.history.path) else 0
+        done = False
+        while True:
+            entries, offset = self.history.follow(offset)
+            done = done or any(_.get('done') for _ in entries)
+            checkpoints = [_['iter'] for _ in entries if _.get('checkpoint')]
+            if checkpoints:
+                self.evaluate(checkpoints[-1])
+            elif done or not parent_alive(self.args.parent_pid):
+                break
+            else:
+                time.sleep(self.args.poll_secs)
+        if self.opt is not None:
+            self.summary_writer.close()
+
+
+if __name__ == '__main__':
+    EvalWorker(parser.parse_args()).run()
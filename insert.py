@@ -3,17 +3,30 @@ from pycocoevalcap.rouge.rouge import Rouge
 from pycocoevalcap.cider.cider import Cider
 from pycocoevalcap.meteor.meteor import Meteor
 from pycocoevalcap.spice.spice import Spice
+import misc.scorer as native_scorer
+from misc.score_cache import ScoreCache
+from misc.entity_index import EntityIndex
+from misc.article_store import open_articles, organize_ner
 
 import numpy as np
 import json
-import operator
 import argparse
-import stop_words
+import multiprocessing
+import os
 import re
+import resource
 import spacy
+import time
 import tqdm
 from nltk.tokenize import word_tokenize
-from collections import deque, defaultdict
+from collections import deque
+
+named_entities = ['PERSON', 'NORP', 'FAC', 'ORG', 'GPE', 'LOC', 'PRODUCT', 'EVENT', 'WORK_OF_ART', 'LANGUAGE',
+                  'DATE', 'TIME', 'PERCENT', 'MONEY', 'QUANTITY', 'ORDINAL', 'CARDINAL']
+METHODS = ['ctx', 'rand', 'att']
+# spacy pipeline (set by main) and the data of the insertion jobs, set before the workers are forked
+nlp = None
+_JOB = {}
 
 
 def open_json(path):
@@ -21,7 +34,14 @@ def open_json(path):
         return json.load(f)
 
 
-def score(ref, hypo):
+def score(ref, hypo, scorer='coco', processes=0, cache=''):
+    # scorer 'native': Bleu, ROUGE_L and CIDEr of misc/scorer.py only, without METEOR and Spice,
+    # memoized in the sqlite file cache if given
+    assert not cache or scorer == 'native', "the score cache needs the native scorer"
+    if scorer == 'native':
+        if cache:
+            return ScoreCache.get(cache).score(ref, hypo, processes)
+        return native_scorer.score(ref, hypo, processes)
     scorers = [
         (Bleu(4), ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"]),
         (Meteor(), "METEOR"),
@@ -46,7 +66,7 @@ def score(ref, hypo):
     return final_scores, all_scores
 
 
-def evaluate(ref, cand, get_scores=True):
+def evaluate(ref, cand, get_scores=True, scorer='coco', processes=0, cache=''):
     # make dictionary
     hypo = {}
     for i, caption in enumerate(cand):
@@ -56,99 +76,135 @@ def evaluate(ref, cand, get_scores=True):
         truth[i] = [caption]
 
     # compute bleu score
-    final_scores = score(truth, hypo)
+    final_scores = score(truth, hypo, scorer, processes, cache)
 
     #     print out scores
-    print 'Bleu_1:\t ;', final_scores[0]['Bleu_1']
-    print 'Bleu_2:\t ;', final_scores[0]['Bleu_2']
-    print 'Bleu_3:\t ;', final_scores[0]['Bleu_3']
-    print 'Bleu_4:\t ;', final_scores[0]['Bleu_4']
-    print 'METEOR:\t ;', final_scores[0]['METEOR']
-    print 'ROUGE_L: ;', final_scores[0]['ROUGE_L']
-    print 'CIDEr:\t ;', final_scores[0]['CIDEr']
-    print 'Spice:\t', final_scores[0]['Spice']
+    print('Bleu_1:\t ;', final_scores[0]['Bleu_1'])
+    print('Bleu_2:\t ;', final_scores[0]['Bleu_2'])
+    print('Bleu_3:\t ;', final_scores[0]['Bleu_3'])
+    print('Bleu_4:\t ;', final_scores[0]['Bleu_4'])
+    if 'METEOR' in final_scores[0]:
+        print('METEOR:\t ;', final_scores[0]['METEOR'])
+    print('ROUGE_L: ;', final_scores[0]['ROUGE_L'])
+    print('CIDEr:\t ;', final_scores[0]['CIDEr'])
+    if 'Spice' in final_scores[0]:
+        print('Spice:\t', final_scores[0]['Spice'])
 
     if get_scores:
         return final_scores
 
 
-def organize_ner(ner):
-    new = defaultdict(list)
-    for k, v in ner.iteritems():
-        value = ' '.join(k.split())
-        if value not in stopwords:
-            new[v].append(value)
-    return new
-
-
-def fill_random(cap, ner_dict):
+def fill_random(cap, ner_dict, random=np.random):
+    # ner_dict: the organize_ner table of the article, the entities of all the placeholders
+    # drawn from their buckets at once
     assert cap != list
-    filled = []
-    for c in cap:
-        if c.split('_')[0] in named_entities and c.isupper():
-            ent = c.split('_')[0]
-            if ner_dict[ent]:
-                ner = np.random.choice(ner_dict[ent])
-                filled.append(ner)
-            else:
-                filled.append(c)
-        else:
-            filled.append(c)
-
+    filled = list(cap)
+    slots = [(i, c.split('_')[0]) for i, c in enumerate(cap)
+             if c.split('_')[0] in named_entities and c.isupper() and ner_dict.get(c.split('_')[0])]
+    if slots:
+        sizes = np.array([len(ner_dict[ent]) for _, ent in slots])
+        draws = (random.random_sample(len(slots)) * sizes).astype(int)
+        for (i, ent), j in zip(slots, draws):
+            filled[i] = ner_dict[ent][j]
     return filled
 
 
 def rank_sentences(cap, sent):
-    # make them unicode, spacy accepts only unicode
-    cap = unicode(cap)
-    sent = [unicode(s) for s in sent]
     # feed them to spacy to get the vectors
     cap = nlp(cap)
     list_sent = [nlp(s) for s in sent]
     compare = [s.similarity(cap) for s in list_sent]
-    # we sort the article sentences according to their similarity to produced caption
-    similarity = sorted([(s, c) for s, c in zip(list_sent, compare)], key=lambda x: x[1], reverse=True)
+    # we sort the article sentences according to their similarity to produced caption,
+    # (sentence, similarity, index in sent) from the most similar
+    similarity = sorted([(s.text, c, i) for i, (s, c) in enumerate(zip(list_sent, compare))], key=lambda x: x[1], reverse=True)
     return similarity
 
 
+def load_sentence_vectors(path):
+    # the matrix (memory mapped) and the article index scripts/prepro_sentence_vectors.py wrote
+    with open(path + '.json', 'r') as f:
+        index = json.load(f)
+    return np.load(path + '.npy', mmap_mode='r'), index
+
+
+def caption_vectors(captions, batch_size=1000):
+    # L2 normalized spacy vectors of the captions, through nlp.pipe
+    vectors = np.array([doc.vector for doc in nlp.pipe(captions, batch_size=batch_size)], dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def rank_vectors(cap_vector, sent, sent_vectors):
+    # rank_sentences with normalized vectors: the cosine similarities are one matrix-vector product
+    compare = np.asarray(sent_vectors).dot(cap_vector)
+    order = np.argsort(-compare, kind='stable')
+    return [(sent[i], float(compare[i]), i) for i in order]
+
+
 def ner_finder(ranked_sen, score_sen, word):
     for sen, sc in zip(ranked_sen, score_sen):
         beg = sen.find(word)
-        if beg is not -1:
+        if beg != -1:
             end = beg + len(word)
             return sen[beg:end], sc
     else:
         return None, None
 
 
-def fill_word2vec(cap, ner_dict, ner_articles, return_ners=False):
+def entity_patterns(ner_dict):
+    # the strings fill_word2vec looks for in the article sentences
+    patterns = set()
+    for values in ner_dict.values():
+        for word in values:
+            patterns.add(word)
+            patterns.add(re.sub('[^A-Za-z0-9]+', ' ', word))
+    return patterns
+
+
+def fill_word2vec(cap, ner_dict, ner_articles, return_ners=False, similarity=None, entity_index=None):
+    # similarity: the ranking of ner_articles of rank_sentences if already known,
+    # entity_index: the EntityIndex of ner_articles and entity_patterns(ner_dict)
     assert cap != list
     filled = []
-    similarity = rank_sentences(' '.join(cap), ner_articles)
-    ranked_sen = [s[0].text for s in similarity]
+    if similarity is None:
+        similarity = rank_sentences(' '.join(cap), ner_articles)
+    ranked_sen = [s[0] for s in similarity]
     score_sen = [s[1] for s in similarity]
     if return_ners: ners = []
+    find = ner_finder
+    if entity_index is not None:
+        rank = [0] * len(similarity)
+        for position, s in enumerate(similarity):
+            rank[s[2]] = position
+
+        def find(ranked_sen, score_sen, word):
+            # ner_finder with the index
+            sentence = entity_index.first_ranked(word, rank)
+            if sentence is None:
+                return None, None
+            return word, score_sen[rank[sentence]]
 
     new = {}
-    for key, values in ner_dict.iteritems():
+    for key, values in ner_dict.items():
         temp = {}
         for word in values:
-            found, sc1 = ner_finder(ranked_sen, score_sen, re.sub('[^A-Za-z0-9]+', ' ', word))
-            found2, sc2 = ner_finder(ranked_sen, score_sen, word)
+            found, sc1 = find(ranked_sen, score_sen, re.sub('[^A-Za-z0-9]+', ' ', word))
+            found2, sc2 = find(ranked_sen, score_sen, word)
             if found:
                 temp[word] = sc1
-            elif ner_finder(ranked_sen, score_sen, word):
+            elif find(ranked_sen, score_sen, word):
                 temp[word] = sc2
             else:
                 temp[word] = 0
         new[key] = temp
-    new = {k: deque([i for i, _ in sorted(v.items(), key=operator.itemgetter(1), reverse=True)]) for k, v in
-           new.iteritems()}
+    # entities not found in the article have the score None, which python 2 sorted below every number
+    new = {k: deque([i for i, _ in sorted(v.items(), key=lambda x: -np.inf if x[1] is None else x[1], reverse=True)])
+           for k, v in new.items()}
 
     for c in cap:
         if c.split('_')[0] in named_entities and c.isupper():
             ent = c.split('_')[0]
-            if ner_dict[ent]:
+            if ner_dict.get(ent):
                 ner = new[ent].popleft()
                 # append it again, we might need to reuse some entites.
                 new[ent].append(ner)
@@ -164,12 +220,17 @@ def fill_word2vec(cap, ner_dict, ner_articles, return_ners=False):
         return filled
 
 
-def insert_word(ner_test, sen_att, ix, ner_dict, return_ner=False):
+def insert_word(ner_test, sen_att, ix, ner_dict, sentences, return_ner=False, first_entity=None):
+    # sentences: article['sentence'],
+    # first_entity: EntityIndex(sentences, ...).by_type(ner_dict), to look the entities up
     if ner_test in named_entities:
         for ii in sen_att[ix]:
-            if ii < len(article['sentence']):
-                art_sen = article['sentence'][ii]
-                temp = [(art_sen.find(ner), ner) for ner in ner_dict[ner_test] if art_sen.find(ner) != -1]
+            if ii < len(sentences):
+                if first_entity is not None:
+                    temp = [(0, first_entity[ii, ner_test])] if (ii, ner_test) in first_entity else []
+                else:
+                    art_sen = sentences[ii]
+                    temp = [(art_sen.find(ner), ner) for ner in ner_dict.get(ner_test, []) if art_sen.find(ner) != -1]
 
                 temp = sorted(temp, key=lambda x: x[0])
                 if temp and return_ner: return temp[0][1], ner_test
@@ -180,14 +241,14 @@ def insert_word(ner_test, sen_att, ix, ner_dict, return_ner=False):
         return ner_test, None
 
 
-def insert(cap, sen_att, ner_dict, return_ners=False):
+def insert(cap, sen_att, ner_dict, sentences, return_ners=False, first_entity=None):
     new_sen = ''
     words = []
     if return_ners: ners = []
 
     for ix, c in enumerate(cap):
         ner_test = c.split('_')[0]
-        word, ner = insert_word(ner_test, sen_att, ix, ner_dict, return_ners)
+        word, ner = insert_word(ner_test, sen_att, ix, ner_dict, sentences, return_ners, first_entity)
         if ner:
             ners.append((word, ner))
         words.append(word)
@@ -197,73 +258,158 @@ def insert(cap, sen_att, ner_dict, return_ners=False):
     else:
         return ' '.join(words)
 
+
+
+def insert_caption(i):
+    # the captions of every method of _JOB for output[i]; runs in the workers, which
+    # build the entity indexes of the article they are on once
+    job = _JOB
+    h = job['output'][i]
+    key = job['id_to_key'][h['image_id']]
+    # the captions come sorted by article, so a worker that gets another article is done
+    # with the indexes of the previous one
+    if job['indexes_key'] != key:
+        job['indexes'].clear()
+        job['indexes_key'] = key
+    article = job['articles'][key]
+    cap = word_tokenize(h['caption'])
+    # the entity table of the store, organized once per article in the worker for an article.json
+    ner_dict = article.get('ner_organized')
+    if ner_dict is None:
+        if ('ner', key) not in job['indexes']:
+            job['indexes']['ner', key] = organize_ner(article['ner'], article['sentence'])
+        ner_dict = job['indexes']['ner', key]
+    result = {'index': i, 'image_id': h['image_id']}
+    for method in job['methods']:
+        # fill the caption with named entities
+        if method == 'ctx':
+            similarity = None
+            if job['sentence_vectors'] is not None:
+                first, count = job['sentence_index'][key]
+                similarity = rank_vectors(job['cap_vectors'][i], article['sentence_ner'],
+                                          job['sentence_vectors'][first:first + count])
+            if ('ctx', key) not in job['indexes']:
+                job['indexes']['ctx', key] = EntityIndex(article['sentence_ner'], entity_patterns(ner_dict))
+            filled = fill_word2vec(cap, ner_dict, article['sentence_ner'], similarity=similarity,
+                                   entity_index=job['indexes']['ctx', key])
+            result[method] = ' '.join(' '.join(filled).split())
+        elif method == 'rand':
+            # seeded per caption, so the draws do not depend on the worker
+            filled = fill_random(cap, ner_dict, np.random.RandomState(job['seed'] + i))
+            result[method] = ' '.join(' '.join(filled).split())
+        elif method == 'att':
+            sen_att = np.array(h['sen_att']).squeeze(axis=2)
+            sorted_sen_att = [s.argsort()[-55:][::-1] for s in sen_att]
+            if ('att', key) not in job['indexes']:
+                entities = [w for values in ner_dict.values() for w in values]
+                job['indexes']['att', key] = EntityIndex(article['sentence'], entities).by_type(ner_dict)
+            result[method], _ = insert(cap, sorted_sen_att, ner_dict, article['sentence'], True,
+                                       job['indexes']['att', key])
+    return result
+
+
+def run_insertion(processes, path=None):
+    # insert_caption for every caption of _JOB over a pool of forked workers (which share the
+    # articles, spacy and the vectors of the parent), each result appended to the jsonl file
+    # path as soon as it is done. Returns the results in the order of output and the time taken.
+    output = _JOB['output']
+    _JOB['indexes'] = {}
+    _JOB['indexes_key'] = None
+    # the captions of an article one after the other, so a worker mostly gets articles it has indexed
+    order = sorted(range(len(output)), key=lambda i: _JOB['id_to_key'][output[i]['image_id']])
+    results = [None] * len(output)
+    f = open(path, 'w') if path else None
+    start = time.time()
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.get_context('fork').Pool(processes)
+        done = pool.imap_unordered(insert_caption, order, chunksize=16)
+    else:
+        done = map(insert_caption, order)
+    for result in tqdm.tqdm(done, total=len(output)):
+        results[result['index']] = result
+        if f is not None:
+            f.write(json.dumps(result) + '\n')
+    elapsed = time.time() - start
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if f is not None:
+        f.close()
+    print('inserted %d captions (%s) with %d processes in %.1fs: %.1f captions/s' % (
+        len(output), ', '.join(_JOB['methods']), processes, elapsed, len(output) / max(elapsed, 1e-8)))
+    return results, elapsed
+
+
 if __name__=='__main__':
     parser = argparse.ArgumentParser()
     # Input paths
     parser.add_argument('--output', type=str, default='./vis/vis_show_attend_tell_default.json',
                         help='path to model to evaluate')
-    parser.add_argument('--insertion_method',type=list, default=['ctx', 'rand', 'att'],
+    parser.add_argument('--articles', type=str, default='./data/articles.sqlite',
+                        help='article store of create_article_set.py (or scripts/convert_article_json.py), or a legacy article.json')
+    parser.add_argument('--insertion_method', type=str, nargs='+', default=METHODS, choices=METHODS,
                         help='rand: random insertion, ctx: context/word2vec/glove insertion, att: attention insertion')
     parser.add_argument('--dump', type=bool, default=True,
-                        help='Save the inserted captions in a json file')
+                        help='Save the inserted captions in the jsonl file --insertion_output')
+    parser.add_argument('--insertion_output', type=str, default='./vis/insertions.jsonl',
+                        help='one json line {index, image_id, <method>: caption} per caption, written as they are done')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='insertion worker processes. 0 = one per cpu')
+    parser.add_argument('--scaling', type=int, default=0,
+                        help='first time the insertion with 1, 2, 4, ... --processes processes (1 = yes, 0 = no)?')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='rand insertion draws the entities of caption i with the seed seed + i')
+    parser.add_argument('--scorer', type=str, default='coco',
+                        help='coco: pycocoevalcap Bleu/METEOR/ROUGE_L/CIDEr/Spice, native: misc/scorer.py Bleu/ROUGE_L/CIDEr')
+    parser.add_argument('--scorer_processes', type=int, default=0,
+                        help='processes of the native scorer. 0 = one per cpu')
+    parser.add_argument('--score_cache', type=str, default='',
+                        help='sqlite file memoizing the per caption scores of the native scorer, e.g. data/score_cache.sqlite. empty = off')
+    parser.add_argument('--sentence_vectors', type=str, default='',
+                        help='path prefix of the article sentence vectors of scripts/prepro_sentence_vectors.py for ctx, e.g. ./data/article_sentence_vectors. empty = spacy per caption')
+    opt = parser.parse_args()
 
+    startup_start = time.time()
     test_compact = open_json('./data/test.json')
-    article_dataset = open_json('./data/article.json')
-    stopwords = stop_words.get_stop_words('en')
-    named_entities = ['PERSON', 'NORP', 'FAC', 'ORG', 'GPE', 'LOC', 'PRODUCT', 'EVENT', 'WORK_OF_ART', 'LANGUAGE',
-                      'DATE', 'TIME', 'PERCENT', 'MONEY', 'QUANTITY', 'ORDINAL', 'CARDINAL']
+    # read per article key by the workers, only a .json is loaded as a whole
+    article_dataset = open_articles(opt.articles)
     nlp = spacy.load('en_core_web_lg', disable=['parser', 'tagger', 'ner'])
 
     # Start the insertion process
-    opt = parser.parse_args()
     output = open_json(opt.output)
     id_to_key = {h['image_id']: h['image_path'].split('/')[1].split('_')[0] for h in output}
     id_to_index = {h['cocoid']: i for i, h in enumerate(test_compact)}
+    # retrieve the reference sentences
     ref = []
     for h in tqdm.tqdm(output):
         imgId = h['image_id']
         index = id_to_index[imgId]
         ref.append(test_compact[index]['sentences_full'][0]['raw'])
 
+    _JOB.update(output=output, articles=article_dataset, id_to_key=id_to_key, methods=opt.insertion_method,
+                seed=opt.seed, sentence_vectors=None)
+    if opt.sentence_vectors and 'ctx' in opt.insertion_method:
+        start = time.time()
+        _JOB['sentence_vectors'], _JOB['sentence_index'] = load_sentence_vectors(opt.sentence_vectors)
+        _JOB['cap_vectors'] = caption_vectors([' '.join(word_tokenize(h['caption'])) for h in output])
+        print('caption vectors of %d captions took %.1fs' % (len(output), time.time() - start))
+    print('startup took {:.1f}s, max RSS {:.0f} MB'.format(
+        time.time() - startup_start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+    processes = opt.processes or os.cpu_count()
+    if opt.scaling:
+        counts = [1]
+        while counts[-1] * 2 < processes:
+            counts.append(counts[-1] * 2)
+        counts = sorted(set(counts + [processes]))
+        elapsed = [run_insertion(n)[1] for n in counts]
+        print('%10s %12s %8s' % ('processes', 'captions/s', 'speedup'))
+        for n, seconds in zip(counts, elapsed):
+            print('%10d %12.1f %8.2f' % (n, len(output) / max(seconds, 1e-8), elapsed[0] / max(seconds, 1e-8)))
+
+    results, _ = run_insertion(processes, opt.insertion_output if opt.dump else None)
     for method in opt.insertion_method:
-        hypo = []
-        if method == 'att':
-            att_sen = []
-        for h in tqdm.tqdm(output):
-            imgId = h['image_id']
-            #         cap = compact_NE(h['caption'])
-            cap = word_tokenize(h['caption'])
-            key = id_to_key[imgId]
-            # index = id_to_index[imgId]
-            # ref.append(test_compact[index]['sentences_full'][0]['raw'])
-
-            ner_articles = article_dataset[key]['sentence_ner']
-            ner_dict = article_dataset[key]['ner']
-            ner_dict = organize_ner(ner_dict)
-
-            # fill the caption with named entities
-            if method=='ctx':
-                cap = fill_word2vec(cap, ner_dict, ner_articles)
-                cap = ' '.join(cap)
-                hypo.append(' '.join(cap.split()))
-            elif method=='rand':
-                cap = fill_random(cap, ner_dict)
-                cap = ' '.join(cap)
-                hypo.append(' '.join(cap.split()))
-            elif method=='att':
-                sen_att = np.array(h['sen_att']).squeeze(axis=2)
-                sorted_sen_att = [s.argsort()[-55:][::-1] for s in sen_att]
-                att_sen.append(sorted_sen_att)
-
-                article = article_dataset[key]
-                index = id_to_index[imgId]
-                ner_dict = article_dataset[key]['ner']
-                ner_dict = organize_ner(ner_dict)
-                sen, name = insert(cap, sorted_sen_att, ner_dict, True)
-                hypo.append(sen)
-
-        # retrieve the reference sentences
-        if opt.dump:
-            json.dump(hypo, open('./vis/%s.json' % method, 'wb'))
+        hypo = [result[method] for result in results]
         print('Insertion Method: %s' % method)
-        sc, scs = evaluate(ref, hypo)
\ No newline at end of file
+        sc, scs = evaluate(ref, hypo, scorer=opt.scorer, processes=opt.scorer_processes, cache=opt.score_cache)
@@ -0,0 +1,172 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import os
+import re
+import sqlite3
+
+import stop_words
+
+# Keyed random access to the article set of prepocess/create_article_set.py. article.json is
+# one big dict {key: {'sentence', 'sentence_ner', 'ner'}} that has to be parsed as a whole
+# before the first article can be read; the store keeps one sqlite row per article, with the
+# fields json encoded in their own columns, and only decodes the articles (and the fields)
+# that are asked for:
+#   articles = ArticleStore('data/articles.sqlite')
+#   articles[key]['sentence_ner'], key in articles, len(articles), articles.items()
+# The connection is opened on first use in every process, so a store can be handed to
+# forked workers. Next to the fields of article.json every row has 'ner_organized', the
+# organize_ner table insert.py fills captions from, computed once when the article is written.
+
+FIELDS = ['sentence', 'sentence_ner', 'ner', 'ner_organized']
+STOPWORDS = frozenset(stop_words.get_stop_words('en'))
+
+
+def organize_ner(ner, sentences=()):
+    # the entities of an article's ner {entity: type} by type, whitespace normalized and
+    # without stop words, every bucket without duplicates and the entities mentioned most in
+    # the article sentences first (in the order of ner on a tie):
+    #   {'PERSON': ['John Smith', 'Jane Doe'], 'GPE': [...]}
+    # the sentences are tokenized without punctuation, so an entity is also counted in the
+    # form insert.py looks for it in, with every run of other characters a space
+    text = '\n'.join(sentences)
+
+    def mentions(entity):
+        count = text.count(entity)
+        pattern = re.sub('[^A-Za-z0-9]+', ' ', entity)
+        if pattern != entity and pattern.strip():
+            count += text.count(pattern)
+        return count
+
+    buckets = collections.OrderedDict()
+    for entity, ent_type in ner.items():
+        entity = ' '.join(entity.split())
+        if entity not in STOPWORDS:
+            buckets.setdefault(ent_type, collections.OrderedDict())[entity] = None
+    return dict((ent_type, sorted(entities, key=mentions, reverse=True)) for ent_type, entities in buckets.items())
+
+
+class ArticleStore(object):
+    def __init__(self, path, writable=False, fields=None, cache_size=64):
+        # fields: the fields articles are read with, all of them by default
+        # cache_size: number of decoded articles kept in memory, most recently read last
+        assert writable or os.path.isfile(path), 'no article store at %s' % path
+        self.path = path
+        self.writable = writable
+        self.fields = list(fields or FIELDS)
+        assert all(field in FIELDS for field in self.fields), 'unknown article fields %s' % self.fields
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._db = None
+        self._pid = None
+        if writable:
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.db.execute('CREATE TABLE IF NOT EXISTS articles (key TEXT PRIMARY KEY, %s)'
+                            % ', '.join('%s TEXT' % field for field in FIELDS))
+            # stores written before a field existed get its column, empty until rewritten
+            for field in FIELDS:
+                if field not in self._columns():
+                    self.db.execute('ALTER TABLE articles ADD COLUMN %s TEXT' % field)
+            self._read_fields = list(self.fields)
+
+    @property
+    def db(self):
+        if self._db is None or self._pid != os.getpid():
+            if self.writable:
+                self._db = sqlite3.connect(self.path)
+                self._db.execute('PRAGMA journal_mode=WAL')
+                self._db.execute('PRAGMA synchronous=NORMAL')
+            else:
+                self._db = sqlite3.connect('file:%s?mode=ro' % os.path.abspath(self.path), uri=True)
+            self._pid = os.getpid()
+            self._cache.clear()
+            # the fields read: the ones asked for the store has a column of
+            columns = self._columns()
+            self._read_fields = [field for field in self.fields if field in columns]
+        return self._db
+
+    def _columns(self):
+        return set(row[1] for row in self._db.execute('PRAGMA table_info(articles)'))
+
+    def _decode(self, row):
+        # a field missing in a row (stores of older versions) is left out of its article
+        return dict((field, json.loads(value)) for field, value in zip(self._read_fields, row) if value is not None)
+
+    def __getitem__(self, key):
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        db = self.db
+        row = db.execute('SELECT %s FROM articles WHERE key = ?' % ', '.join(self._read_fields), (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        article = self._decode(row)
+        self._cache[key] = article
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return article
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.db.execute('SELECT 1 FROM articles WHERE key = ?', (key,)).fetchone() is not None
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM articles').fetchone()[0]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        # in the order the articles were written
+        return [key for key, in self.db.execute('SELECT key FROM articles ORDER BY rowid')]
+
+    def items(self):
+        # streamed, one decoded article at a time
+        db = self.db
+        rows = db.execute('SELECT key, %s FROM articles ORDER BY rowid' % ', '.join(self._read_fields))
+        for row in rows:
+            yield row[0], self._decode(row[1:])
+
+    def values(self):
+        for _, article in self.items():
+            yield article
+
+    def put_many(self, items):
+        # items: (key, {'sentence', 'sentence_ner', 'ner'}), written in one transaction
+        assert self.writable, 'article store %s is read only' % self.path
+        rows = []
+        for key, article in items:
+            if 'ner_organized' not in article:
+                article = dict(article, ner_organized=organize_ner(article['ner'], article['sentence']))
+            rows.append((key,) + tuple(json.dumps(article[field], ensure_ascii=False) for field in FIELDS))
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO articles (key, %s) VALUES (?, %s)'
+                                % (', '.join(FIELDS), ', '.join('?' * len(FIELDS))), rows)
+        self._cache.clear()
+
+    def put(self, key, article):
+        self.put_many([(key, article)])
+
+    def close(self):
+        if self._db is not None and self._pid == os.getpid():
+            self._db.close()
+        self._db = None
+        self._cache.clear()
+
+
+def open_articles(path, fields=None):
+    # the articles of path: an ArticleStore, or the dict of a (legacy) article.json
+    if path.endswith('.json'):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return ArticleStore(path, fields=fields)
@@ -0,0 +1,148 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import os
+import re
+import shutil
+import sys
+import threading
+
+import torch
+from six.moves import cPickle
+
+# <name>-<iteration> files of CheckpointWriter: model-1000.pth, infos_-1000.pkl
+NUMBERED = re.compile(r'^(.+)-(\d+)(\.[^.]+)$')
+
+
+def to_cpu(obj):
+    # Snapshot of (nested) state dicts and infos: every tensor is copied to cpu memory
+    # and every container copied, so training can go on while the snapshot is being written.
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, argparse.Namespace):
+        return argparse.Namespace(**to_cpu(vars(obj)))
+    if isinstance(obj, dict):
+        out = type(obj)((k, to_cpu(v)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):
+            # module state dicts carry their version numbers here
+            out._metadata = obj._metadata
+        return out
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    # write to a temporary file and rename it, so a crash never leaves a truncated checkpoint
+    tmp = path + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            if path.endswith('.pkl'):
+                cPickle.dump(obj, f)
+            else:
+                torch.save(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+    except Exception:
+        # open() itself may have failed, leaving no file and the error to raise
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    os.replace(tmp, path)
+
+
+def atomic_link(src, dst):
+    # publish src under another name without serializing it again (copy if hard links are not supported)
+    tmp = dst + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def suffixed(name, suffix):
+    # model.pth -> model-best.pth, infos_.pkl -> infos_-1000.pkl
+    root, ext = os.path.splitext(name)
+    return '%s-%s%s' % (root, suffix, ext)
+
+
+def numbered_files(directory):
+    # the <name>-<iteration> files in directory, a list per iteration in iteration order
+    saves = collections.defaultdict(list)
+    for name in sorted(os.listdir(directory)):
+        match = NUMBERED.match(name)
+        if match:
+            saves[int(match.group(2))].append(os.path.join(directory, name))
+    return [saves[iteration] for iteration in sorted(saves)]
+
+
+class CheckpointWriter(object):
+    # Writes the checkpoints of train.py in a background thread. Each save writes
+    # <name>-<iteration> files and points <name> (and <name>-best for the best model)
+    # at them with hard links, so start_from and eval.py find the usual file names.
+    # Only the numbered files of the last `keep` saves are kept, counting the ones earlier
+    # runs left in the directory, so a resumed run prunes them too.
+    def __init__(self, directory, keep=1, background=True):
+        assert keep > 0, "keep should be greater than 0"
+        self.directory = directory
+        self.keep = keep
+        self.background = background
+        self.thread = None
+        self.error = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # numbered files of the saves still on disk, of this run and the earlier ones
+        self.saved = numbered_files(directory)
+
+    def save(self, iteration, files, best=(), done=None):
+        # files: list of (name, object), .pkl names are pickled, the rest torch.save'd
+        # best: names to publish as <name>-best as well
+        # done: called once the files are on disk
+        self.wait()
+        files = [(name, to_cpu(obj)) for name, obj in files]
+        if self.background:
+            self.thread = threading.Thread(target=self.write, args=(iteration, files, best, done))
+            self.thread.start()
+        else:
+            self.write(iteration, files, best, done)
+
+    def wait(self):
+        # block until the previous save is on disk, and raise its error if it failed
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error[1].with_traceback(error[2])
+
+    def write(self, iteration, files, best, done=None):
+        try:
+            numbered = []
+            for name, obj in files:
+                path = os.path.join(self.directory, suffixed(name, iteration))
+                atomic_save(obj, path)
+                numbered.append(path)
+                atomic_link(path, os.path.join(self.directory, name))
+                if name in best:
+                    atomic_link(path, os.path.join(self.directory, suffixed(name, 'best')))
+            print("checkpoint of iteration {} saved to {}".format(iteration, self.directory))
+            if done is not None:
+                done()
+            # a resumed run saving an iteration again replaced its files
+            self.saved = [[path for path in paths if path not in numbered] for paths in self.saved]
+            self.saved = [paths for paths in self.saved if paths]
+            self.saved.append(numbered)
+            while len(self.saved) > self.keep:
+                for path in self.saved.pop(0):
+                    if os.path.exists(path):
+                        os.remove(path)
+        except Exception:
+            if not self.background:
+                raise
+            self.error = sys.exc_info()
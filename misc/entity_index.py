@@ -0,0 +1,46 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import ahocorasick
+
+
+class EntityIndex(object):
+    # Where the named entities of an article occur in a list of its sentences, found with one
+    # Aho-Corasick pass over every sentence instead of a str.find per entity and sentence:
+    #   index.occurrences[entity] = {sentence index: offset of the first occurrence}
+    # An empty entity occurs at offset 0 of every sentence, as with str.find.
+    def __init__(self, sentences, entities):
+        self.n_sentences = len(sentences)
+        self.occurrences = dict((entity, {}) for entity in entities)
+        automaton = ahocorasick.Automaton()
+        for entity in self.occurrences:
+            if entity:
+                automaton.add_word(entity, entity)
+        if len(automaton):
+            automaton.make_automaton()
+            for i, sentence in enumerate(sentences):
+                # matches come by end position, so the first match of an entity is its first occurrence
+                for end, entity in automaton.iter(sentence):
+                    self.occurrences[entity].setdefault(i, end - len(entity) + 1)
+        if '' in self.occurrences:
+            self.occurrences[''] = dict((i, 0) for i in range(len(sentences)))
+
+    def first_ranked(self, entity, rank):
+        # the sentence with the lowest rank[sentence] containing entity, None if there is none
+        sentences = self.occurrences.get(entity)
+        if not sentences:
+            return None
+        return min(sentences, key=rank.__getitem__)
+
+    def by_type(self, ner_dict):
+        # {(sentence, type): the entity of ner_dict[type] occurring first in the sentence};
+        # on the same offset the one listed first, as a stable sort by offset would pick
+        first = {}
+        for ent, values in ner_dict.items():
+            for order, entity in enumerate(values):
+                for sentence, offset in self.occurrences.get(entity, {}).items():
+                    key = (sentence, ent)
+                    if key not in first or (offset, order) < first[key][0]:
+                        first[key] = ((offset, order), entity)
+        return dict((key, entity) for key, (_, entity) in first.items())
@@ -0,0 +1,131 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import glob
+import gzip
+import json
+import os
+import shutil
+
+from six.moves import cPickle
+
+
+class HistoryLog(object):
+    # Append-only training history. Every logged iteration is one json line of
+    # <directory>/history_<id>.jsonl (train loss, lr, ss_prob or val loss and lang_stats),
+    # the validation predictions go to their own predictions_<id>-<iteration>.json.gz.
+    # train.py also logs every checkpoint on disk ({"iter", "checkpoint"}) and the end of
+    # training ({"iter", "done"}), which is what eval_worker.py follows.
+    # Logging costs the same at every iteration however long the run is; the
+    # loss/lr/ss_prob/val_result histories are only rebuilt when asked for.
+    def __init__(self, directory, id=''):
+        self.directory = directory
+        self.id = id
+        self.path = os.path.join(directory, 'history_%s.jsonl' % id)
+        self._histories = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def predictions_path(self, iteration):
+        return os.path.join(self.directory, 'predictions_%s-%s.json.gz' % (self.id, iteration))
+
+    def append(self, entry):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry, default=float) + '\n')
+        self._histories = None
+
+    def log(self, iteration, **values):
+        values['iter'] = iteration
+        self.append(values)
+
+    def log_val(self, iteration, val_loss, lang_stats, predictions):
+        path = self.predictions_path(iteration)
+        with gzip.open(path + '.tmp', 'wt') as f:
+            json.dump(predictions, f)
+        os.replace(path + '.tmp', path)
+        self.log(iteration, val_loss=val_loss, lang_stats=lang_stats)
+
+    def resume(self, start_from=None, iteration=0):
+        # Continue the history of start_from (a fresh one if None) at iteration. Nothing is
+        # rewritten: the entries after iteration are dropped when the log is read back.
+        if start_from is not None:
+            source = HistoryLog(start_from, self.id)
+            legacy = os.path.join(start_from, 'histories_' + self.id + '.pkl')
+            if os.path.isfile(source.path):
+                if os.path.abspath(source.path) != os.path.abspath(self.path):
+                    shutil.copyfile(source.path, self.path)
+                    for path in glob.glob(source.predictions_path('*')):
+                        shutil.copy(path, self.directory)
+            elif os.path.isfile(legacy):
+                self.convert(legacy)
+        if os.path.isfile(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                cut = f.read(1) != b'\n'
+            if cut:
+                # end the line a crash cut short, so the next entry is not glued to it
+                with open(self.path, 'a') as f:
+                    f.write('\n')
+        self.append({'resume': iteration})
+
+    def convert(self, histories_path):
+        # log the histories pickle of an older run
+        with open(histories_path, 'rb') as f:
+            histories = cPickle.load(f)
+        self.append({'resume': 0})
+        for iteration in sorted(histories.get('loss_history', {})):
+            self.log(iteration, loss=histories['loss_history'][iteration],
+                     lr=histories.get('lr_history', {}).get(iteration),
+                     ss_prob=histories.get('ss_prob_history', {}).get(iteration))
+        val_result_history = histories.get('val_result_history', {})
+        for iteration in sorted(val_result_history):
+            result = val_result_history[iteration]
+            self.log_val(iteration, result['loss'], result['lang_stats'], result['predictions'])
+
+    def histories(self):
+        # the dicts train.py used to pickle, read back from the log; the predictions of
+        # an evaluation are loaded on demand by load_predictions(iteration)
+        if self._histories is None:
+            histories = {'loss_history': {}, 'lr_history': {}, 'ss_prob_history': {}, 'val_result_history': {}}
+            if os.path.isfile(self.path):
+                with open(self.path) as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # a line cut short by a crash
+                            continue
+                        if 'resume' in entry:
+                            for history in histories.values():
+                                for iteration in [_ for _ in history if _ > entry['resume']]:
+                                    del history[iteration]
+                        elif 'val_loss' in entry:
+                            histories['val_result_history'][entry['iter']] = {
+                                'loss': entry['val_loss'], 'lang_stats': entry['lang_stats']}
+                        elif 'loss' in entry:
+                            histories['loss_history'][entry['iter']] = entry['loss']
+                            histories['lr_history'][entry['iter']] = entry['lr']
+                            histories['ss_prob_history'][entry['iter']] = entry['ss_prob']
+            self._histories = histories
+        return self._histories
+
+    def follow(self, offset=0):
+        # the complete entries appended after byte offset, and the offset to continue from
+        entries = []
+        if os.path.isfile(self.path):
+            with open(self.path, 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    offset += len(line)
+                    try:
+                        entries.append(json.loads(line.decode('utf-8')))
+                    except ValueError:
+                        continue
+        return entries, offset
+
+    def load_predictions(self, iteration):
+        with gzip.open(self.predictions_path(iteration), 'rt') as f:
+            return json.load(f)
@@ -0,0 +1,102 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import contextlib
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+_OFF = contextlib.nullcontext()
+
+
+class _Span(object):
+    def __init__(self, profiler, name, gpu):
+        self.profiler = profiler
+        self.name = name
+        self.gpu = gpu and profiler.cuda
+        self.start_event = None
+
+    def __enter__(self):
+        if self.gpu:
+            self.start_event = torch.cuda.Event(enable_timing=True)
+            self.start_event.record()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        end_event = None
+        if self.gpu:
+            end_event = torch.cuda.Event(enable_timing=True)
+            end_event.record()
+        self.profiler.pending.append((self.name, self.start, end, self.start_event, end_event))
+        return False
+
+
+class Profiler(object):
+    # Named spans around the phases of a training iteration:
+    #   with profiler.span('loader wait'): data = loader.get_batch('train')
+    #   with profiler.span('backward', gpu=True): loss.backward()
+    # Spans are host wall time (perf_counter). A gpu span is measured between cuda events
+    # instead, so it times the kernels it queued rather than the launch; the events are read
+    # back (one synchronize) in step(). In the trace gpu spans get their own row, placed on
+    # the device clock from the host time of the first gpu span of the iteration.
+    # Every `every` iterations the p50/p90/p99 of each span are printed and, with trace_dir,
+    # the spans of the window are exported as a Chrome trace (chrome://tracing, Perfetto).
+    # With every = 0 span() returns a shared no-op context manager.
+    def __init__(self, every=0, trace_dir='', cuda=None):
+        self.every = every
+        self.trace_dir = trace_dir
+        self.cuda = torch.cuda.is_available() if cuda is None else cuda
+        self.pending = []
+        self.times = collections.OrderedDict()
+        self.trace = []
+
+    def span(self, name, gpu=False):
+        if not self.every:
+            return _OFF
+        return _Span(self, name, gpu)
+
+    def step(self, iteration):
+        # end of an iteration: resolve its spans and report every `every` iterations
+        if not self.every:
+            return
+        gpu_spans = [span for span in self.pending if span[3] is not None]
+        if gpu_spans:
+            gpu_spans[-1][4].synchronize()
+            # host time of the first gpu span, the origin of the device clock in the trace
+            origin, origin_event = gpu_spans[0][1], gpu_spans[0][3]
+        for name, start, end, start_event, end_event in self.pending:
+            if start_event is None:
+                ts, seconds, tid = start, end - start, 0
+            else:
+                ts = origin + origin_event.elapsed_time(start_event) / 1000.0
+                seconds, tid = start_event.elapsed_time(end_event) / 1000.0, 1
+            self.times.setdefault(name, []).append(seconds)
+            if self.trace_dir:
+                self.trace.append({'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+                                   'ts': ts * 1e6, 'dur': seconds * 1e6, 'args': {'iteration': iteration}})
+        self.pending = []
+        if iteration % self.every == 0:
+            self.report(iteration)
+
+    def report(self, iteration):
+        print('profile of the last {} iterations at iteration {} (ms)'.format(self.every, iteration))
+        print('%-16s %8s %8s %8s %8s %8s' % ('span', 'count', 'mean', 'p50', 'p90', 'p99'))
+        for name, times in self.times.items():
+            ms = 1000.0 * np.array(times)
+            print('%-16s %8d %8.2f %8.2f %8.2f %8.2f' % ((name, len(ms), ms.mean()) + tuple(np.percentile(ms, [50, 90, 99]))))
+        self.times = collections.OrderedDict()
+        if self.trace_dir:
+            if not os.path.isdir(self.trace_dir):
+                os.makedirs(self.trace_dir)
+            path = os.path.join(self.trace_dir, 'trace-%d.json' % iteration)
+            with open(path, 'w') as f:
+                json.dump({'traceEvents': self.trace, 'displayTimeUnit': 'ms'}, f)
+            print('chrome trace written to {}'.format(path))
+            self.trace = []
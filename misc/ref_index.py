@@ -0,0 +1,197 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import glob
+import hashlib
+import json
+import math
+import os
+import time
+
+import numpy as np
+from six.moves import cPickle
+from pycocoevalcap.bleu.bleu_scorer import BleuScorer, cook_refs as bleu_cook_refs, cook_test as bleu_cook_test
+from pycocoevalcap.cider.cider_scorer import cook_test as cider_cook_test
+
+from misc.checkpoint import atomic_save
+
+# Reference side of the caption metrics, prepared once per annotation file (data/val.json,
+# data/test.json) instead of on every language_eval: the references, their
+# BLEU (length, clipped counts) and CIDEr-D n-gram counts and the CIDEr-D document
+# frequencies. The index is pickled next to the annotation file, named after the sha1 of
+# its content, and kept in memory for the next validation passes of the process.
+# The scores are the ones of pycocoevalcap's Bleu and Cider, computed the same way.
+
+# bumped when the pickled index changes, older pickles are rebuilt
+VERSION = 2
+_INDEXES = {}
+
+
+def file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class DocumentFrequency(dict):
+    # CiderScorer keeps its document frequencies in a defaultdict, which grows with every
+    # hypothesis n-gram it is asked about; this one stays the same when shared across calls
+    def __missing__(self, ngram):
+        return 0.0
+
+
+class ReferenceIndex(object):
+    def __init__(self, dataset, n=4, sigma=6.0):
+        # dataset: the content of val.json/test.json, [{'cocoid', 'sentences': [{'raw'}]}]
+        self.n = n
+        self.sigma = sigma
+        self.refs = {}
+        self.bleu_refs = {}
+        self.cider_refs = {}
+        self.ngrams = {}
+        for image in dataset:
+            image_id = image['cocoid']
+            raws = [sentence['raw'] for sentence in image['sentences']]
+            self.refs[image_id] = raws
+            self.bleu_refs[image_id] = bleu_cook_refs(raws, n=n)
+            self.cider_refs[image_id] = [dict(cider_cook_test(raw, n=n)) for raw in raws]
+            self.ngrams[image_id] = tuple(set(ngram for counts in self.cider_refs[image_id] for ngram in counts))
+        self.all_ids = frozenset(self.refs)
+        self.full_document_frequency = self._document_frequency(self.refs)
+        self._init_memo()
+
+    def _init_memo(self):
+        # CIDEr-D document frequencies and reference vectors of the image sets scored so far
+        # (they depend on the images scored together), most recent last
+        self._memo = collections.OrderedDict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_memo']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_memo()
+
+    @classmethod
+    def load(cls, ann_file):
+        # the index of ann_file, from memory, from its pickle or built (and pickled)
+        stat = os.stat(ann_file)
+        key = (os.path.abspath(ann_file), stat.st_size, stat.st_mtime_ns)
+        if key in _INDEXES:
+            return _INDEXES[key]
+        start = time.time()
+        sha1 = file_sha1(ann_file)
+        path = '%s.refindex-%d-%s.pkl' % (ann_file, VERSION, sha1[:16])
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                index = cPickle.load(f)
+            print('reference index of {} loaded in {:.2f}s'.format(ann_file, time.time() - start))
+        else:
+            with open(ann_file, 'rb') as f:
+                index = cls(json.load(f))
+            for stale in glob.glob(ann_file + '.refindex-*.pkl'):
+                os.remove(stale)
+            atomic_save(index, path)
+            print('reference index of {} built in {:.2f}s, saved to {}'.format(ann_file, time.time() - start, path))
+        _INDEXES.clear()
+        _INDEXES[key] = index
+        return index
+
+    def _document_frequency(self, image_ids):
+        document_frequency = DocumentFrequency()
+        for image_id in image_ids:
+            for ngram in self.ngrams[image_id]:
+                document_frequency[ngram] = document_frequency.get(ngram, 0.0) + 1
+        return document_frequency
+
+    def _cider_state(self, image_ids):
+        key = frozenset(image_ids)
+        if key in self._memo:
+            self._memo.move_to_end(key)
+            return self._memo[key]
+        if key == self.all_ids:
+            document_frequency = self.full_document_frequency
+        else:
+            document_frequency = self._document_frequency(key)
+        state = {'document_frequency': document_frequency,
+                 'ref_len': np.log(float(len(key))),
+                 'vectors': {}}
+        self._memo[key] = state
+        while len(self._memo) > 4:
+            self._memo.popitem(last=False)
+        return state
+
+    def _counts2vec(self, counts, state):
+        # CiderScorer.compute_cider's counts2vec, with plain dicts
+        vec = [{} for _ in range(self.n)]
+        norm = [0.0 for _ in range(self.n)]
+        length = 0
+        document_frequency = state['document_frequency']
+        for ngram, term_freq in counts.items():
+            df = np.log(max(1.0, document_frequency[ngram]))
+            n = len(ngram) - 1
+            vec[n][ngram] = float(term_freq) * (state['ref_len'] - df)
+            norm[n] += pow(vec[n][ngram], 2)
+            if n == 1:
+                length += term_freq
+        norm = [np.sqrt(n) for n in norm]
+        return vec, norm, length
+
+    def _sim(self, vec_hyp, vec_ref, norm_hyp, norm_ref, length_hyp, length_ref):
+        delta = float(length_hyp - length_ref)
+        val = np.array([0.0 for _ in range(self.n)])
+        for n in range(self.n):
+            for ngram, weight in vec_hyp[n].items():
+                ref_weight = vec_ref[n].get(ngram, 0.0)
+                val[n] += min(weight, ref_weight) * ref_weight
+            if (norm_hyp[n] != 0) and (norm_ref[n] != 0):
+                val[n] /= (norm_hyp[n] * norm_ref[n])
+            assert(not math.isnan(val[n]))
+            val[n] *= np.e ** (-(delta ** 2) / (2 * self.sigma ** 2))
+        return val
+
+    def cider(self, hypo):
+        # pycocoevalcap Cider().compute_score(refs, hypo) for hypo {image_id: [caption]}
+        image_ids = list(hypo.keys())
+        state = self._cider_state(image_ids)
+        vectors = state['vectors']
+        scores = []
+        for image_id in image_ids:
+            vec, norm, length = self._counts2vec(cider_cook_test(hypo[image_id][0], n=self.n), state)
+            if image_id not in vectors:
+                vectors[image_id] = [self._counts2vec(ref, state) for ref in self.cider_refs[image_id]]
+            score = np.array([0.0 for _ in range(self.n)])
+            for vec_ref, norm_ref, length_ref in vectors[image_id]:
+                score += self._sim(vec, vec_ref, norm, norm_ref, length, length_ref)
+            score_avg = np.mean(score)
+            score_avg /= len(vectors[image_id])
+            score_avg *= 10.0
+            scores.append(score_avg)
+        return np.mean(np.array(scores)), np.array(scores)
+
+    def bleu(self, hypo, verbose=1):
+        # pycocoevalcap Bleu(4).compute_score(refs, hypo)
+        bleu_scorer = BleuScorer(n=self.n)
+        for image_id, captions in hypo.items():
+            assert(len(captions) == 1)
+            crefs = self.bleu_refs[image_id]
+            bleu_scorer.crefs.append(crefs)
+            bleu_scorer.ctest.append(bleu_cook_test(captions[0], crefs, n=self.n))
+        return bleu_scorer.compute_score(option='closest', verbose=verbose)
+
+
+class IndexedScorer(object):
+    # scorer with the compute_score(gts, res) interface of pycocoevalcap, for eval_utils.evaluate
+    def __init__(self, index, metric):
+        self.index = index
+        self.metric = metric
+
+    def compute_score(self, gts, res):
+        assert(gts.keys() == res.keys())
+        return getattr(self.index, self.metric)(res)
@@ -0,0 +1,109 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+import misc.scorer as native_scorer
+
+# Persistent per caption memo of misc/scorer.py. Checkpoints of a run repeat many of their
+# validation captions and insert.py scores the same references for every insertion method,
+# so only the (caption, references) pairs never seen before are scored. An sqlite table maps
+#   sha1(caption, references[, corpus]) + metric -> float64 values
+# where Bleu keeps the caption's sufficient statistics (testlen, reflen, guess, correct), the
+# corpus Bleu is recomputed from them, and ROUGE_L its score. CIDEr depends on the document
+# frequencies of all the references scored together, so its key also has the hash of the
+# corpus references.
+#   final_scores, all_scores = ScoreCache.get('data/score_cache.sqlite').score(refs, hypo)
+
+METRICS = ['bleu', 'rouge', 'cider']
+_CACHES = {}
+
+
+def _sha1(*parts):
+    sha1 = hashlib.sha1()
+    for part in parts:
+        sha1.update(part.encode('utf-8') if not isinstance(part, bytes) else part)
+        sha1.update(b'\0')
+    return sha1.digest()
+
+
+class ScoreCache(object):
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS scores (key BLOB PRIMARY KEY, value BLOB)')
+        self.hits = dict((metric, 0) for metric in METRICS)
+        self.lookups = dict((metric, 0) for metric in METRICS)
+
+    @classmethod
+    def get(cls, path):
+        # one cache (and its hit counts) per path and process
+        if path not in _CACHES:
+            _CACHES[path] = cls(path)
+        return _CACHES[path]
+
+    def fetch(self, keys):
+        values = {}
+        for start in range(0, len(keys), 900):
+            batch = keys[start:start + 900]
+            rows = self.db.execute('SELECT key, value FROM scores WHERE key IN (%s)' % ','.join('?' * len(batch)), batch)
+            for key, value in rows:
+                values[bytes(key)] = np.frombuffer(value, dtype=np.float64)
+        return values
+
+    def store(self, items):
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO scores VALUES (?, ?)',
+                                ((key, np.asarray(value, dtype=np.float64).tobytes()) for key, value in items))
+
+    def hit_rate(self):
+        # fraction of the lookups of each metric found in the cache
+        return dict((metric, self.hits[metric] / float(max(self.lookups[metric], 1))) for metric in METRICS)
+
+    def score(self, refs, hypo, processes=0):
+        # misc.scorer.score(refs, hypo), with the per caption values of the cache
+        assert refs.keys() == hypo.keys()
+        image_ids = list(hypo.keys())
+        ref_hashes = [_sha1(json.dumps(refs[image_id])) for image_id in image_ids]
+        corpus = _sha1(*sorted(ref_hashes))
+        keys = {}
+        for image_id, ref_hash in zip(image_ids, ref_hashes):
+            pair = _sha1(hypo[image_id][0], ref_hash)
+            keys[image_id] = {'bleu': pair + b'bleu', 'rouge': pair + b'rouge', 'cider': _sha1(pair, corpus) + b'cider'}
+        cached = self.fetch([key for image_keys in keys.values() for key in image_keys.values()])
+        for metric in METRICS:
+            self.lookups[metric] += len(image_ids)
+            self.hits[metric] += sum(keys[image_id][metric] in cached for image_id in image_ids)
+
+        missing = [image_id for image_id in image_ids if any(key not in cached for key in keys[image_id].values())]
+        if missing:
+            testlen, reflen, guess, correct, rouge, cider = native_scorer.statistics(
+                refs, hypo, processes, image_ids=missing)
+            bleu = np.concatenate([testlen[:, None], reflen[:, None], guess, correct], 1)
+            items = []
+            for i, image_id in enumerate(missing):
+                values = {'bleu': bleu[i], 'rouge': rouge[i:i + 1], 'cider': cider[i:i + 1]}
+                for metric in METRICS:
+                    cached[keys[image_id][metric]] = values[metric]
+                    items.append((keys[image_id][metric], values[metric]))
+            self.store(items)
+
+        bleu = np.stack([cached[keys[image_id]['bleu']] for image_id in image_ids]).reshape(-1, 2 + 2 * native_scorer.N)
+        rouge = np.array([cached[keys[image_id]['rouge']][0] for image_id in image_ids])
+        cider = np.array([cached[keys[image_id]['cider']][0] for image_id in image_ids])
+        hit_rate = self.hit_rate()
+        print('score cache: {} new of {} captions, hit rate bleu {:.1%} rouge {:.1%} cider {:.1%}'.format(
+            len(missing), len(image_ids), hit_rate['bleu'], hit_rate['rouge'], hit_rate['cider']))
+        n = native_scorer.N
+        return native_scorer.aggregate(bleu[:, 0], bleu[:, 1], bleu[:, 2:2 + n], bleu[:, 2 + n:], rouge, cider)
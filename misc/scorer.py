@@ -0,0 +1,243 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import itertools
+import multiprocessing
+import os
+
+import numpy as np
+import scipy.sparse
+
+# Bleu_1..4, ROUGE_L and CIDEr (pycocoevalcap's Cider, i.e. CIDEr-D: clipped tf-idf and
+# length penalty) of a whole corpus at once, the scores of pycocoevalcap's Bleu(4), Rouge()
+# and Cider() up to float rounding. Words are mapped to integers and every n-gram to a
+# 64 bit hash of its words, the n-gram counts of the hypotheses and references are sparse
+# matrices and the Bleu clipping, CIDEr document frequencies, tf-idf vectors and
+# similarities are computed on them; ROUGE_L uses a bit-parallel LCS. The images are
+# scored in shards over a pool of forked processes.
+#   final_scores, all_scores = score(refs, hypo, processes=8)
+# with refs {image_id: [reference, ...]} and hypo {image_id: [caption]} as for pycocoevalcap.
+
+METRICS = ['Bleu_1', 'Bleu_2', 'Bleu_3', 'Bleu_4', 'ROUGE_L', 'CIDEr']
+N = 4
+SIGMA = 6.0
+BETA = 1.2
+_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+_SHARED = {}
+
+
+def encode(sentences, vocab, sep=None):
+    # the words of sentences as integers of vocab (grown as needed), concatenated, and the sentence lengths
+    words = [sentence.split(sep) for sentence in sentences]
+    lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+    words = list(itertools.chain.from_iterable(words))
+    for word in dict.fromkeys(words):
+        if word not in vocab:
+            vocab[word] = len(vocab)
+    return np.fromiter(map(vocab.__getitem__, words), dtype=np.int64, count=len(words)), lengths
+
+
+def ngrams(ids, lengths, n_max=N):
+    # [(rows, hashes)] of the n-grams of order 1..n_max of the sentences encode() returned
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    remaining = lengths[rows] - (np.arange(len(ids)) - starts)
+    hashes = ids.astype(np.uint64) + np.uint64(1)
+    out = []
+    for n in range(1, n_max + 1):
+        if n > 1:
+            hashes = hashes[:-1] * _HASH_MULTIPLIER + (ids[n - 1:].astype(np.uint64) + np.uint64(1))
+        valid = remaining[:len(hashes)] >= n
+        out.append((rows[:len(hashes)][valid], hashes[valid]))
+    return out
+
+
+def document_frequency(ref_ngrams, ref_images):
+    # per order, the sorted hashes of the reference n-grams and the number of images having them
+    out = []
+    for rows, hashes in ref_ngrams:
+        # one occurrence of an n-gram per image
+        images = ref_images[rows]
+        order = np.lexsort((hashes, images))
+        hashes, images = hashes[order], images[order]
+        first = np.ones(len(hashes), dtype=bool)
+        first[1:] = (hashes[1:] != hashes[:-1]) | (images[1:] != images[:-1])
+        out.append(np.unique(hashes[first], return_counts=True))
+    return out
+
+
+def lcs(a, b):
+    # length of the longest common subsequence of the sequences a and b (Hyyro's bit-vector algorithm)
+    if not a or not b:
+        return 0
+    masks = {}
+    for i, word in enumerate(a):
+        masks[word] = masks.get(word, 0) | (1 << i)
+    full = (1 << len(a)) - 1
+    v = full
+    for word in b:
+        u = v & masks.get(word, 0)
+        v = ((v + u) | (v - u)) & full
+    return len(a) - bin(v).count('1')
+
+
+def _rows(matrix, indices):
+    return matrix[indices] if len(indices) else scipy.sparse.csr_matrix((0, matrix.shape[1]))
+
+
+def score_shard(bounds):
+    # Bleu statistics, ROUGE_L and CIDEr of the images start:end of _SHARED
+    start, end = bounds
+    data = _SHARED
+    ref_start, ref_end = data['ref_offsets'][start], data['ref_offsets'][end]
+    n_images, n_refs = end - start, ref_end - ref_start
+    ref_images = data['ref_images'][ref_start:ref_end] - start
+    hyp_lengths = data['hyp_lengths'][start:end]
+    ref_lengths = data['ref_lengths'][ref_start:ref_end]
+
+    guess = np.zeros((n_images, N))
+    correct = np.zeros((n_images, N))
+    cider = np.zeros(n_images)
+    penalty = np.exp(-((np.maximum(hyp_lengths[ref_images] - 1, 0) - np.maximum(ref_lengths - 1, 0)) ** 2) / (2 * SIGMA ** 2))
+    for n in range(N):
+        hyp_rows, hyp_hashes = data['hyp_ngrams'][n]
+        ref_rows, ref_hashes = data['ref_ngrams'][n]
+        hyp_sel = slice(*np.searchsorted(hyp_rows, [start, end]))
+        ref_sel = slice(*np.searchsorted(ref_rows, [ref_start, ref_end]))
+        hashes, columns = np.unique(np.concatenate([hyp_hashes[hyp_sel], ref_hashes[ref_sel]]), return_inverse=True)
+        columns = columns.reshape(-1)
+        n_hyp = hyp_sel.stop - hyp_sel.start
+        hyp = scipy.sparse.csr_matrix((np.ones(n_hyp), (hyp_rows[hyp_sel] - start, columns[:n_hyp])),
+                                      shape=(n_images, len(hashes)))
+        ref = scipy.sparse.csr_matrix((np.ones(len(columns) - n_hyp), (ref_rows[ref_sel] - ref_start, columns[n_hyp:])),
+                                      shape=(n_refs, len(hashes)))
+
+        # Bleu: hypothesis counts clipped by the max count in a reference of the image
+        coo = ref.tocoo()
+        keys, inverse = np.unique(ref_images[coo.row].astype(np.int64) * len(hashes) + coo.col, return_inverse=True)
+        max_counts = np.zeros(len(keys))
+        np.maximum.at(max_counts, inverse.reshape(-1), coo.data)
+        max_counts = scipy.sparse.csr_matrix((max_counts, (keys // len(hashes), keys % len(hashes))),
+                                             shape=(n_images, len(hashes)))
+        guess[:, n] = np.maximum(hyp_lengths - n, 0)
+        correct[:, n] = np.asarray(hyp.minimum(max_counts).sum(1)).reshape(-1)
+
+        # CIDEr: clipped cosine similarity of the tf-idf vectors of the hypothesis and each reference
+        df_hashes, df_counts = data['document_frequency'][n]
+        position = np.minimum(np.searchsorted(df_hashes, hashes), max(len(df_hashes) - 1, 0))
+        df = np.where(df_hashes[position] == hashes, df_counts[position], 0) if len(df_hashes) else np.zeros(len(hashes))
+        weights = scipy.sparse.diags(data['ref_len'] - np.log(np.maximum(1.0, df)))
+        hyp_vec = hyp.dot(weights).tocsr()
+        ref_vec = ref.dot(weights).tocsr()
+        hyp_norm = np.sqrt(np.asarray(hyp_vec.multiply(hyp_vec).sum(1)).reshape(-1))[ref_images]
+        ref_norm = np.sqrt(np.asarray(ref_vec.multiply(ref_vec).sum(1)).reshape(-1))
+        hyp_vec = _rows(hyp_vec, ref_images)
+        val = np.asarray(hyp_vec.minimum(ref_vec).multiply(ref_vec).sum(1)).reshape(-1)
+        nonzero = (hyp_norm != 0) & (ref_norm != 0)
+        val[nonzero] /= hyp_norm[nonzero] * ref_norm[nonzero]
+        np.add.at(cider, ref_images, val * penalty)
+    refs_per_image = np.diff(data['ref_offsets'][start:end + 1])
+    cider = cider / N / refs_per_image * 10.0
+
+    # ROUGE_L: F-measure of the best LCS precision and recall over the references
+    rouge = np.zeros(n_images)
+    hyps, refs = data['rouge_hyps'], data['rouge_refs']
+    for i in range(start, end):
+        hyp = hyps[i]
+        prec_max = rec_max = 0.0
+        for reference in refs[data['ref_offsets'][i]:data['ref_offsets'][i + 1]]:
+            common = lcs(hyp, reference)
+            prec_max = max(prec_max, common / float(len(hyp)))
+            rec_max = max(rec_max, common / float(len(reference)))
+        if prec_max != 0 and rec_max != 0:
+            rouge[i - start] = ((1 + BETA ** 2) * prec_max * rec_max) / float(rec_max + BETA ** 2 * prec_max)
+    return guess, correct, rouge, cider
+
+
+def _closest_reflen(hyp_lengths, ref_lengths, ref_offsets, ref_images):
+    # the reference length closest to the hypothesis length, the shorter one on ties (pycocoevalcap "closest")
+    keys = np.abs(ref_lengths - hyp_lengths[ref_images]) * (1 << 32) + ref_lengths
+    return np.minimum.reduceat(keys, ref_offsets[:-1]) % (1 << 32)
+
+
+def _bleu(guess, correct, testlen, reflen):
+    # BleuScorer.compute_score(option='closest') from the per image statistics
+    small, tiny = 1e-9, 1e-15
+    bleu_list = np.cumprod((correct + tiny) / (guess + small), axis=1) ** (1. / np.arange(1, N + 1))
+    ratio = (testlen + tiny) / (reflen + small)
+    bleu_list[ratio < 1] *= np.exp(1 - 1 / ratio[ratio < 1])[:, None]
+    bleus = np.cumprod((correct.sum(0) + tiny) / (guess.sum(0) + small)) ** (1. / np.arange(1, N + 1))
+    ratio = (testlen.sum() + tiny) / (reflen.sum() + small)
+    if ratio < 1:
+        bleus *= np.exp(1 - 1 / ratio)
+    return list(bleus), [list(_) for _ in bleu_list.T]
+
+
+def _encode_refs(refs, image_ids, vocab):
+    sentences = [ref for image_id in image_ids for ref in refs[image_id]]
+    offsets = np.concatenate([[0], np.cumsum([len(refs[image_id]) for image_id in image_ids])]).astype(np.int64)
+    ids, lengths = encode(sentences, vocab)
+    return sentences, offsets, np.repeat(np.arange(len(image_ids)), np.diff(offsets)), ids, lengths
+
+
+def statistics(refs, hypo, processes=1, shard_size=2000, image_ids=None):
+    # Per image Bleu statistics (testlen, reflen, guess, correct), ROUGE_L and CIDEr of image_ids
+    # (all images by default), in that order. The CIDEr document frequencies always come from the
+    # references of every image of refs, as when the whole corpus is scored.
+    assert refs.keys() == hypo.keys()
+    corpus = list(hypo.keys())
+    for image_id in corpus:
+        assert len(hypo[image_id]) == 1 and len(refs[image_id]) > 0
+    vocab = {}
+    ref_sentences, ref_offsets, ref_images, ref_ids, ref_lengths = _encode_refs(refs, corpus, vocab)
+    ref_ngrams = ngrams(ref_ids, ref_lengths)
+    df = document_frequency(ref_ngrams, ref_images)
+    if image_ids is None:
+        image_ids = corpus
+    elif list(image_ids) != corpus:
+        ref_sentences, ref_offsets, ref_images, ref_ids, ref_lengths = _encode_refs(refs, image_ids, vocab)
+        ref_ngrams = ngrams(ref_ids, ref_lengths)
+    hyp_sentences = [hypo[image_id][0] for image_id in image_ids]
+    hyp_ids, hyp_lengths = encode(hyp_sentences, vocab)
+
+    _SHARED.clear()
+    # ROUGE_L splits on single spaces
+    _SHARED.update(hyp_ngrams=ngrams(hyp_ids, hyp_lengths), ref_ngrams=ref_ngrams,
+                   hyp_lengths=hyp_lengths, ref_lengths=ref_lengths, ref_offsets=ref_offsets, ref_images=ref_images,
+                   document_frequency=df, ref_len=np.log(float(len(corpus))),
+                   rouge_hyps=[sentence.split(' ') for sentence in hyp_sentences],
+                   rouge_refs=[sentence.split(' ') for sentence in ref_sentences])
+    shards = [(start, min(start + shard_size, len(image_ids))) for start in range(0, len(image_ids), shard_size)]
+    processes = processes or os.cpu_count()
+    if processes > 1 and len(shards) > 1:
+        # forked workers see _SHARED without pickling it
+        with multiprocessing.get_context('fork').Pool(min(processes, len(shards))) as pool:
+            results = pool.map(score_shard, shards)
+    else:
+        results = [score_shard(shard) for shard in shards]
+    _SHARED.clear()
+    if not results:
+        results = [(np.zeros((0, N)), np.zeros((0, N)), np.zeros(0), np.zeros(0))]
+    guess, correct, rouge, cider = [np.concatenate(_) for _ in zip(*results)]
+
+    testlen = hyp_lengths.astype(np.float64)
+    reflen = _closest_reflen(hyp_lengths, ref_lengths, ref_offsets, ref_images).astype(np.float64) if len(image_ids) else np.zeros(0)
+    return testlen, reflen, guess, correct, rouge, cider
+
+
+def aggregate(testlen, reflen, guess, correct, rouge, cider):
+    # (final_scores, all_scores) of METRICS from the per image statistics
+    bleus, bleu_list = _bleu(guess, correct, testlen, reflen)
+    final_scores, all_scores = {}, {}
+    for k in range(N):
+        final_scores['Bleu_%d' % (k + 1)] = bleus[k]
+        all_scores['Bleu_%d' % (k + 1)] = bleu_list[k]
+    final_scores['ROUGE_L'], all_scores['ROUGE_L'] = np.mean(rouge), rouge
+    final_scores['CIDEr'], all_scores['CIDEr'] = np.mean(cider), cider
+    return final_scores, all_scores
+
+
+def score(refs, hypo, processes=1, shard_size=2000):
+    # (final_scores, all_scores) like insert.score for METRICS; processes=0 uses every cpu
+    return aggregate(*statistics(refs, hypo, processes, shard_size))
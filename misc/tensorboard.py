@@ -0,0 +1,127 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import glob
+import os
+import socket
+import struct
+import threading
+import time
+
+# Minimal tensorboard event file writer for the scalar summaries of train.py, so training
+# does not have to import tensorflow. An event file is a sequence of records
+#   uint64 length, uint32 masked crc32c(length), bytes data, uint32 masked crc32c(data)
+# where data is a serialized tensorflow.Event protobuf, encoded here by hand.
+
+
+def _crc32c_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+_CRC32C_TABLE = _crc32c_table()
+
+
+def crc32c(data):
+    crc = 0xFFFFFFFF
+    for byte in bytearray(data):
+        crc = _CRC32C_TABLE[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def masked_crc32c(data):
+    crc = crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _field(number, wire_type):
+    return _varint(number << 3 | wire_type)
+
+
+def _bytes_field(number, data):
+    return _field(number, 2) + _varint(len(data)) + data
+
+
+def encode_event(wall_time, step=None, file_version=None, tag=None, value=None):
+    # Event {double wall_time = 1; int64 step = 2; string file_version = 3; Summary summary = 5}
+    # Summary {repeated Value value = 1}, Value {string tag = 1; float simple_value = 2}
+    event = _field(1, 1) + struct.pack('<d', wall_time)
+    if step is not None:
+        event += _field(2, 0) + _varint(step & 0xFFFFFFFFFFFFFFFF)
+    if file_version is not None:
+        event += _bytes_field(3, file_version.encode('utf-8'))
+    if tag is not None:
+        summary_value = _bytes_field(1, tag.encode('utf-8')) + _field(2, 5) + struct.pack('<f', value)
+        event += _bytes_field(5, _bytes_field(1, summary_value))
+    return event
+
+
+def encode_record(data):
+    length = struct.pack('<Q', len(data))
+    return length + struct.pack('<I', masked_crc32c(length)) + data + struct.pack('<I', masked_crc32c(data))
+
+
+class SummaryWriter(object):
+    # add_scalar only encodes the record; a background thread appends the buffered
+    # records to the event file every flush_secs (and on flush/close). With purge, the
+    # event files of earlier runs in logdir are removed by that thread too.
+    def __init__(self, logdir, flush_secs=10, purge=False):
+        if not os.path.isdir(logdir):
+            os.makedirs(logdir)
+        self.path = os.path.join(logdir, 'events.out.tfevents.%010d.%s' % (time.time(), socket.gethostname()))
+        self.flush_secs = flush_secs
+        self.purge = purge
+        self.records = [encode_record(encode_event(time.time(), file_version='brain.Event:2'))]
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add_scalar(self, tag, value, step):
+        record = encode_record(encode_event(time.time(), step=int(step), tag=tag, value=float(value)))
+        with self.lock:
+            self.records.append(record)
+
+    def flush(self):
+        self.wake.set()
+
+    def close(self):
+        self.closed = True
+        self.wake.set()
+        self.thread.join()
+
+    def run(self):
+        if self.purge:
+            for path in glob.glob(os.path.join(os.path.dirname(self.path), 'events.out.tfevents.*')):
+                if path != self.path:
+                    os.remove(path)
+        with open(self.path, 'ab') as f:
+            while True:
+                self.wake.wait(self.flush_secs)
+                self.wake.clear()
+                with self.lock:
+                    records, self.records = self.records, []
+                if records:
+                    f.write(b''.join(records))
+                    f.flush()
+                if self.closed:
+                    return
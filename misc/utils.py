@@ -3,12 +3,19 @@ from __future__ import division
 from __future__ import print_function
 import numpy as np
 import collections
+import contextlib
+import copy
+import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from torch.autograd import Variable
 import misc.resnet as resnet
 import os
 import random
+from typing import Tuple
+from torch import Tensor
 
 ##################################################################################
 # Convolutional Blocks
@@ -97,7 +104,7 @@ class INSResBlock(nn.Module):
 def build_cnn(opt):
     net = getattr(resnet, opt.cnn_model)()
     if vars(opt).get('start_from', None) is None and vars(opt).get('cnn_weight', '') != '':
-        net.load_state_dict(torch.load(opt.cnn_weight))
+        net.load_state_dict(torch.load(opt.cnn_weight, map_location='cpu'))
     net = nn.Sequential(\
         net.conv1,
         net.bn1,
@@ -108,9 +115,108 @@ def build_cnn(opt):
         net.layer3,
         net.layer4)
     if vars(opt).get('start_from', None) is not None:
-        net.load_state_dict(torch.load(os.path.join(opt.start_from, 'model-cnn.pth')))
+        net.load_state_dict(torch.load(os.path.join(opt.start_from, 'model-cnn.pth'), map_location='cpu'))
     return net
 
+def fold_conv_bn(conv, bn):
+    # Conv2d that computes bn(conv(x)) with the running statistics of bn (eval mode only).
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride,
+                      conv.padding, conv.dilation, conv.groups, bias=True)
+    fused.weight.data.copy_(conv.weight.data * scale.data.view(-1, 1, 1, 1))
+    fused.bias.data.copy_((bias.data - bn.running_mean) * scale.data + bn.bias.data)
+    return fused.to(conv.weight.device)
+
+def _fold_bn(module):
+    # The resnet blocks register every BatchNorm2d right after the conv it normalizes
+    # (conv1/bn1, ..., downsample[0]/downsample[1]), so adjacent children can be folded.
+    children = list(module.named_children())
+    for (name, child), (next_name, next_child) in zip(children, children[1:]):
+        if isinstance(child, nn.Conv2d) and isinstance(next_child, nn.BatchNorm2d):
+            setattr(module, name, fold_conv_bn(child, next_child))
+            setattr(module, next_name, nn.Identity())
+    for name, child in module.named_children():
+        _fold_bn(child)
+    return module
+
+class _ChannelsLast(nn.Module):
+    def __init__(self, net):
+        super(_ChannelsLast, self).__init__()
+        self.net = net
+
+    def forward(self, x):
+        return self.net(x.contiguous(memory_format=torch.channels_last))
+
+def build_inference_cnn(cnn_model, trace=True):
+    # Frozen copy of the cnn for eval and for the epochs before finetune_cnn_after:
+    # BatchNorm folded into the convs, channels_last weights/activations and a traced graph.
+    # The output is in channels_last layout, which makes the .permute(0, 2, 3, 1) of the
+    # callers contiguous. cnn_model itself is left untouched so it can still be finetuned/saved.
+    device = next(cnn_model.parameters()).device
+    net = copy.deepcopy(cnn_model).eval()
+    net = _ChannelsLast(_fold_bn(net)).to(memory_format=torch.channels_last)
+    for p in net.parameters():
+        p.requires_grad = False
+    example = torch.randn(1, 3, 224, 224, device=device)
+    with torch.no_grad():
+        if trace:
+            net = torch.jit.trace(net, example, check_trace=False)
+        was_training = cnn_model.training
+        cnn_model.eval()
+        reference = cnn_model(example)
+        diff = ((net(example) - reference).abs().max() / reference.abs().max().clamp(min=1e-12)).item()
+        cnn_model.train(was_training)
+    print('inference cnn built, max relative diff to the original cnn: %.2e' % diff)
+    return net
+
+def _add_zero_rnn_bias(model):
+    # Dynamic quantized LSTM/GRU modules need a bias, while our cores are built with
+    # bias=False. Swap them for biased copies with zero biases, which compute the same thing.
+    for name, module in list(model.named_modules()):
+        if isinstance(module, (nn.LSTM, nn.GRU)) and not module.bias:
+            rnn = type(module)(module.input_size, module.hidden_size, module.num_layers,
+                               bias=True, dropout=module.dropout)
+            for weight_name in module._flat_weights_names:
+                getattr(rnn, weight_name).data.copy_(getattr(module, weight_name).data)
+            for bias_name in [n for n in rnn._flat_weights_names if n.startswith('bias')]:
+                getattr(rnn, bias_name).data.zero_()
+            parent = model
+            for part in name.split('.')[:-1]:
+                parent = getattr(parent, part)
+            setattr(parent, name.split('.')[-1], rnn)
+    return model
+
+def quantize_model(model):
+    # Dynamic int8 quantization of the decoder for CPU inference: the weights of every
+    # Linear/LSTM layer (logit, att_embed, ctx2att, the cores...) are stored as int8 and
+    # the activations are quantized on the fly. Only runs on the CPU.
+    assert not isinstance(getattr(model, 'core', None), torch.jit.ScriptModule), \
+        'int8 quantization needs the eager core, build the model without --script_core'
+    model = _add_zero_rnn_bias(model.cpu())
+    return torch.quantization.quantize_dynamic(model, {nn.Linear, nn.LSTM, nn.GRU, nn.LSTMCell, nn.GRUCell},
+                                               dtype=torch.qint8)
+
+def is_quantized_state_dict(state_dict):
+    return any('_packed' in k or '_all_weight_values' in k for k in state_dict.keys())
+
+def maxout(x, rnn_size):
+    # type: (Tensor, int) -> Tensor
+    return torch.max(x.narrow(1, 0, rnn_size), x.narrow(1, rnn_size, rnn_size))
+
+def lstm_gates(all_input_sums, in_transform, prev_c, rnn_size):
+    # type: (Tensor, Tensor, Tensor, int) -> Tuple[Tensor, Tensor, Tensor]
+    # LSTM update of the hand-written cores: the in/forget/out gates are the first
+    # 3 * rnn_size columns of all_input_sums. It is all pointwise, so a core compiled with
+    # --script_core runs it as a single fused kernel per timestep instead of one per op.
+    sigmoid_chunk = torch.sigmoid(all_input_sums.narrow(1, 0, 3 * rnn_size))
+    in_gate = sigmoid_chunk.narrow(1, 0, rnn_size)
+    forget_gate = sigmoid_chunk.narrow(1, rnn_size, rnn_size)
+    out_gate = sigmoid_chunk.narrow(1, rnn_size * 2, rnn_size)
+    next_c = forget_gate * prev_c + in_gate * in_transform
+    tanh_next_c = torch.tanh(next_c)
+    return out_gate * tanh_next_c, next_c, tanh_next_c
+
 def prepro_images(imgs, data_augment=False):
     # crop the image
     h,w = imgs.shape[2], imgs.shape[3]
@@ -173,6 +279,128 @@ class LanguageModelCriterion(nn.Module):
 
         return output
 
+class FusedLanguageModelCriterion(nn.Module):
+    # LanguageModelCriterion computed from the inputs of the logit layer (model.return_hidden):
+    # logit, log_softmax and the masked nll run chunk_size time steps at a time under
+    # checkpointing, so the B x T x (vocab+1) log-probs are never stored for backward.
+    def __init__(self, logit, chunk_size=4):
+        super(FusedLanguageModelCriterion, self).__init__()
+        self.logit = logit
+        self.chunk_size = chunk_size
+
+    def chunk_nll(self, input, target, mask):
+        logprobs = F.log_softmax(self.logit(input), dim=2)
+        return - torch.sum(logprobs.gather(2, target.unsqueeze(2)).squeeze(2) * mask)
+
+    def forward(self, input, target, mask):
+        # truncate to the same size
+        target = target[:, :input.size(1)]
+        mask = mask[:, :input.size(1)]
+        output = 0
+        for t in range(0, input.size(1), self.chunk_size):
+            chunk = slice(t, t + self.chunk_size)
+            if torch.is_grad_enabled():
+                output = output + checkpoint(self.chunk_nll, input[:, chunk], target[:, chunk], mask[:, chunk],
+                                             use_reentrant=False)
+            else:
+                output = output + self.chunk_nll(input[:, chunk], target[:, chunk], mask[:, chunk])
+        output = output / torch.sum(mask)
+
+        return output
+
+class AdaptiveLogit(nn.Module):
+    # Drop-in replacement of the models' dense logit layer by an adaptive softmax
+    # (Grave et al. 2017). The vocabulary is ranked by training frequency (<eos> first):
+    # the cutoffs[0] most frequent words form the head, rarer words share tail clusters
+    # whose projection is div_value times smaller per cluster.
+    # Calling it returns log-probs over the whole vocabulary in the original index order,
+    # so log_softmax on top is a no-op and sample/beam search work unchanged.
+    # While decoding greedily or with a beam (adaptive_decoding) only the top exact_topk
+    # words of every row have to be exact: a tail cluster is only computed for the rows
+    # where its log-prob, a bound of the ones of its words, beats their exact_topk-th best
+    # head word. Elsewhere its mass is spread evenly over its words, which keeps the rows
+    # normalized and those words below the top.
+    def __init__(self, in_features, n_classes, cutoffs, word_counts=None, div_value=4.0):
+        super(AdaptiveLogit, self).__init__()
+        counts = np.zeros(n_classes)
+        if word_counts is not None:
+            for ix, count in word_counts.items():
+                counts[int(ix)] = count
+        counts[0] = np.inf
+        order = np.argsort(-counts, kind='stable')
+        rank = np.empty(n_classes, dtype=np.int64)
+        rank[order] = np.arange(n_classes)
+        # rank[ix] is the adaptive softmax class of vocabulary index ix
+        self.register_buffer('rank', torch.from_numpy(rank))
+        self.asm = nn.AdaptiveLogSoftmaxWithLoss(in_features, n_classes, cutoffs, div_value=div_value)
+        # 0 = every cluster of every row, the full distribution sampling and training need
+        self.exact_topk = 0
+
+    def forward(self, input):
+        flat = input.reshape(-1, input.size(-1))
+        if self.exact_topk:
+            logprobs = self.topk_log_prob(flat, self.exact_topk)
+        else:
+            logprobs = self.asm.log_prob(flat)
+        return logprobs.index_select(1, self.rank).view(input.shape[:-1] + (-1,))
+
+    def topk_log_prob(self, input, k):
+        # asm.log_prob with only the top k words of every row exact (in class order)
+        asm = self.asm
+        shortlist = asm.shortlist_size
+        head_logprob = F.log_softmax(asm.head(input), dim=1)
+        out = head_logprob.new_empty((input.size(0), asm.n_classes))
+        out[:, :shortlist] = head_logprob[:, :shortlist]
+        kth = head_logprob[:, :shortlist].topk(min(k, shortlist), dim=1)[0][:, -1]
+        for i, (start, stop) in enumerate(zip(asm.cutoffs, asm.cutoffs[1:])):
+            cluster_logprob = head_logprob[:, shortlist + i]
+            out[:, start:stop] = (cluster_logprob - math.log(stop - start)).unsqueeze(1)
+            rows = (cluster_logprob > kth).nonzero().squeeze(1)
+            if rows.numel():
+                tail_logprob = F.log_softmax(asm.tail[i](input[rows]), dim=1)
+                out[rows, start:stop] = tail_logprob + cluster_logprob[rows].unsqueeze(1)
+        return out
+
+    def target_logprob(self, input, target):
+        # log-probs of the targets only, the tail clusters run just for the rows that need them
+        return self.asm(input, self.rank[target]).output
+
+@contextlib.contextmanager
+def adaptive_decoding(model, opt):
+    # model.sample with opt (sample_max, beam_size) in the block: an AdaptiveLogit head only
+    # computes the tail clusters greedy or beam search can pick from, sampling needs them all
+    logit = getattr(model, 'logit', None)
+    if not isinstance(logit, AdaptiveLogit):
+        yield
+        return
+    beam_size = opt.get('beam_size', 1)
+    previous = logit.exact_topk
+    logit.exact_topk = beam_size if beam_size > 1 or opt.get('sample_max', 1) else 0
+    try:
+        yield
+    finally:
+        logit.exact_topk = previous
+
+class AdaptiveLanguageModelCriterion(nn.Module):
+    # LanguageModelCriterion for an AdaptiveLogit head, computed from the inputs of the logit
+    # layer (model.return_hidden) without ever forming the full log-probs
+    def __init__(self, logit):
+        super(AdaptiveLanguageModelCriterion, self).__init__()
+        self.logit = logit
+
+    def forward(self, input, target, mask):
+        # truncate to the same size
+        target = target[:, :input.size(1)]
+        mask = mask[:, :input.size(1)]
+        input = to_contiguous(input).view(-1, input.size(2))
+        target = to_contiguous(target).view(-1)
+        mask = to_contiguous(mask).view(-1)
+        keep = mask > 0
+        output = - self.logit.target_logprob(input[keep], target[keep]) * mask[keep]
+        output = torch.sum(output) / torch.sum(mask)
+
+        return output
+
 def set_lr(optimizer, lr):
     for group in optimizer.param_groups:
         group['lr'] = lr
@@ -39,6 +39,7 @@ class Att2inCore(nn.Module):
         self.alpha_net = nn.Linear(self.att_hid_size, 1)
 
     def forward(self, xt, fc_feats, att_feats, p_att_feats, state):
+        # type: (Tensor, Tensor, Tensor, Tensor, Tuple[Tensor, Tensor]) -> Tuple[Tensor, Tuple[Tensor, Tensor]]
         # The p_att_feats here is already projected
         att_size = att_feats.numel() // att_feats.size(0) // self.att_feat_size
         att = p_att_feats.view(-1, att_size, self.att_hid_size)
@@ -51,24 +52,15 @@ class Att2inCore(nn.Module):
         dot = self.alpha_net(dot)                           # (batch * att_size) * 1
         dot = dot.view(-1, att_size)                        # batch * att_size
         
-        weight = F.softmax(dot)                             # batch * att_size
+        weight = F.softmax(dot, dim=1)                      # batch * att_size
         att_feats_ = att_feats.view(-1, att_size, self.att_feat_size) # batch * att_size * att_feat_size
         att_res = torch.bmm(weight.unsqueeze(1), att_feats_).squeeze(1) # batch * att_feat_size
 
         all_input_sums = self.i2h(xt) + self.h2h(state[0][-1])
-        sigmoid_chunk = all_input_sums.narrow(1, 0, 3 * self.rnn_size)
-        sigmoid_chunk = F.sigmoid(sigmoid_chunk)
-        in_gate = sigmoid_chunk.narrow(1, 0, self.rnn_size)
-        forget_gate = sigmoid_chunk.narrow(1, self.rnn_size, self.rnn_size)
-        out_gate = sigmoid_chunk.narrow(1, self.rnn_size * 2, self.rnn_size)
-
         in_transform = all_input_sums.narrow(1, 3 * self.rnn_size, 2 * self.rnn_size) + \
             self.a2c(att_res)
-        in_transform = torch.max(\
-            in_transform.narrow(1, 0, self.rnn_size),
-            in_transform.narrow(1, self.rnn_size, self.rnn_size))
-        next_c = forget_gate * state[1][-1] + in_gate * in_transform
-        next_h = out_gate * F.tanh(next_c)
+        in_transform = utils.maxout(in_transform, self.rnn_size)
+        next_h, next_c, _ = utils.lstm_gates(all_input_sums, in_transform, state[1][-1], self.rnn_size)
 
         output = self.dropout(next_h)
         state = (next_h.unsqueeze(0), next_c.unsqueeze(0))
@@ -112,39 +104,36 @@ class Att2inModel(CaptionModel):
         batch_size = fc_feats.size(0)
         state = self.init_hidden(batch_size)
 
-        outputs = []
-
         # Project the attention feats first to reduce memory and computation comsumptions.
         p_att_feats = self.ctx2att(att_feats.view(-1, self.att_feat_size))
         p_att_feats = p_att_feats.view(*(att_feats.size()[:-1] + (self.att_hid_size,)))
 
-        for i in range(seq.size(1) - 1):
+        if self.teacher_forced():
+            # embed all the words at once, only step the core and project all outputs together
+            n = self.input_steps(seq)
+            xt = self.embed(seq[:, :n])
+            outputs = fc_feats.new_empty(batch_size, n, self.rnn_size)
+            for i in range(n):
+                output, state = self.core(xt[:, i], fc_feats, att_feats, p_att_feats, state)
+                outputs[:, i] = output
+            if self.return_hidden:
+                return outputs
+            return F.log_softmax(self.logit(outputs), dim=2)
+
+        outputs, hiddens = [], []
+        # stop where all the sequences end, found once instead of checking every step
+        for i in range(self.input_steps(seq)):
             if self.training and i >= 1 and self.ss_prob > 0.0: # otherwiste no need to sample
-                sample_prob = fc_feats.data.new(batch_size).uniform_(0, 1)
-                sample_mask = sample_prob < self.ss_prob
-                if sample_mask.sum() == 0:
-                    it = seq[:, i].clone()
-                else:
-                    sample_ind = sample_mask.nonzero().view(-1)
-                    it = seq[:, i].data.clone()
-                    #prob_prev = torch.exp(outputs[-1].data.index_select(0, sample_ind)) # fetch prev distribution: shape Nx(M+1)
-                    #it.index_copy_(0, sample_ind, torch.multinomial(prob_prev, 1).view(-1))
-                    prob_prev = torch.exp(outputs[-1].data) # fetch prev distribution: shape Nx(M+1)
-                    it.index_copy_(0, sample_ind, torch.multinomial(prob_prev, 1).view(-1).index_select(0, sample_ind))
-                    it = Variable(it, requires_grad=False)
+                it = self.scheduled_sample(seq[:, i], outputs[-1])
             else:
-                it = seq[:, i].clone()          
-            # break if all the sequences end
-            if i >= 1 and seq[:, i].data.sum() == 0:
-                break
+                it = seq[:, i].clone()
 
             xt = self.embed(it)
 
             output, state = self.core(xt, fc_feats, att_feats, p_att_feats, state)
-            output = F.log_softmax(self.logit(output))
-            outputs.append(output)
+            self.append_step(outputs, hiddens, output)
 
-        return torch.cat([_.unsqueeze(1) for _ in outputs], 1)
+        return self.stack_steps(outputs, hiddens)
 
     def get_logprobs_state(self, it, tmp_fc_feats, tmp_att_feats, tmp_p_att_feats, state):
         # 'it' is Variable contraining a word index
@@ -217,7 +206,7 @@ class Att2inModel(CaptionModel):
                 else:
                     # scale logprobs by temperature
                     prob_prev = torch.exp(torch.div(logprobs.data, temperature)).cpu()
-                it = torch.multinomial(prob_prev, 1).cuda()
+                it = torch.multinomial(prob_prev, 1).to(logprobs.device)
                 sampleLogprobs = logprobs.gather(1, Variable(it, requires_grad=False)) # gather the logprobs at sampled positions
                 it = it.view(-1).long() # and flatten indices for downstream processing
 
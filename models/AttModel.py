@@ -67,8 +67,6 @@ class AttModel(CaptionModel):
         batch_size = fc_feats.size(0)
         state = self.init_hidden(batch_size)
 
-        outputs = []
-
         # embed fc and att feats
         fc_feats = self.fc_embed(fc_feats)
         _att_feats = self.att_embed(att_feats.view(-1, self.att_feat_size))
@@ -78,33 +76,32 @@ class AttModel(CaptionModel):
         p_att_feats = self.ctx2att(att_feats.view(-1, self.rnn_size))
         p_att_feats = p_att_feats.view(*(att_feats.size()[:-1] + (self.att_hid_size,)))
 
-        for i in range(seq.size(1) - 1):
+        if self.teacher_forced():
+            # embed all the words at once, only step the core and project all outputs together
+            n = self.input_steps(seq)
+            xt = self.embed(seq[:, :n])
+            outputs = fc_feats.new_empty(batch_size, n, self.rnn_size)
+            for i in range(n):
+                output, state = self.core(xt[:, i], fc_feats, att_feats, p_att_feats, state)
+                outputs[:, i] = output
+            if self.return_hidden:
+                return outputs
+            return F.log_softmax(self.logit(outputs), dim=2)
+
+        outputs, hiddens = [], []
+        # stop where all the sequences end, found once instead of checking every step
+        for i in range(self.input_steps(seq)):
             if self.training and i >= 1 and self.ss_prob > 0.0: # otherwiste no need to sample
-                sample_prob = fc_feats.data.new(batch_size).uniform_(0, 1)
-                sample_mask = sample_prob < self.ss_prob
-                if sample_mask.sum() == 0:
-                    it = seq[:, i].clone()
-                else:
-                    sample_ind = sample_mask.nonzero().view(-1)
-                    it = seq[:, i].data.clone()
-                    #prob_prev = torch.exp(outputs[-1].data.index_select(0, sample_ind)) # fetch prev distribution: shape Nx(M+1)
-                    #it.index_copy_(0, sample_ind, torch.multinomial(prob_prev, 1).view(-1))
-                    prob_prev = torch.exp(outputs[-1].data) # fetch prev distribution: shape Nx(M+1)
-                    it.index_copy_(0, sample_ind, torch.multinomial(prob_prev, 1).view(-1).index_select(0, sample_ind))
-                    it = Variable(it, requires_grad=False)
+                it = self.scheduled_sample(seq[:, i], outputs[-1])
             else:
-                it = seq[:, i].clone()          
-            # break if all the sequences end
-            if i >= 1 and seq[:, i].data.sum() == 0:
-                break
+                it = seq[:, i].clone()
 
             xt = self.embed(it)
 
             output, state = self.core(xt, fc_feats, att_feats, p_att_feats, state)
-            output = F.log_softmax(self.logit(output))
-            outputs.append(output)
+            self.append_step(outputs, hiddens, output)
 
-        return torch.cat([_.unsqueeze(1) for _ in outputs], 1)
+        return self.stack_steps(outputs, hiddens)
 
     def get_logprobs_state(self, it, tmp_fc_feats, tmp_att_feats, tmp_p_att_feats, state):
         # 'it' is Variable contraining a word index
@@ -187,7 +184,7 @@ class AttModel(CaptionModel):
                 else:
                     # scale logprobs by temperature
                     prob_prev = torch.exp(torch.div(logprobs.data, temperature)).cpu()
-                it = torch.multinomial(prob_prev, 1).cuda()
+                it = torch.multinomial(prob_prev, 1).to(logprobs.device)
                 sampleLogprobs = logprobs.gather(1, Variable(it, requires_grad=False)) # gather the logprobs at sampled positions
                 it = it.view(-1).long() # and flatten indices for downstream processing
 
@@ -241,11 +238,23 @@ class AdaAtt_lstm(nn.Module):
         self.r_h2h = nn.Linear(self.rnn_size, self.rnn_size)
 
 
-    def forward(self, xt, img_fc, state):
+    def _layer_i2h(self, L, x):
+        # type: (int, Tensor) -> Tensor
+        # self.i2h[L](x); ModuleLists can only be indexed by literals in TorchScript
+        i2h = x
+        for ix, layer in enumerate(self.i2h):
+            if ix == L:
+                i2h = layer(x)
+        return i2h
 
+    def forward(self, xt, img_fc, state):
+        # type: (Tensor, Tensor, Tuple[Tensor, Tensor]) -> Tuple[Tensor, Tensor, Tuple[Tensor, Tensor]]
         hs = []
         cs = []
-        for L in range(self.num_layers):
+        x = xt
+        prev_h = state[0][0]
+        tanh_nex_c = state[1][0]
+        for L, h2h in enumerate(self.h2h):
             # c,h from previous timesteps
             prev_h = state[0][L]
             prev_c = state[1][L]
@@ -256,40 +265,29 @@ class AdaAtt_lstm(nn.Module):
             else:
                 x = hs[-1]
                 x = F.dropout(x, self.drop_prob_lm, self.training)
-                i2h = self.i2h[L-1](x)
+                i2h = self._layer_i2h(L-1, x)
 
-            all_input_sums = i2h+self.h2h[L](prev_h)
+            all_input_sums = i2h+h2h(prev_h)
 
-            sigmoid_chunk = all_input_sums.narrow(1, 0, 3 * self.rnn_size)
-            sigmoid_chunk = F.sigmoid(sigmoid_chunk)
-            # decode the gates
-            in_gate = sigmoid_chunk.narrow(1, 0, self.rnn_size)
-            forget_gate = sigmoid_chunk.narrow(1, self.rnn_size, self.rnn_size)
-            out_gate = sigmoid_chunk.narrow(1, self.rnn_size * 2, self.rnn_size)
             # decode the write inputs
             if not self.use_maxout:
-                in_transform = F.tanh(all_input_sums.narrow(1, 3 * self.rnn_size, self.rnn_size))
+                in_transform = torch.tanh(all_input_sums.narrow(1, 3 * self.rnn_size, self.rnn_size))
             else:
-                in_transform = all_input_sums.narrow(1, 3 * self.rnn_size, 2 * self.rnn_size)
-                in_transform = torch.max(\
-                    in_transform.narrow(1, 0, self.rnn_size),
-                    in_transform.narrow(1, self.rnn_size, self.rnn_size))
-            # perform the LSTM update
-            next_c = forget_gate * prev_c + in_gate * in_transform
-            # gated cells form the output
-            tanh_nex_c = F.tanh(next_c)
-            next_h = out_gate * tanh_nex_c
-            if L == self.num_layers-1:
-                if L == 0:
-                    i2h = self.r_w2h(x) + self.r_v2h(img_fc)
-                else:
-                    i2h = self.r_i2h(x)
-                n5 = i2h+self.r_h2h(prev_h)
-                fake_region = F.sigmoid(n5) * tanh_nex_c
+                in_transform = utils.maxout(all_input_sums.narrow(1, 3 * self.rnn_size, 2 * self.rnn_size), self.rnn_size)
+            # perform the LSTM update, gated cells form the output
+            next_h, next_c, tanh_nex_c = utils.lstm_gates(all_input_sums, in_transform, prev_c, self.rnn_size)
 
             cs.append(next_c)
             hs.append(next_h)
 
+        # fake region from the input, previous h and new cell of the last layer
+        if hasattr(self, 'r_w2h'):
+            i2h = self.r_w2h(x) + self.r_v2h(img_fc)
+        else:
+            i2h = self.r_i2h(x)
+        n5 = i2h+self.r_h2h(prev_h)
+        fake_region = torch.sigmoid(n5) * tanh_nex_c
+
         # set up the decoder
         top_h = hs[-1]
         top_h = F.dropout(top_h, self.drop_prob_lm, self.training)
@@ -326,6 +324,7 @@ class AdaAtt_attention(nn.Module):
         self.att2h = nn.Linear(self.rnn_size, self.rnn_size)
 
     def forward(self, h_out, fake_region, conv_feat, conv_feat_embed):
+        # type: (Tensor, Tensor, Tensor, Tensor) -> Tensor
 
         # View into three dimensions
         att_size = conv_feat.numel() // conv_feat.size(0) // self.rnn_size
@@ -348,7 +347,7 @@ class AdaAtt_attention(nn.Module):
         hA = F.dropout(hA,self.drop_prob_lm, self.training)
         
         hAflat = self.alpha_net(hA.view(-1, self.att_hid_size))
-        PI = F.softmax(hAflat.view(-1, att_size + 1))
+        PI = F.softmax(hAflat.view(-1, att_size + 1), dim=1)
 
         visAtt = torch.bmm(PI.unsqueeze(1), img_all)
         visAttdim = visAtt.squeeze(1)
@@ -366,6 +365,7 @@ class AdaAttCore(nn.Module):
         self.attention = AdaAtt_attention(opt)
 
     def forward(self, xt, fc_feats, att_feats, p_att_feats, state):
+        # type: (Tensor, Tensor, Tensor, Tensor, Tuple[Tensor, Tensor]) -> Tuple[Tensor, Tuple[Tensor, Tensor]]
         h_out, p_out, state = self.lstm(xt, fc_feats, state)
         atten_out = self.attention(h_out, p_out, att_feats, p_att_feats)
         return atten_out, state
@@ -380,6 +380,7 @@ class TopDownCore(nn.Module):
         self.attention = Attention(opt)
 
     def forward(self, xt, fc_feats, att_feats, p_att_feats, state):
+        # type: (Tensor, Tensor, Tensor, Tensor, Tuple[Tensor, Tensor]) -> Tuple[Tensor, Tuple[Tensor, Tensor]]
         prev_h = state[0][-1]
         att_lstm_input = torch.cat([prev_h, fc_feats, xt], 1)
 
@@ -407,6 +408,7 @@ class Attention(nn.Module):
         self.alpha_net = nn.Linear(self.att_hid_size, 1)
 
     def forward(self, h, att_feats, p_att_feats):
+        # type: (Tensor, Tensor, Tensor) -> Tensor
         # The p_att_feats here is already projected
         att_size = att_feats.numel() // att_feats.size(0) // self.rnn_size
         att = p_att_feats.view(-1, att_size, self.att_hid_size)
@@ -419,7 +421,7 @@ class Attention(nn.Module):
         dot = self.alpha_net(dot)                           # (batch * att_size) * 1
         dot = dot.view(-1, att_size)                        # batch * att_size
         
-        weight = F.softmax(dot)                             # batch * att_size
+        weight = F.softmax(dot, dim=1)                      # batch * att_size
         att_feats_ = att_feats.view(-1, att_size, self.rnn_size) # batch * att_size * att_feat_size
         att_res = torch.bmm(weight.unsqueeze(1), att_feats_).squeeze(1) # batch * att_feat_size
 
@@ -447,22 +449,14 @@ class Att2in2Core(nn.Module):
         self.attention = Attention(opt)
 
     def forward(self, xt, fc_feats, att_feats, p_att_feats, state):
+        # type: (Tensor, Tensor, Tensor, Tensor, Tuple[Tensor, Tensor]) -> Tuple[Tensor, Tuple[Tensor, Tensor]]
         att_res = self.attention(state[0][-1], att_feats, p_att_feats)
 
         all_input_sums = self.i2h(xt) + self.h2h(state[0][-1])
-        sigmoid_chunk = all_input_sums.narrow(1, 0, 3 * self.rnn_size)
-        sigmoid_chunk = F.sigmoid(sigmoid_chunk)
-        in_gate = sigmoid_chunk.narrow(1, 0, self.rnn_size)
-        forget_gate = sigmoid_chunk.narrow(1, self.rnn_size, self.rnn_size)
-        out_gate = sigmoid_chunk.narrow(1, self.rnn_size * 2, self.rnn_size)
-
         in_transform = all_input_sums.narrow(1, 3 * self.rnn_size, 2 * self.rnn_size) + \
             self.a2c(att_res)
-        in_transform = torch.max(\
-            in_transform.narrow(1, 0, self.rnn_size),
-            in_transform.narrow(1, self.rnn_size, self.rnn_size))
-        next_c = forget_gate * state[1][-1] + in_gate * in_transform
-        next_h = out_gate * F.tanh(next_c)
+        in_transform = utils.maxout(in_transform, self.rnn_size)
+        next_h, next_c, _ = utils.lstm_gates(all_input_sums, in_transform, state[1][-1], self.rnn_size)
 
         output = self.dropout(next_h)
         state = (next_h.unsqueeze(0), next_c.unsqueeze(0))
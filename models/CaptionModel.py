@@ -19,6 +19,43 @@ import misc.utils as utils
 class CaptionModel(nn.Module):
     def __init__(self):
         super(CaptionModel, self).__init__()
+        # forward returns the inputs of self.logit instead of log-probs, for utils.FusedLanguageModelCriterion
+        self.return_hidden = False
+
+    def teacher_forced(self):
+        # no scheduled sampling: every input word is known in advance
+        return not (self.training and self.ss_prob > 0.0)
+
+    def append_step(self, outputs, hiddens, hidden):
+        # Per-step bookkeeping of the scheduled sampling loops. With return_hidden only the latest
+        # log-probs are kept (to sample the next word), the loss is computed from the hiddens.
+        if self.return_hidden:
+            hiddens.append(hidden)
+            with torch.no_grad():
+                outputs[:] = [F.log_softmax(self.logit(hidden), dim=1)]
+        else:
+            outputs.append(F.log_softmax(self.logit(hidden), dim=1))
+
+    def stack_steps(self, outputs, hiddens, start=0):
+        if self.return_hidden:
+            return torch.stack(hiddens[start:], 1)
+        return torch.cat([_.unsqueeze(1) for _ in outputs[start:]], 1).contiguous()
+
+    def input_steps(self, seq):
+        # Number of words fed to the core: up to the first all-zero column after <bos>,
+        # found with a single sync per batch.
+        empty = (seq.data[:, 1:-1] == 0).all(0).nonzero()
+        if empty.numel() > 0:
+            return int(empty[0]) + 1
+        return seq.size(1) - 1
+
+    def scheduled_sample(self, it, logprobs):
+        # Scheduled sampling without host syncs: with probability ss_prob an input word is replaced
+        # by one drawn from the previous log-probs. The draw is an exponential race (argmax of
+        # p / Exp(1), the Gumbel-max trick), so it needs no multinomial and the blend is a torch.where.
+        sample_mask = torch.rand(it.size(0), device=it.device) < self.ss_prob
+        race = logprobs.data - torch.empty_like(logprobs.data).exponential_().log()
+        return torch.where(sample_mask, race.argmax(1), it)
 
     def beam_search(self, state, logprobs, *args, **kwargs):
         # args are the miscelleous inputs to the core in addition to embedded word and state
@@ -71,7 +108,7 @@ class CaptionModel(nn.Module):
                 beam_seq[t, vix] = v['c'] # c'th word is the continuation
                 beam_seq_logprobs[t, vix] = v['r'] # the raw logprob here
                 beam_logprobs_sum[vix] = v['p'] # the new (sum) logprob along this beam
-            state = new_state
+            state = tuple(new_state)
             return beam_seq, beam_seq_logprobs, beam_logprobs_sum, state, candidates
 
         # start beam search
@@ -116,7 +153,7 @@ class CaptionModel(nn.Module):
 
             # encode as vectors
             it = beam_seq[t]
-            logprobs, state = self.get_logprobs_state(Variable(it.cuda()), *(args + (state,)))
+            logprobs, state = self.get_logprobs_state(Variable(it.to(logprobs.device)), *(args + (state,)))
 
         done_beams = sorted(done_beams, key=lambda x: -x['p'])[:beam_size]
         return done_beams
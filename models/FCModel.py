@@ -23,19 +23,16 @@ class LSTMCore(nn.Module):
         self.dropout = nn.Dropout(self.drop_prob_lm)
 
     def forward(self, xt, state):
-        
-        all_input_sums = self.i2h(xt) + self.h2h(state[0][-1])
-        sigmoid_chunk = all_input_sums.narrow(1, 0, 3 * self.rnn_size)
-        sigmoid_chunk = F.sigmoid(sigmoid_chunk)
-        in_gate = sigmoid_chunk.narrow(1, 0, self.rnn_size)
-        forget_gate = sigmoid_chunk.narrow(1, self.rnn_size, self.rnn_size)
-        out_gate = sigmoid_chunk.narrow(1, self.rnn_size * 2, self.rnn_size)
-
-        in_transform = torch.max(\
-            all_input_sums.narrow(1, 3 * self.rnn_size, self.rnn_size),
-            all_input_sums.narrow(1, 4 * self.rnn_size, self.rnn_size))
-        next_c = forget_gate * state[1][-1] + in_gate * in_transform
-        next_h = out_gate * F.tanh(next_c)
+        # type: (Tensor, Tuple[Tensor, Tensor]) -> Tuple[Tensor, Tuple[Tensor, Tensor]]
+        return self.step(self.i2h(xt), state)
+
+    @torch.jit.export
+    def step(self, i2h, state):
+        # type: (Tensor, Tuple[Tensor, Tensor]) -> Tuple[Tensor, Tuple[Tensor, Tensor]]
+        # the recurrent part of forward, i2h = self.i2h(xt) can be computed for all steps at once
+        all_input_sums = i2h + self.h2h(state[0][-1])
+        in_transform = utils.maxout(all_input_sums.narrow(1, 3 * self.rnn_size, 2 * self.rnn_size), self.rnn_size)
+        next_h, next_c, _ = utils.lstm_gates(all_input_sums, in_transform, state[1][-1], self.rnn_size)
 
         next_h = self.dropout(next_h)
 
@@ -81,37 +78,38 @@ class FCModel(CaptionModel):
     def forward(self, fc_feats, att_feats, seq):
         batch_size = fc_feats.size(0)
         state = self.init_hidden(batch_size)
-        outputs = []
 
-        for i in range(seq.size(1)):
+        if self.teacher_forced():
+            # The core is not an nn.LSTM, so project the image and all the words through i2h
+            # at once and only loop over the recurrence.
+            n = self.input_steps(seq)
+            xt = torch.cat([self.img_embed(fc_feats).unsqueeze(1), self.embed(seq[:, :n])], 1)
+            i2h = self.core.i2h(xt)
+            outputs = fc_feats.new_empty(batch_size, n, self.rnn_size)
+            for i in range(n + 1):
+                output, state = self.core.step(i2h[:, i], state)
+                if i > 0:
+                    outputs[:, i - 1] = output
+            if self.return_hidden:
+                return outputs
+            return F.log_softmax(self.logit(outputs), dim=2)
+
+        outputs, hiddens = [], []
+        # stop where all the sequences end, found once instead of checking every step
+        for i in range(self.input_steps(seq) + 1):
             if i == 0:
                 xt = self.img_embed(fc_feats)
             else:
                 if self.training and i >= 2 and self.ss_prob > 0.0: # otherwiste no need to sample
-                    sample_prob = fc_feats.data.new(batch_size).uniform_(0, 1)
-                    sample_mask = sample_prob < self.ss_prob
-                    if sample_mask.sum() == 0:
-                        it = seq[:, i-1].clone()
-                    else:
-                        sample_ind = sample_mask.nonzero().view(-1)
-                        it = seq[:, i-1].data.clone()
-                        #prob_prev = torch.exp(outputs[-1].data.index_select(0, sample_ind)) # fetch prev distribution: shape Nx(M+1)
-                        #it.index_copy_(0, sample_ind, torch.multinomial(prob_prev, 1).view(-1))
-                        prob_prev = torch.exp(outputs[-1].data) # fetch prev distribution: shape Nx(M+1)
-                        it.index_copy_(0, sample_ind, torch.multinomial(prob_prev, 1).view(-1).index_select(0, sample_ind))
-                        it = Variable(it, requires_grad=False)
+                    it = self.scheduled_sample(seq[:, i-1], outputs[-1])
                 else:
                     it = seq[:, i-1].clone()
-                # break if all the sequences end
-                if i >= 2 and seq[:, i-1].data.sum() == 0:
-                    break
                 xt = self.embed(it)
 
             output, state = self.core(xt, state)
-            output = F.log_softmax(self.logit(output))
-            outputs.append(output)
+            self.append_step(outputs, hiddens, output)
 
-        return torch.cat([_.unsqueeze(1) for _ in outputs[1:]], 1).contiguous()
+        return self.stack_steps(outputs, hiddens, 1)
 
     def get_logprobs_state(self, it, state):
         # 'it' is Variable contraining a word index
@@ -176,7 +174,7 @@ class FCModel(CaptionModel):
                     else:
                         # scale logprobs by temperature
                         prob_prev = torch.exp(torch.div(logprobs.data, temperature)).cpu()
-                    it = torch.multinomial(prob_prev, 1).cuda()
+                    it = torch.multinomial(prob_prev, 1).to(logprobs.device)
                     sampleLogprobs = logprobs.gather(1, Variable(it, requires_grad=False)) # gather the logprobs at sampled positions
                     it = it.view(-1).long() # and flatten indices for downstream processing
 
@@ -65,28 +65,27 @@ class OldModel(CaptionModel):
     def forward(self, fc_feats, att_feats, seq, sen_embed=None, return_attention=False):
         batch_size = fc_feats.size(0)
         state = self.init_hidden(fc_feats)
-        outputs = []
         if return_attention: coverage, cov_loss = torch.Tensor([]).cuda(), torch.zeros(batch_size).cuda()
 
-        for i in range(seq.size(1) - 1):
+        if self.teacher_forced() and not return_attention:
+            # embed all the words at once, only step the core and project all outputs together
+            n = self.input_steps(seq)
+            xt = self.embed(seq[:, :n])
+            outputs = fc_feats.new_empty(batch_size, n, self.rnn_size)
+            for i in range(n):
+                output, state = self.core(xt[:, i], fc_feats, att_feats, state, sen_embed)
+                outputs[:, i] = output
+            if self.return_hidden:
+                return self.dropout(outputs)
+            return F.log_softmax(self.logit(self.dropout(outputs)), dim=2)
+
+        outputs, hiddens = [], []
+        # stop where all the sequences end, found once instead of checking every step
+        for i in range(self.input_steps(seq)):
             if self.training and i >= 1 and self.ss_prob > 0.0: # otherwiste no need to sample
-                sample_prob = fc_feats.data.new(batch_size).uniform_(0, 1)
-                sample_mask = sample_prob < self.ss_prob
-                if sample_mask.sum() == 0:
-                    it = seq[:, i].clone()
-                else:
-                    sample_ind = sample_mask.nonzero().view(-1)
-                    it = seq[:, i].data.clone()
-                    #prob_prev = torch.exp(outputs[-1].data.index_select(0, sample_ind)) # fetch prev distribution: shape Nx(M+1)
-                    #it.index_copy_(0, sample_ind, torch.multinomial(prob_prev, 1).view(-1))
-                    prob_prev = torch.exp(outputs[-1].data) # fetch prev distribution: shape Nx(M+1)
-                    it.index_copy_(0, sample_ind, torch.multinomial(prob_prev, 1).view(-1).index_select(0, sample_ind))
-                    it = Variable(it, requires_grad=False)
+                it = self.scheduled_sample(seq[:, i], outputs[-1])
             else:
-                it = seq[:, i].clone()          
-            # break if all the sequences end
-            if i >= 1 and seq[:, i].data.sum() == 0:
-                break
+                it = seq[:, i].clone()
 
             xt = self.embed(it)
             if return_attention:
@@ -98,18 +97,20 @@ class OldModel(CaptionModel):
                 else:
                     coverage = torch.cat((coverage, atts), 0)
             else: output, state = self.core(xt, fc_feats, att_feats, state, sen_embed)
-            output = F.log_softmax(self.logit(self.dropout(output)))
-            outputs.append(output)
+            self.append_step(outputs, hiddens, self.dropout(output))
         if return_attention:
-            return torch.cat([_.unsqueeze(1) for _ in outputs], 1), torch.sum(cov_loss)/batch_size
+            return self.stack_steps(outputs, hiddens), torch.sum(cov_loss)/batch_size
         else:
-            return torch.cat([_.unsqueeze(1) for _ in outputs], 1)
+            return self.stack_steps(outputs, hiddens)
 
-    def get_logprobs_state(self, it, tmp_fc_feats, tmp_att_feats, state):
+    def get_logprobs_state(self, it, tmp_fc_feats, tmp_att_feats, tmp_sen_embed, state):
         # 'it' is Variable contraining a word index
         xt = self.embed(it)
 
-        output, state = self.core(xt, tmp_fc_feats, tmp_att_feats, state)
+        if tmp_sen_embed is not None:
+            output, state = self.core(xt, tmp_fc_feats, tmp_att_feats, state, tmp_sen_embed)
+        else:
+            output, state = self.core(xt, tmp_fc_feats, tmp_att_feats, state)
         logprobs = F.log_softmax(self.logit(self.dropout(output)))
 
         return logprobs, state
@@ -127,7 +128,10 @@ class OldModel(CaptionModel):
         for k in range(batch_size):
             tmp_fc_feats = fc_feats[k:k+1].expand(beam_size, self.fc_feat_size)
             tmp_att_feats = att_feats[k:k+1].expand(*((beam_size,)+att_feats.size()[1:])).contiguous()
-            
+            tmp_sen_embed = None
+            if sen_embed is not None:
+                tmp_sen_embed = sen_embed[k:k+1].expand(*((beam_size,)+sen_embed.size()[1:])).contiguous()
+
             state = self.init_hidden(tmp_fc_feats)
 
             beam_seq = torch.LongTensor(self.seq_length, beam_size).zero_()
@@ -139,17 +143,13 @@ class OldModel(CaptionModel):
                     it = fc_feats.data.new(beam_size).long().zero_()
                     xt = self.embed(Variable(it, requires_grad=False))
 
-                if sen_embed is not None:
-                    if return_attention:
-                        output, state, att = self.core(xt, fc_feats, att_feats, state, sen_embed, return_attention)
-                    else:
-                        output, state = self.core(xt, fc_feats, att_feats, state, sen_embed)
+                if tmp_sen_embed is not None:
+                    output, state = self.core(xt, tmp_fc_feats, tmp_att_feats, state, tmp_sen_embed)
                 else:
-                    output, state = self.core(xt, fc_feats, att_feats, state)
-                # output, state = self.core(xt, tmp_fc_feats, tmp_att_feats, state)
+                    output, state = self.core(xt, tmp_fc_feats, tmp_att_feats, state)
                 logprobs = F.log_softmax(self.logit(self.dropout(output)))
 
-            self.done_beams[k] = self.beam_search(state, logprobs, tmp_fc_feats, tmp_att_feats, opt=opt)
+            self.done_beams[k] = self.beam_search(state, logprobs, tmp_fc_feats, tmp_att_feats, tmp_sen_embed, opt=opt)
             seq[:, k] = self.done_beams[k][0]['seq'] # the first beam has highest cumulative score
             seqLogprobs[:, k] = self.done_beams[k][0]['logps']
         # return the samples and their log likelihoods
@@ -181,7 +181,7 @@ class OldModel(CaptionModel):
                 else:
                     # scale logprobs by temperature
                     prob_prev = torch.exp(torch.div(logprobs.data, temperature)).cpu()
-                it = torch.multinomial(prob_prev, 1).cuda()
+                it = torch.multinomial(prob_prev, 1).to(logprobs.device)
                 sampleLogprobs = logprobs.gather(1, Variable(it, requires_grad=False)) # gather the logprobs at sampled positions
                 it = it.view(-1).long() # and flatten indices for downstream processing
 
@@ -49,37 +49,33 @@ class ShowTellModel(CaptionModel):
     def forward(self, fc_feats, att_feats, seq):
         batch_size = fc_feats.size(0)
         state = self.init_hidden(batch_size)
-        outputs = []
 
-        for i in range(seq.size(1)):
+        if self.teacher_forced():
+            # the image and all the words go through the rnn in a single call
+            n = self.input_steps(seq)
+            xt = torch.cat([self.img_embed(fc_feats).unsqueeze(0), self.embed(seq[:, :n].t())], 0)
+            output, state = self.core(xt, state)
+            output = self.dropout(output[1:]).transpose(0, 1)
+            if self.return_hidden:
+                return output
+            return F.log_softmax(self.logit(output), dim=2).contiguous()
+
+        outputs, hiddens = [], []
+        # stop where all the sequences end, found once instead of checking every step
+        for i in range(self.input_steps(seq) + 1):
             if i == 0:
                 xt = self.img_embed(fc_feats)
             else:
                 if self.training and i >= 2 and self.ss_prob > 0.0: # otherwiste no need to sample
-                    sample_prob = fc_feats.data.new(batch_size).uniform_(0, 1)
-                    sample_mask = sample_prob < self.ss_prob
-                    if sample_mask.sum() == 0:
-                        it = seq[:, i-1].clone()
-                    else:
-                        sample_ind = sample_mask.nonzero().view(-1)
-                        it = seq[:, i-1].data.clone()
-                        #prob_prev = torch.exp(outputs[-1].data.index_select(0, sample_ind)) # fetch prev distribution: shape Nx(M+1)
-                        #it.index_copy_(0, sample_ind, torch.multinomial(prob_prev, 1).view(-1))
-                        prob_prev = torch.exp(outputs[-1].data) # fetch prev distribution: shape Nx(M+1)
-                        it.index_copy_(0, sample_ind, torch.multinomial(prob_prev, 1).view(-1).index_select(0, sample_ind))
-                        it = Variable(it, requires_grad=False)
+                    it = self.scheduled_sample(seq[:, i-1], outputs[-1])
                 else:
-                    it = seq[:, i-1].clone()                
-                # break if all the sequences end
-                if i >= 2 and seq[:, i-1].data.sum() == 0:
-                    break
+                    it = seq[:, i-1].clone()
                 xt = self.embed(it)
 
             output, state = self.core(xt.unsqueeze(0), state)
-            output = F.log_softmax(self.logit(self.dropout(output.squeeze(0))))
-            outputs.append(output)
+            self.append_step(outputs, hiddens, self.dropout(output.squeeze(0)))
 
-        return torch.cat([_.unsqueeze(1) for _ in outputs[1:]], 1).contiguous()
+        return self.stack_steps(outputs, hiddens, 1)
 
     def get_logprobs_state(self, it, state):
         # 'it' is Variable contraining a word index
@@ -144,7 +140,7 @@ class ShowTellModel(CaptionModel):
                     else:
                         # scale logprobs by temperature
                         prob_prev = torch.exp(torch.div(logprobs.data, temperature)).cpu()
-                    it = torch.multinomial(prob_prev, 1).cuda()
+                    it = torch.multinomial(prob_prev, 1).to(logprobs.device)
                     sampleLogprobs = logprobs.gather(1, Variable(it, requires_grad=False)) # gather the logprobs at sampled positions
                     it = it.view(-1).long() # and flatten indices for downstream processing
 
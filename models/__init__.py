@@ -11,7 +11,11 @@ from .OldModel import ShowAttendTellModel, AllImgModel
 from .Att2inModel import Att2inModel
 from .AttModel import *
 
-def setup(opt):
+SCRIPTABLE_CORES = ['fc', 'att2in', 'att2in2', 'adaatt', 'adaattmo', 'topdown']
+
+def setup(opt, word_counts=None):
+    # word_counts: {vocabulary index: training count} the adaptive softmax clusters are made
+    # from; a checkpoint loaded afterwards brings its own ranking (AdaptiveLogit.rank)
     
     if opt.caption_model == 'show_tell':
         model = ShowTellModel(opt)
@@ -41,6 +45,19 @@ def setup(opt):
     else:
         raise Exception("Caption model not supported: {}".format(opt.caption_model))
 
+    # Adaptive softmax output head, the clusters follow the word counts of prepro_labels.py
+    if vars(opt).get('adaptive_softmax_cutoffs', ''):
+        cutoffs = [int(_) for _ in opt.adaptive_softmax_cutoffs.split(',')]
+        assert cutoffs == sorted(set(cutoffs)) and 0 < cutoffs[0] and cutoffs[-1] < opt.vocab_size + 1, \
+            "adaptive_softmax_cutoffs must be increasing and within the vocabulary (%d words)" % opt.vocab_size
+        model.logit = utils.AdaptiveLogit(opt.rnn_size, opt.vocab_size + 1, cutoffs, word_counts,
+                                          vars(opt).get('adaptive_softmax_div', 4.0))
+
+    # TorchScript the core so the LSTM gate math of every timestep runs fused; the state dict is unchanged
+    if vars(opt).get('script_core', 0):
+        assert opt.caption_model in SCRIPTABLE_CORES, "script_core is not supported by %s" % opt.caption_model
+        model.core = torch.jit.script(model.core)
+
     # check compatibility if training is continued from previously saved model
     if vars(opt).get('start_from', None) is not None:
         # check if all necessary files exist 
@@ -1,6 +1,4 @@
 import argparse
-import torchvision
-torchvision.models.resnet152()
 
 def parse_opt():
     parser = argparse.ArgumentParser()
@@ -64,6 +62,16 @@ def parse_opt():
                     help='strength of dropout in the Language Model RNN')
     parser.add_argument('--finetune_cnn_after', type=int, default=-1,
                     help='After what epoch do we start finetuning the CNN? (-1 = disable; never finetune, 0 = finetune from start)')
+    parser.add_argument('--cnn_inference_build', type=int, default=0,
+                    help='Run the frozen CNN (eval, and training before finetune_cnn_after) as a BatchNorm-folded, channels_last, traced copy? (1 = yes, 0 = no)')
+    parser.add_argument('--crit_chunk_size', type=int, default=0,
+                    help='if > 0, compute logit, log_softmax and the loss this many time steps at a time with checkpointing, so the B x T x vocab log-probs are never stored. Saves memory with large vocabularies. 0 = off')
+    parser.add_argument('--adaptive_softmax_cutoffs', type=str, default='',
+                    help='comma separated cluster cutoffs (e.g. 2000,10000) of an adaptive softmax output head over the words ranked by training frequency. Needs the word_counts of prepro_labels.py in input_json and replaces --crit_chunk_size. empty = dense softmax')
+    parser.add_argument('--adaptive_softmax_div', type=float, default=4.0,
+                    help='each adaptive softmax tail cluster projects to a div times smaller size than the previous one')
+    parser.add_argument('--script_core', type=int, default=0,
+                    help='Compile the decoder core with TorchScript to fuse the LSTM gate math (1 = yes, 0 = no)? fc, att2in, att2in2, adaatt, adaattmo and topdown only.')
     parser.add_argument('--seq_per_img', type=int, default=1,
                     help='number of captions to sample for each image during training. Done for efficiency since CNN forward pass is expensive. E.g. coco has 5 sents/image')
     parser.add_argument('--beam_size', type=int, default=1,
@@ -115,10 +123,28 @@ def parse_opt():
                     help='how often to save a model checkpoint (in iterations)?')
     parser.add_argument('--checkpoint_path', type=str, default='save/',
                     help='directory to store checkpointed models')
+    parser.add_argument('--keep_checkpoints', type=int, default=1,
+                    help='how many of the latest checkpoints to keep as model-<iteration>.pth etc. next to model.pth and model-best.pth')
+    parser.add_argument('--async_checkpoint', type=int, default=1,
+                    help='write checkpoints in a background thread from a cpu snapshot (1 = yes, 0 = no)?')
     parser.add_argument('--language_eval', type=int, default=1,
                     help='Evaluate language as well (1 = yes, 0 = no)? BLEU/CIDEr/METEOR/ROUGE_L? requires coco-caption code from Github.')
+    parser.add_argument('--scorer', type=str, default='coco',
+                    help='Bleu/ROUGE_L/CIDEr of language_eval from coco: pycocoevalcap, native: misc/scorer.py (same scores, vectorized over a process pool)')
+    parser.add_argument('--scorer_processes', type=int, default=0,
+                    help='processes of the native scorer. 0 = one per cpu')
+    parser.add_argument('--score_cache', type=str, default='',
+                    help='sqlite file memoizing the per caption scores of the native scorer, e.g. data/score_cache.sqlite. empty = off')
     parser.add_argument('--losses_log_every', type=int, default=100,
                     help='How often do we snapshot losses, for inclusion in the progress dump? (0 = disable)')
+    parser.add_argument('--profile_every', type=int, default=0,
+                    help='time the phases of every training iteration (loader wait, cnn forward, backward, ...) and print their percentiles every this many iterations. 0 = off')
+    parser.add_argument('--profile_trace', type=int, default=0,
+                    help='with --profile_every, also write the spans of each window as a Chrome trace (traces/trace-<iteration>.json in the checkpoint directory)? (1 = yes, 0 = no)')
+    parser.add_argument('--async_eval', type=int, default=0,
+                    help='validate in a separate eval_worker.py process that evaluates the checkpoints and links the best one, so training never waits on it (1 = yes, 0 = no)?')
+    parser.add_argument('--eval_device', type=str, default='cuda',
+                    help='device of the --async_eval worker, e.g. cuda:1 or cpu')
     parser.add_argument('--load_best_score', type=int, default=1,
                     help='Do we load previous best score when resuming training.')       
 
@@ -139,8 +165,12 @@ def parse_opt():
     assert args.seq_per_img > 0, "seq_per_img should be greater than 0"
     assert args.beam_size > 0, "beam_size should be greater than 0"
     assert args.save_checkpoint_every > 0, "save_checkpoint_every should be greater than 0"
+    assert args.keep_checkpoints > 0, "keep_checkpoints should be greater than 0"
     assert args.losses_log_every > 0, "losses_log_every should be greater than 0"
+    assert args.profile_every >= 0, "profile_every should be 0 (off) or greater"
     assert args.language_eval == 0 or args.language_eval == 1, "language_eval should be 0 or 1"
+    assert args.scorer in ['coco', 'native'], "scorer should be coco or native"
+    assert not args.score_cache or args.scorer == 'native', "score_cache needs the native scorer"
     assert args.load_best_score == 0 or args.load_best_score == 1, "language_eval should be 0 or 1"
     assert args.train_only == 0 or args.train_only == 1, "language_eval should be 0 or 1"
 
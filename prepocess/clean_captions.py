@@ -1,5 +1,9 @@
+import argparse
 import json
+import multiprocessing
+import os
 import re
+import time
 import unicodedata
 from itertools import groupby
 
@@ -12,9 +16,15 @@ import unidecode
 from bs4 import BeautifulSoup
 from nltk.corpus import stopwords
 
+from normalizer import normalize_sentences
+
 nltk.download("punkt")
 nltk.download("stopwords")
 
+# only strings with a tag or a character reference are parsed by BeautifulSoup,
+# get_text gives every other string back unchanged
+MARKUP = re.compile(r"[<&]")
+
 
 def remove_non_ascii(words):
     """Remove non-ASCII characters from list of tokenized words"""
@@ -84,7 +94,8 @@ def remove_between_square_brackets(text):
 
 
 def denoise_text(text):
-    text = strip_html(text)
+    if MARKUP.search(text):
+        text = strip_html(text)
     text = remove_between_square_brackets(text)
     return text
 
@@ -98,15 +109,15 @@ def preprocess_sentence(sen):
     return sen
 
 
-def NER(sen):
-    doc = nlp(sen)
+def NER(doc):
+    """Template (entities replaced by their type) and tokens of a spaCy doc."""
     tokens = [d.text for d in doc]
     temp = [d.ent_type_ + "_" if d.ent_iob_ != "O" else d.text for d in doc]
     return [x[0] for x in groupby(temp)], tokens
 
 
-def get_split():
-    rand = np.random.uniform()
+def get_split(rand):
+    """Split of a caption given its uniform draw."""
     if rand > 0.95:
         split = "test"
     elif 0.91 < rand <= 0.95:
@@ -116,48 +127,171 @@ def get_split():
     return split
 
 
+def report(caption, e):
+    print(caption, e)
+
+
+def clean(captions):
+    """Tokens of every caption (as preprocess_sentence), None for the ones that fail."""
+    return normalize_sentences(captions, on_error=report)
+
+
+def process_shard(captions, nlp, pool, batch_size, n_process):
+    """[template, full] of every caption, None for the ones that failed to clean."""
+    chunks = [captions[i : i + 256] for i in range(0, len(captions), 256)]
+    cleaned = [tokens for chunk in pool.map(clean, chunks) for tokens in chunk]
+    texts = [" ".join(tokens) for tokens in cleaned if tokens is not None]
+    docs = iter(nlp.pipe(texts, batch_size=batch_size, n_process=n_process))
+    return [list(NER(next(docs))) if tokens is not None else None for tokens in cleaned]
+
+
+def run_shards(captions, nlp, args):
+    """Clean and tag the captions shard by shard, skipping the shards already written.
+
+    Every shard is a json list in args.shard_dir with the [template, full] of its
+    args.shard_size captions, written once it is complete, so a run that stopped goes on
+    from the first missing shard.
+    """
+    if not os.path.isdir(args.shard_dir):
+        os.makedirs(args.shard_dir)
+    manifest = {"captions": len(captions), "shard_size": args.shard_size}
+    manifest_path = os.path.join(args.shard_dir, "manifest.json")
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, "r") as f:
+            assert json.load(f) == manifest, (
+                "the shards of %s are of other captions or another shard size, remove them"
+                % args.shard_dir
+            )
+    else:
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f)
+
+    processes = args.processes or os.cpu_count()
+    paths = []
+    done = 0
+    elapsed = 0.0
+    with multiprocessing.get_context("fork").Pool(processes) as pool:
+        for shard, start in enumerate(range(0, len(captions), args.shard_size)):
+            path = os.path.join(args.shard_dir, "shard-%05d.json" % shard)
+            paths.append(path)
+            if os.path.isfile(path):
+                continue
+            shard_start = time.time()
+            chunk = captions[start : start + args.shard_size]
+            results = process_shard(chunk, nlp, pool, args.batch_size, args.n_process)
+            with open(path + ".tmp", "w") as f:
+                json.dump(results, f)
+            os.replace(path + ".tmp", path)
+            done += len(chunk)
+            elapsed += time.time() - shard_start
+            print(
+                "shard %d: %d captions, %.1f captions/s"
+                % (shard, len(chunk), len(chunk) / max(time.time() - shard_start, 1e-8))
+            )
+    print(
+        "processed %d captions (%d from earlier runs) in %.1fs: %.1f captions/s with %d cleaning "
+        "and %d spaCy processes on %d cores"
+        % (
+            done,
+            len(captions) - done,
+            elapsed,
+            done / max(elapsed, 1e-8),
+            processes,
+            args.n_process,
+            os.cpu_count(),
+        )
+    )
+    return paths
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Clean the captions, replace their named entities and write the splits."
+    )
+    parser.add_argument(
+        "--shard_dir",
+        default="../data/clean_captions_shards",
+        help="Directory of the processed shards, kept to resume an interrupted run.",
+    )
+    parser.add_argument(
+        "--shard_size",
+        type=int,
+        default=100000,
+        help="Number of captions per shard.",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=0,
+        help="Processes cleaning the captions. 0 = one per cpu.",
+    )
+    parser.add_argument(
+        "--n_process",
+        type=int,
+        default=1,
+        help="Processes of spaCy's nlp.pipe.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1000,
+        help="Number of captions spaCy processes at once.",
+    )
+    args = parser.parse_args()
+
     np.random.seed(42)
     nlp = spacy.load("en_core_web_sm", disable=["parser", "tagger"])
     print("Loading spacy modules.")
-    news_data = []
-    counter = 0
 
     print("Loading the json.")
     with open("../data/captioning_dataset.json", "r") as f:
         captioning_dataset = json.load(f)
 
-    for k, anns in tqdm.tqdm(captioning_dataset.items()):
+    names, captions = [], []
+    for k, anns in captioning_dataset.items():
         for ix, img in anns["images"].items():
-            try:
-                split = get_split()
-                img = preprocess_sentence(img)
-                template, full = NER(" ".join(img))
-                if len(" ".join(template)) != 0:
-                    news_data.append(
-                        {
-                            "filename": k + "_" + str(ix) + ".jpg",
-                            "filepath": "resized",
-                            "cocoid": counter,
-                            "imgid": k + "_" + str(ix),
-                            "sentences": [],
-                            "sentences_full": [],
-                            "split": split,
-                        }
-                    )
-                    news_data[counter]["sentences"].append(
-                        {
-                            "imgid": counter,
-                            "raw": " ".join(template),
-                            "tokens": template,
-                        }
-                    )
-                    news_data[counter]["sentences_full"].append(
-                        {"imgid": counter, "raw": " ".join(full), "tokens": full}
-                    )
-                    counter += 1
-            except Exception as e:
-                print(img, e)
+            names.append(k + "_" + str(ix))
+            captions.append(img)
+    del captioning_dataset
+    # one draw per caption in the order of the dataset, as when every caption drew its own
+    splits = [get_split(rand) for rand in np.random.uniform(size=len(captions))]
+
+    paths = run_shards(captions, nlp, args)
+
+    news_data = []
+    counter = 0
+    name_iter = iter(zip(names, splits))
+    for path in tqdm.tqdm(paths):
+        with open(path, "r") as f:
+            results = json.load(f)
+        for result in results:
+            name, split = next(name_iter)
+            if result is None:
+                continue
+            template, full = result
+            if len(" ".join(template)) != 0:
+                news_data.append(
+                    {
+                        "filename": name + ".jpg",
+                        "filepath": "resized",
+                        "cocoid": counter,
+                        "imgid": name,
+                        "sentences": [],
+                        "sentences_full": [],
+                        "split": split,
+                    }
+                )
+                news_data[counter]["sentences"].append(
+                    {
+                        "imgid": counter,
+                        "raw": " ".join(template),
+                        "tokens": template,
+                    }
+                )
+                news_data[counter]["sentences_full"].append(
+                    {"imgid": counter, "raw": " ".join(full), "tokens": full}
+                )
+                counter += 1
 
     split_to_ix = {i: n["split"] for i, n in enumerate(news_data)}
     val = [news_data[k] for k, v in split_to_ix.items() if v == "val"]
@@ -169,4 +303,3 @@ if __name__ == "__main__":
         json.dump(val, f)
     with open("../data/news_dataset.json", "w") as f:
         json.dump(news_data, f)
-
@@ -1,66 +1,205 @@
+import argparse
 import json
+import os
 import sys
+import time
 
 import numpy as np
 import spacy
-from clean_captions import preprocess_sentence
+from normalizer import normalize_sentences
 
-np.random.seed(42)
+# the article store lives in misc/ of the repository root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from misc.article_store import ArticleStore  # noqa: E402
 
-# Load SpaCy model
-nlp = spacy.load("en", disable=["parser", "tagger"])
-nlp.add_pipe("sentencizer")
 
-# Load datasets
-with open("../data/news_dataset.json", "r", encoding="utf-8") as f:
-    news_dataset = json.load(f)
+def iter_json(path, chunk_size=1 << 20):
+    """Items of the top-level object ((key, value)) or list (value) of a JSON file.
 
-with open("../data/captioning_dataset.json", "r", encoding="utf-8") as f:
-    captioning_dataset = json.load(f)
+    The file is read chunk by chunk and only the item being decoded is kept in memory,
+    instead of the whole file json.load would build.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buffer = ""
+        position = 0
+        eof = False
 
-# Extract unique article IDs
-ids = list(set([news["imgid"].split("_")[0] for news in news_dataset]))
-articles = [captioning_dataset[i]["article"] for i in ids]
-len_articles = len(articles)
+        def skip(chars):
+            # position of the first character of buffer not in chars, reading on as needed
+            nonlocal buffer, position, eof
+            while True:
+                while position < len(buffer) and buffer[position] in chars:
+                    position += 1
+                if position < len(buffer) or eof:
+                    return
+                buffer, position = "", 0
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer += chunk
 
-print(
-    "Sanity check len of ids: %d, len of cap dataset: %d, len of news dataset %d"
-    % (len(ids), len(captioning_dataset), len(news_dataset))
-)
+        def decode():
+            # the next value; a number is only complete with a delimiter after it
+            nonlocal buffer, position, eof
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, position)
+                    if eof or (end < len(buffer) and buffer[end] in " \t\n\r,:]}"):
+                        position = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                buffer, position = buffer[position:], 0
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer += chunk
 
-# Free up memory
-del news_dataset, captioning_dataset
+        skip(" \t\n\r")
+        container = buffer[position]
+        assert container in "{[", "%s is not a JSON object or list" % path
+        position += 1
+        while True:
+            skip(" \t\n\r")
+            if buffer[position] in "}]":
+                return
+            if container == "{":
+                key = decode()
+                skip(" \t\n\r:")
+                yield key, decode()
+            else:
+                yield decode()
+            skip(" \t\n\r,")
 
-article_dataset = {}
-for ix, sentences in enumerate(nlp.pipe(articles, n_process=12, batch_size=2000)):
-    key = ids[ix]
-    art_ner = {ent.text: ent.label_ for ent in sentences.ents}
+
+def default_n_process():
+    """One spaCy process per core."""
+    return os.cpu_count() or 1
+
+
+def default_batch_size(pending, n_process):
+    """Articles per nlp.pipe batch: a few batches for every process, at most 2000."""
+    return int(min(2000, max(1, np.ceil(pending / (4.0 * n_process)))))
+
+
+def process_article(key, doc):
+    """The article set entry of a spaCy doc of an article."""
+    art_ner = {ent.text: ent.label_ for ent in doc.ents}
     article_sentence = []
     article_sentence_ner = []
 
-    for sen_ in sentences.sents:
-        try:
-            sen = preprocess_sentence(sen_.text.encode("ascii", errors="ignore"))
-            sen_text = " ".join(sen)
+    sents = list(doc.sents)
+    # the ascii characters of every sentence, as a str: preprocess_sentence used to get
+    # the encoded bytes, which failed for every sentence under python 3
+    texts = [
+        sen_.text.encode("ascii", errors="ignore").decode("ascii") for sen_ in sents
+    ]
+
+    def report(sen, e):
+        print(f"Error processing sentence for key {key}: {e}")
 
-            # Append sentence if it contains named entities
-            if any(d.ent_iob_ != "O" for d in sen_):
-                article_sentence_ner.append(sen_text)
+    for sen_, sen in zip(sents, normalize_sentences(texts, on_error=report)):
+        if sen is None:
+            continue
+        sen_text = " ".join(sen)
 
-            article_sentence.append(sen_text)
-        except Exception as e:
-            print(f"Error processing sentence for key {key}: {e}")
+        # Append sentence if it contains named entities
+        if any(d.ent_iob_ != "O" for d in sen_):
+            article_sentence_ner.append(sen_text)
 
-    article_dataset[key] = {
+        article_sentence.append(sen_text)
+
+    return {
         "sentence": article_sentence,
         "sentence_ner": article_sentence_ner,
         "ner": art_ner,
     }
 
-    sys.stdout.write("\rPercentage done: {:.4f}".format(ix / float(len_articles)))
-    sys.stdout.flush()
 
-# Save processed article dataset
-with open("../data/article.json", "w", encoding="utf-8") as f:
-    json.dump(article_dataset, f, ensure_ascii=False, indent=4)
-    print("Finished!")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Split the articles of the news dataset into sentences and entities."
+    )
+    parser.add_argument(
+        "--news_dataset",
+        default="../data/news_dataset.json",
+        help="news_dataset.json of clean_captions.py, whose articles are processed.",
+    )
+    parser.add_argument(
+        "--captioning_dataset",
+        default="../data/captioning_dataset.json",
+        help="captioning_dataset.json with the article texts.",
+    )
+    parser.add_argument(
+        "--output",
+        default="../data/articles.sqlite",
+        help="Article store to write; the articles already in it are skipped.",
+    )
+    parser.add_argument(
+        "--shard_size",
+        type=int,
+        default=1000,
+        help="Articles written to the store per transaction.",
+    )
+    parser.add_argument(
+        "--n_process",
+        type=int,
+        default=0,
+        help="Processes of spaCy's nlp.pipe. 0 = one per cpu.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=0,
+        help="Articles per nlp.pipe batch. 0 = a few batches per process, at most 2000.",
+    )
+    args = parser.parse_args()
+
+    np.random.seed(42)
+
+    # Load SpaCy model
+    nlp = spacy.load("en", disable=["parser", "tagger"])
+    nlp.add_pipe("sentencizer")
+
+    # The articles with captions in the news dataset
+    ids = set(news["imgid"].split("_")[0] for news in iter_json(args.news_dataset))
+    article_store = ArticleStore(args.output, writable=True)
+    done = set(article_store.keys()) & ids
+    pending = len(ids) - len(done)
+    n_process = args.n_process or default_n_process()
+    batch_size = args.batch_size or default_batch_size(pending, n_process)
+    print(
+        "%d articles, %d of them already in %s. nlp.pipe with %d processes, batch size %d"
+        % (len(ids), len(done), args.output, n_process, batch_size)
+    )
+
+    # Articles stream from the captioning dataset in its order into nlp.pipe, and are
+    # written to the store a shard at a time: a run that stopped goes on after the last
+    # complete shard
+    articles = (
+        (anns["article"], key)
+        for key, anns in iter_json(args.captioning_dataset)
+        if key in ids and key not in done
+    )
+    start = time.time()
+    count = 0
+    shard = []
+    docs = nlp.pipe(articles, as_tuples=True, n_process=n_process, batch_size=batch_size)
+    for doc, key in docs:
+        shard.append((key, process_article(key, doc)))
+        if len(shard) == args.shard_size:
+            article_store.put_many(shard)
+            count += len(shard)
+            shard = []
+            elapsed = time.time() - start
+            print(
+                "%d/%d articles, %.1f articles/s"
+                % (len(done) + count, len(ids), count / max(elapsed, 1e-8))
+            )
+    article_store.put_many(shard)
+    count += len(shard)
+    article_store.close()
+    print(
+        "Finished! %d articles in %.1fs, %d missing in the captioning dataset"
+        % (count, time.time() - start, pending - count)
+    )
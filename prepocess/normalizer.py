@@ -0,0 +1,134 @@
+import argparse
+import json
+import re
+import time
+import unicodedata
+
+import unidecode
+from bs4 import BeautifulSoup
+from nltk.tokenize import word_tokenize
+
+# clean_captions.preprocess_sentence in one pass per token, for lists of sentences:
+#   normalize_sentences(["Albert Einstein taught in Princeton.", ...])
+#   -> [["Albert", "Einstein", "taught", "in", "Princeton"], ...]
+# ASCII text, most of the captions and article sentences, skips unidecode and the NFKD
+# of every token, BeautifulSoup only parses text with markup and the punctuation of a
+# token is removed with str.translate. The output is the one of preprocess_sentence,
+# which `python normalizer.py --corpus ...` checks on a corpus.
+
+MARKUP = re.compile(r"[<&]")
+SQUARE_BRACKETS = re.compile(r"\[[^]]*\]")
+PUNCTUATION = re.compile(r"[^\w\s]")
+# the ASCII characters PUNCTUATION removes
+ASCII_PUNCTUATION = {c: None for c in range(128) if PUNCTUATION.match(chr(c))}
+
+
+def normalize_sentence(sen):
+    """Tokens of a sentence, as clean_captions.preprocess_sentence."""
+    sen = sen.strip()
+    if not sen.isascii():
+        sen = unidecode.unidecode(sen)
+    if MARKUP.search(sen):
+        sen = BeautifulSoup(sen, "html.parser").get_text()
+    if "[" in sen:
+        sen = SQUARE_BRACKETS.sub("", sen)
+    words = []
+    for word in word_tokenize(sen):
+        if not word.isascii():
+            word = (
+                unicodedata.normalize("NFKD", word)
+                .encode("ascii", "ignore")
+                .decode("utf-8", "ignore")
+            )
+        word = word.translate(ASCII_PUNCTUATION)
+        if word:
+            words.append(word)
+    return words
+
+
+def normalize_sentences(sentences, on_error=None):
+    """normalize_sentence of every sentence.
+
+    A sentence that fails raises, or with on_error is None in the output after
+    on_error(sentence, exception) is called.
+    """
+    normalized = []
+    for sen in sentences:
+        try:
+            normalized.append(normalize_sentence(sen))
+        except Exception as e:
+            if on_error is None:
+                raise
+            on_error(sen, e)
+            normalized.append(None)
+    return normalized
+
+
+def load_corpus(path, limit):
+    """Captions and article lines of a captioning_dataset.json."""
+    with open(path, "r") as f:
+        dataset = json.load(f)
+    corpus = []
+    for anns in dataset.values():
+        corpus.extend(anns["images"].values())
+        article = anns.get("article", "")
+        corpus.extend(line for line in article.split("\n") if line.strip())
+        if len(corpus) >= limit:
+            break
+    return corpus[:limit]
+
+
+def time_per_sentence(function, corpus):
+    """Outputs of function per sentence (None where it raises) and the time taken."""
+    start = time.time()
+    outputs = []
+    for sen in corpus:
+        try:
+            outputs.append(function(sen))
+        except Exception:
+            outputs.append(None)
+    return outputs, time.time() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the normalizer with preprocess_sentence and time both."
+    )
+    parser.add_argument(
+        "--corpus",
+        default="../data/captioning_dataset.json",
+        help="captioning_dataset.json whose captions and article lines are normalized.",
+    )
+    parser.add_argument(
+        "--limit",
+        type=int,
+        default=200000,
+        help="Number of sentences to compare.",
+    )
+    args = parser.parse_args()
+
+    from clean_captions import preprocess_sentence
+
+    corpus = load_corpus(args.corpus, args.limit)
+    expected, reference_time = time_per_sentence(preprocess_sentence, corpus)
+    start = time.time()
+    normalized = normalize_sentences(corpus, on_error=lambda sen, e: None)
+    normalizer_time = time.time() - start
+    mismatches = [i for i, (a, b) in enumerate(zip(expected, normalized)) if a != b]
+    for i in mismatches[:10]:
+        print(
+            "mismatch: %r\n  preprocess_sentence %r\n  normalizer          %r"
+            % (corpus[i], expected[i], normalized[i])
+        )
+    print(
+        "%d sentences, %d mismatches. preprocess_sentence %.1f sentences/s, "
+        "normalizer %.1f sentences/s (%.2fx)"
+        % (
+            len(corpus),
+            len(mismatches),
+            len(corpus) / max(reference_time, 1e-8),
+            len(corpus) / max(normalizer_time, 1e-8),
+            reference_time / max(normalizer_time, 1e-8),
+        )
+    )
+    assert not mismatches, "the normalizer differs from preprocess_sentence"
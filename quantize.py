@@ -0,0 +1,151 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import copy
+import os
+import time
+from collections import OrderedDict
+from six.moves import cPickle
+
+import numpy as np
+import torch
+
+import models
+from dataloader import *
+import eval_utils
+import misc.utils as utils
+
+# Export a dynamic int8 copy of a trained decoder for CPU captioning nodes.
+# The written checkpoint can be passed straight to eval.py as --model_path.
+parser = argparse.ArgumentParser()
+# Input paths
+parser.add_argument('--model_path', type=str, default='./save/show_attend_tell/model-best.pth',
+                help='path to the float model to quantize')
+parser.add_argument('--infos_path', type=str, default='./save/show_attend_tell/infos_-best.pkl',
+                help='path to the infos of the model')
+parser.add_argument('--output_path', type=str, default='',
+                help='where to write the int8 checkpoint. empty = next to model_path with an -int8 suffix')
+# Accuracy/speed report
+parser.add_argument('--report', type=int, default=0,
+                help='compare greedy and beam captions of the float and int8 decoders on --split (1 = yes, 0 = no)')
+parser.add_argument('--cnn_model_path', type=str, default='./save/show_attend_tell/model-cnn-best.pth',
+                help='path to the cnn model used for the report')
+parser.add_argument('--split', type=str, default='test',
+                help='which split to use for the report: val|test')
+parser.add_argument('--num_images', type=int, default=-1,
+                help='how many images to caption for the report (-1 = all)')
+parser.add_argument('--batch_size', type=int, default=32,
+                help='minibatch size for the report')
+parser.add_argument('--beam_size', type=int, default=3,
+                help='beam size of the beam search half of the report')
+parser.add_argument('--input_json', type=str, default='',
+                help='empty = fetch from model checkpoint.')
+parser.add_argument('--input_label_h5', type=str, default='',
+                help='empty = fetch from model checkpoint.')
+parser.add_argument('--input_image_h5', type=str, default='',
+                help='empty = fetch from model checkpoint.')
+parser.add_argument('--id', type=str, default='',
+                help='an id identifying this run/job. empty = fetch from model checkpoint.')
+
+
+def decode_split(cnn_model, variants, loader, opt):
+    # The CNN runs once per batch and only the decoders are timed, so captions/s
+    # measures the part that quantization changes.
+    loader.reset_iterator(opt.split)
+    predictions = OrderedDict((name, []) for name in variants)
+    elapsed = OrderedDict((name, 0.0) for name in variants)
+    n = 0
+    while True:
+        data = loader.get_batch(opt.split)
+        data['images'] = utils.prepro_images(data['images'], False)
+        n = n + loader.batch_size
+
+        with torch.no_grad():
+            att_feats = cnn_model(torch.from_numpy(data['images'])).permute(0, 2, 3, 1).contiguous()
+            fc_feats = att_feats.mean(2).mean(1)
+            extra = ()
+            if data.get('sen_embed', None) is not None:
+                extra = (torch.from_numpy(np.array(data['sen_embed'], dtype=np.float32)),)
+
+            for name, (model, sample_opt) in variants.items():
+                start = time.time()
+                with utils.adaptive_decoding(model, sample_opt):
+                    seq = model.sample(fc_feats, att_feats, sample_opt, *extra)[0]
+                elapsed[name] += time.time() - start
+                sents = utils.decode_sequence(loader.get_vocab(), seq)
+                for k, sent in enumerate(sents):
+                    predictions[name].append({'image_id': data['infos'][k]['id'], 'caption': sent})
+
+        # if we wrapped around the split or used up the image budget then bail
+        ix1 = data['bounds']['it_max']
+        if opt.num_images != -1:
+            ix1 = min(ix1, opt.num_images)
+        for name in variants:
+            for i in range(n - ix1):
+                predictions[name].pop()
+        print('decoded %d/%d' % (min(n, ix1), ix1))
+
+        if data['bounds']['wrapped']:
+            break
+        if opt.num_images >= 0 and n >= opt.num_images:
+            break
+
+    return predictions, elapsed
+
+
+def report(model, qmodel, opt, infos):
+    cnn_model = utils.build_cnn(opt)
+    cnn_model.load_state_dict(torch.load(opt.cnn_model_path, map_location='cpu'))
+    cnn_model.eval()
+
+    opt.seq_per_img = 1
+    loader = DataLoader(opt)
+    loader.ix_to_word = infos['vocab']
+
+    greedy = {'sample_max': 1, 'beam_size': 1}
+    beam = {'sample_max': 1, 'beam_size': opt.beam_size}
+    variants = OrderedDict([('float greedy', (model, greedy)), ('int8 greedy', (qmodel, greedy)),
+                            ('float beam', (model, beam)), ('int8 beam', (qmodel, beam))])
+    predictions, elapsed = decode_split(cnn_model, variants, loader, opt)
+    scores = OrderedDict((name, eval_utils.language_eval('news', preds, opt.id, opt.split))
+                         for name, preds in predictions.items())
+
+    print('\n%-14s %8s %8s %8s %8s %12s' % ('', 'Bleu_4', 'dBleu_4', 'CIDEr', 'dCIDEr', 'captions/s'))
+    for name in variants:
+        base = scores[name.replace('int8', 'float')]
+        print('%-14s %8.4f %+8.4f %8.4f %+8.4f %12.1f' % (
+            name, scores[name]['Bleu_4'], scores[name]['Bleu_4'] - base['Bleu_4'],
+            scores[name]['CIDEr'], scores[name]['CIDEr'] - base['CIDEr'],
+            len(predictions[name]) / max(elapsed[name], 1e-8)))
+
+
+if __name__ == '__main__':
+    opt = parser.parse_args()
+
+    # Load infos and copy over the options of the model
+    with open(opt.infos_path, 'rb') as f:
+        infos = cPickle.load(f)
+    for k in ['input_json', 'input_label_h5', 'input_image_h5', 'id']:
+        if len(vars(opt)[k]) == 0:
+            vars(opt)[k] = vars(infos['opt'])[k]
+    ignore = ['batch_size', 'beam_size', 'start_from']
+    for k, v in vars(infos['opt']).items():
+        if k not in ignore and k not in vars(opt):
+            vars(opt)[k] = v
+
+    opt.script_core = 0  # quantize_dynamic only sees eager modules
+    model = models.setup(opt)
+    model.load_state_dict(torch.load(opt.model_path, map_location='cpu'))
+    model.eval()
+    qmodel = utils.quantize_model(copy.deepcopy(model))
+    qmodel.eval()
+
+    output_path = opt.output_path or os.path.splitext(opt.model_path)[0] + '-int8.pth'
+    torch.save(qmodel.state_dict(), output_path)
+    print('int8 model saved to {} ({:.1f}MB -> {:.1f}MB)'.format(
+        output_path, os.path.getsize(opt.model_path) / 2.0 ** 20, os.path.getsize(output_path) / 2.0 ** 20))
+
+    if opt.report == 1:
+        report(model, qmodel, opt, infos)
@@ -0,0 +1,51 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import tqdm
+
+# the article store lives in misc/ of the repository root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from misc.article_store import ArticleStore  # noqa: E402
+
+
+def convert(input_json, output, batch_size):
+    """Write the articles of an article.json of create_article_set.py to an article store."""
+    with open(input_json, "r") as f:
+        articles = json.load(f)
+    store = ArticleStore(output, writable=True)
+    items = list(articles.items())
+    for start in tqdm.tqdm(range(0, len(items), batch_size)):
+        store.put_many(items[start : start + batch_size])
+    store.close()
+    return len(items)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert an article.json to the keyed article store insert.py and the article encoders read."
+    )
+    parser.add_argument(
+        "--input_json",
+        default="./data/article.json",
+        help="Path to the article JSON file.",
+    )
+    parser.add_argument(
+        "--output",
+        default="./data/articles.sqlite",
+        help="Path of the article store to write.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1000,
+        help="Number of articles written per transaction.",
+    )
+
+    args = parser.parse_args()
+
+    start = time.time()
+    count = convert(args.input_json, args.output, args.batch_size)
+    print("wrote {} articles to {} in {:.1f}s".format(count, args.output, time.time() - start))
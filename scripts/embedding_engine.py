@@ -0,0 +1,201 @@
+import multiprocessing
+import os
+
+import numpy as np
+import scipy.sparse
+from spacy.attrs import ORTH
+from vector_cache import vector_keys
+
+# Sentence embeddings of the article encoders, for whole batches of sentences: the
+# sentences are tokenized with the tokenizer of the spaCy pipeline only, their tokens
+# mapped to the rows of the vocabulary vector matrix, and the (weighted) averages of
+# the token vectors computed as one sparse (sentences x rows) product with the matrix.
+#   engine = EmbeddingEngine(nlp)
+#   engine.embed(sentences)  # = [nlp(sentence).vector for sentence in sentences]
+#   EmbeddingEngine(nlp, weight=lambda text: ...).embed(sentences)
+# With a weight the tokens with a vector are averaged with weight(token.text), and a
+# sentence without any has a zero vector, as in prepro_articles_wavg.py. The scheme
+# names the weighting for the VectorCache of vector_cache.py, which embed_cached and
+# embed_articles look sentences up in before embedding them: it has to change with
+# the weights.
+
+# engine of embed_articles, set before the workers are forked
+_SHARED = {}
+
+
+class EmbeddingEngine(object):
+    def __init__(self, nlp, weight=None, batch_size=1000, scheme=None):
+        assert weight is None or scheme, "a weighted engine needs a scheme name"
+        self.nlp = nlp
+        self.weight = weight
+        self.batch_size = batch_size
+        self.scheme = scheme or "avg"
+        self.vectors = nlp.vocab.vectors
+        self.matrix = np.asarray(self.vectors.data)
+        meta = getattr(nlp, "meta", {})
+        # the model the vectors come from, part of the cache key of a sentence
+        self.model = "%s_%s-%s %dx%d" % (
+            (meta.get("lang"), meta.get("name"), meta.get("version"))
+            + self.matrix.shape
+        )
+        # weight of every token orth seen so far
+        self._weights = {}
+
+    def tokens(self, sentences):
+        """Sentence, orth and vector row of the tokens with a vector; token counts."""
+        docs = self.nlp.tokenizer.pipe(sentences, batch_size=self.batch_size)
+        orths = [doc.to_array(ORTH) for doc in docs]
+        lengths = np.array([len(o) for o in orths], dtype=np.int64)
+        if orths:
+            orths = np.concatenate(orths).astype(np.uint64)
+        else:
+            orths = np.zeros(0, np.uint64)
+        rows = self.vectors.find(keys=orths.tolist())
+        rows = np.asarray(rows, dtype=np.int64).reshape(-1)
+        sentence = np.repeat(np.arange(len(lengths)), lengths)
+        found = rows >= 0
+        return sentence[found], orths[found], rows[found], lengths
+
+    def token_weights(self, orths):
+        """weight(text) of every orth."""
+        unique, inverse = np.unique(orths, return_inverse=True)
+        for orth in unique.tolist():
+            if orth not in self._weights:
+                self._weights[orth] = self.weight(self.nlp.vocab.strings[orth])
+        return np.array([self._weights[orth] for orth in unique.tolist()])[inverse]
+
+    def embed(self, sentences):
+        """(len(sentences), vector width) embeddings of the sentences."""
+        sentence, orths, rows, lengths = self.tokens(sentences)
+        shape = (len(lengths), self.matrix.shape[0])
+        if self.weight is None:
+            # Doc.vector: sum of the token vectors (zero without one) / number of tokens
+            counts = np.ones(len(rows), dtype=self.matrix.dtype)
+            totals = lengths.astype(self.matrix.dtype)
+        else:
+            counts = self.token_weights(orths)
+            totals = np.bincount(sentence, weights=counts, minlength=len(lengths))
+        weights = scipy.sparse.csr_matrix((counts, (sentence, rows)), shape=shape)
+        return (weights @ self.matrix) / np.where(totals > 0, totals, 1)[:, None]
+
+
+def article_matrix(vectors, sen_len):
+    """[vector width, <= sen_len + 1] embedding of an article from its sentence vectors.
+
+    The first sen_len sentences get a column each, the rest share the last one, which
+    is the average of all the values of their vectors.
+    """
+    if len(vectors) < sen_len + 1:
+        temp = np.zeros([vectors.shape[1], len(vectors)])
+        temp[:] = vectors.T
+    else:
+        temp = np.zeros([vectors.shape[1], sen_len + 1])
+        temp[:, :sen_len] = vectors[:sen_len].T
+        temp[:, sen_len] = np.average(vectors[sen_len:])
+    return temp
+
+
+def _lookup(engine, sentences, cache):
+    # cache keys of the sentences, {key: vector} of the cached ones and {key: sentence}
+    # of the others
+    keys = vector_keys(sentences, engine.model, engine.scheme)
+    found = cache.get_many(keys)
+    missing = {}
+    for key, sentence in zip(keys, sentences):
+        if key not in found:
+            missing.setdefault(key, sentence)
+    return keys, found, missing
+
+
+def _complete(engine, keys, found, missing, vectors, cache):
+    # the vectors of all the keys, after the ones of the missing sentences are cached
+    vectors = np.asarray(vectors, dtype=np.float32)
+    cache.put_many(list(missing), vectors)
+    found.update(zip(missing, vectors))
+    if not keys:
+        return np.zeros((0, engine.matrix.shape[1]), dtype=np.float32)
+    return np.stack([found[key] for key in keys])
+
+
+def embed_cached(engine, sentences, cache=None):
+    """engine.embed(sentences), with only the sentences not in cache embedded.
+
+    With a cache the vectors are float32, the way they are cached, whether they were
+    found or embedded.
+    """
+    if cache is None:
+        return engine.embed(sentences)
+    keys, found, missing = _lookup(engine, sentences, cache)
+    vectors = engine.embed(list(missing.values()))
+    return _complete(engine, keys, found, missing, vectors, cache)
+
+
+def _embed(sentences):
+    return _SHARED["engine"].embed(sentences)
+
+
+def _chunks(articles, chunk_size):
+    chunk = []
+    for item in articles:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _embed_waves(articles, engine, sen_len, cache, embed, wave_size, chunk_size):
+    # keys and article matrices of the articles, a wave of chunks at a time: the cache
+    # is looked up and written here, the sentences it misses are embedded by
+    # embed(chunks)
+    keys, data = [], []
+    for wave in _chunks(_chunks(articles, chunk_size), wave_size):
+        sentences = [[s.lower() for _, ss in chunk for s in ss] for chunk in wave]
+        if cache is None:
+            wave_vectors = embed(sentences)
+        else:
+            lookups = [_lookup(engine, chunk, cache) for chunk in sentences]
+            embedded = embed([list(missing.values()) for _, _, missing in lookups])
+            wave_vectors = [
+                _complete(engine, *lookup, vectors, cache)
+                for lookup, vectors in zip(lookups, embedded)
+            ]
+        for chunk, vectors in zip(wave, wave_vectors):
+            start = 0
+            for key, article_sentences in chunk:
+                end = start + len(article_sentences)
+                keys.append(key)
+                data.append(article_matrix(vectors[start:end], sen_len))
+                start = end
+    return keys, data
+
+
+def embed_articles(articles, engine, sen_len, processes=0, chunk_size=64, cache=None):
+    """Keys and article_matrix of the lowercased sentences of (key, sentences) articles.
+
+    Chunks of chunk_size articles are embedded by a pool of processes forked with the
+    engine, 0 = one per cpu. With a VectorCache only the sentences not in it are.
+    """
+    _SHARED.update(engine=engine)
+    processes = processes or os.cpu_count()
+    if processes == 1:
+        return _embed_waves(
+            articles,
+            engine,
+            sen_len,
+            cache,
+            lambda chunks: [_embed(chunk) for chunk in chunks],
+            1,
+            chunk_size,
+        )
+    with multiprocessing.get_context("fork").Pool(processes) as pool:
+        return _embed_waves(
+            articles,
+            engine,
+            sen_len,
+            cache,
+            lambda chunks: pool.map(_embed, chunks, chunksize=1),
+            4 * processes,
+            chunk_size,
+        )
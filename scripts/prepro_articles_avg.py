@@ -1,22 +1,18 @@
 import argparse
 import json
+import os
+import sys
 
 import h5py
 import numpy as np
 import spacy
 import tqdm
 
-
-def open_json(path):
-    """Open and load a JSON file."""
-    with open(path, "r") as f:
-        return json.load(f)
-
-
-def get_word_vector(sen):
-    """Convert a sentence to its word vector representation using SpaCy."""
-    sen = nlp(sen)
-    return sen.vector
+# the article store lives in misc/ of the repository root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from misc.article_store import open_articles  # noqa: E402
+from embedding_engine import EmbeddingEngine, embed_articles  # noqa: E402
+from vector_cache import add_vector_cache_arguments, open_vector_cache  # noqa: E402
 
 
 def save_h5(file_save, data):
@@ -28,26 +24,11 @@ def save_h5(file_save, data):
             ds[i] = d
 
 
-def create_rep(art):
+def create_rep(art, processes, cache=None):
     """Create representation for each article."""
-    data = []
-    keys = []
-    for k, v in tqdm.tqdm(art.items()):
-        v = v["sentence"]
-        if len(v) < sen_len + 1:
-            temp = np.zeros([300, len(v)])
-            for i, sents in enumerate(v):
-                temp[:, i] = get_word_vector(sents.lower())
-        else:
-            temp = np.zeros([300, sen_len + 1])
-            for i, sents in enumerate(v[:sen_len]):
-                temp[:, i] = get_word_vector(sents.lower())
-            temp[:, sen_len] = np.average(
-                [get_word_vector(sents.lower()) for sents in v[sen_len:]]
-            )
-        data.append(temp)
-        keys.append(k)
-    return keys, data
+    articles = ((k, v["sentence"]) for k, v in tqdm.tqdm(art.items(), total=len(art)))
+    engine = EmbeddingEngine(nlp)
+    return embed_articles(articles, engine, sen_len, processes, cache=cache)
 
 
 if __name__ == "__main__":
@@ -55,9 +36,9 @@ if __name__ == "__main__":
         description="Process articles and convert sentences to word vectors."
     )
     parser.add_argument(
-        "--input_json",
+        "--input_articles",
         required=True,
-        help="Path to the input JSON file containing articles.",
+        help="Path to the article store of create_article_set.py (or an article JSON file).",
     )
     parser.add_argument(
         "--output_keys_json",
@@ -75,15 +56,27 @@ if __name__ == "__main__":
         default=54,
         help="Maximum number of sentences to consider for each article.",
     )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=0,
+        help="Processes embedding the articles. 0 = one per cpu.",
+    )
+    add_vector_cache_arguments(parser)
 
     args = parser.parse_args()
 
     sen_len = args.sen_len
     np.random.seed(42)
-    nlp = spacy.load("en_core_web_lg", disable=["parser", "tagger"])
+    # only the tokenizer and the vectors are used
+    nlp = spacy.load("en_core_web_lg", disable=["parser", "tagger", "ner"])
 
-    full = open_json(args.input_json)
-    keys, data = create_rep(full)
+    full = open_articles(args.input_articles, fields=["sentence"])
+    cache = open_vector_cache(args.vector_cache, nlp, args.vector_cache_size)
+    keys, data = create_rep(full, args.processes, cache)
+    if cache is not None:
+        print(cache.report())
+        cache.close()
     json.dump(keys, open(args.output_keys_json, "w"))
     save_h5(args.output_h5, data)
 
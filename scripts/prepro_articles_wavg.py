@@ -1,5 +1,9 @@
+import argparse
+import hashlib
 import json
 import math
+import os
+import sys
 from collections import Counter
 
 import h5py
@@ -8,15 +12,11 @@ import spacy
 import tqdm
 from nltk.tokenize import word_tokenize
 
-
-def open_json(path):
-    with open(path, "r") as f:
-        return json.load(f)
-
-
-def get_word_vector(sen, nlp):
-    sen = nlp(sen)
-    return sen.vector
+# the article store lives in misc/ of the repository root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from misc.article_store import open_articles  # noqa: E402
+from embedding_engine import EmbeddingEngine, embed_articles  # noqa: E402
+from vector_cache import add_vector_cache_arguments, open_vector_cache  # noqa: E402
 
 
 def save_h5(file_save, data):
@@ -38,61 +38,51 @@ def getLog(frequency, a=10**-3):
     return a / (a + math.log(1 + frequency))
 
 
-def get_vector_avg_weighted_full(sent, nlp, count_full):
-    sent = nlp(sent)
-    vectors = []
-    weights = []
-    for token in sent:
-        if token.has_vector:
-            frequency = count_full.get(token.text.lower(), 10)
-            weight = getLog(frequency)
-            vectors.append(token.vector)
-            weights.append(weight)
-    try:
-        doc_vector = np.average(vectors, weights=weights, axis=0)
-    except:
-        doc_vector = sent.vector
-    return doc_vector
-
-
-def get_weighted_avg_data(article, get_vector_avg_weighted, nlp, count_full, sen_len):
-    data, keys = [], []
-    for k, v in tqdm.tqdm(article.items()):
-        if len(v) < sen_len + 1:
-            temp = np.zeros([300, len(v)])
-            for i, sents in enumerate(v):
-                temp[:, i] = get_vector_avg_weighted(sents.lower(), nlp, count_full)
-        else:
-            temp = np.zeros([300, sen_len + 1])
-            for i, sents in enumerate(v[:sen_len]):
-                temp[:, i] = get_vector_avg_weighted(sents.lower(), nlp, count_full)
-            temp[:, sen_len] = np.average(
-                [
-                    get_vector_avg_weighted(sents.lower(), nlp, count_full)
-                    for sents in v[sen_len:]
-                ]
-            )
-        data.append(temp)
-        keys.append(k)
-
-    return keys, data
+def get_weighted_avg_data(article, nlp, count_full, sen_len, processes, cache=None):
+    # the tokens with a vector of every sentence averaged with the weights getLog of their
+    # counts in all the articles; the cached vectors are the ones of the same counts
+    counts = json.dumps(sorted(count_full.items()))
+    engine = EmbeddingEngine(
+        nlp,
+        weight=lambda text: getLog(count_full.get(text.lower(), 10)),
+        scheme="wavg-log " + hashlib.sha1(counts.encode("utf-8")).hexdigest(),
+    )
+    articles = (
+        (k, v["sentence"]) for k, v in tqdm.tqdm(article.items(), total=len(article))
+    )
+    return embed_articles(articles, engine, sen_len, processes, cache=cache)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=0,
+        help="Processes embedding the articles. 0 = one per cpu.",
+    )
+    add_vector_cache_arguments(parser)
+    args = parser.parse_args()
+
     sen_len = 54
     np.random.seed(42)
-    nlp = spacy.load("en_core_web_lg", disable=["parser", "tagger"])
+    # only the tokenizer and the vectors are used
+    nlp = spacy.load("en_core_web_lg", disable=["parser", "tagger", "ner"])
 
     count_full = Counter()
 
-    full = open_json("../data/article.json")
+    full = open_articles("../data/articles.sqlite", fields=["sentence"])
     for v_fu in full.values():
         for elm in v_fu["sentence"]:
             count_full.update([t.lower() for t in word_tokenize(elm)])
 
+    cache = open_vector_cache(args.vector_cache, nlp, args.vector_cache_size)
     keys, data = get_weighted_avg_data(
-        full, get_vector_avg_weighted_full, nlp, count_full, sen_len
+        full, nlp, count_full, sen_len, args.processes, cache
     )
+    if cache is not None:
+        print(cache.report())
+        cache.close()
     with open("../data/articles_full_WeightedAvg_keys.json", "w") as keys_file:
         json.dump(keys, keys_file)
     save_h5("../data/articles_full_WeightedAvg.h5", data)
@@ -159,5 +159,70 @@ def main(params):
     }  # A 1-indexed vocab translation table
     wtoi = {w: i + 1 for i, w in enumerate(vocab)}  # Inverse table
 
-    #
+    # Count the words of the final captions (UNK included), they order the adaptive softmax clusters
+    word_counts = {i: 0 for i in itow}
+    for img in imgs:
+        for caption in img["final_captions"]:
+            for w in caption[: params["max_length"]]:
+                word_counts[wtoi[w]] += 1
+
+    L, label_start_ix, label_end_ix, label_length = encode_captions(imgs, params, wtoi)
+
+    # create output h5 file
+    f_lb = h5py.File(params["output_h5"] + "_label.h5", "w")
+    f_lb.create_dataset("labels", dtype="uint32", data=L)
+    f_lb.create_dataset("label_start_ix", dtype="uint32", data=label_start_ix)
+    f_lb.create_dataset("label_end_ix", dtype="uint32", data=label_end_ix)
+    f_lb.create_dataset("label_length", dtype="uint32", data=label_length)
+    f_lb.close()
+
+    # create output json file
+    out = {}
+    out["ix_to_word"] = itow
+    out["word_counts"] = word_counts
+    out["images"] = []
+    for i, img in enumerate(imgs):
+        jimg = {}
+        jimg["split"] = img["split"]
+        if "filename" in img:
+            jimg["file_path"] = os.path.join(img["filepath"], img["filename"])
+        if "cocoid" in img:
+            jimg["id"] = img["cocoid"]
+        out["images"].append(jimg)
+
+    json.dump(out, open(params["output_json"], "w"))
+    print("Wrote ", params["output_json"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # input json
+    parser.add_argument(
+        "--input_json",
+        default="../data/news_dataset.json",
+        help="Input JSON file with image paths and captions",
+    )
+    parser.add_argument(
+        "--output_json", default="../data/data_news.json", help="Output JSON file"
+    )
+    parser.add_argument(
+        "--output_h5", default="../data/data_news", help="Output HDF5 file prefix"
+    )
+
+    # options
+    parser.add_argument(
+        "--max_length", default=31, type=int, help="Max length of a caption"
+    )
+    parser.add_argument(
+        "--word_count_threshold",
+        default=4,
+        type=int,
+        help="only words that occur more than this number of times will be put in vocab",
+    )
 
+    args = parser.parse_args()
+    params = vars(args)  # convert to ordinary dict
+    print("parsed input parameters:")
+    print(json.dumps(params, indent=2))
+    main(params)
@@ -29,6 +29,7 @@ import argparse
 import json
 import os
 import string
+import sys
 from random import seed
 
 import h5py
@@ -40,6 +41,12 @@ import torchvision.models as models
 import tqdm
 from torch.autograd import Variable
 
+# the article store lives in misc/ of the repository root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from misc.article_store import open_articles  # noqa: E402
+from embedding_engine import EmbeddingEngine, embed_articles  # noqa: E402
+from vector_cache import add_vector_cache_arguments, open_vector_cache  # noqa: E402
+
 
 def build_vocab(imgs, params):
     count_thr = params["word_count_threshold"]
@@ -138,11 +145,6 @@ def open_json(path):
         return json.load(f)
 
 
-def get_word_vector(sen):
-    sen = nlp(sen)
-    return sen.vector
-
-
 def save_h5(file_save, data):
     f_lb = h5py.File(file_save, "w")
     dt = h5py.special_dtype(vlen=np.dtype("float64"))
@@ -152,25 +154,10 @@ def save_h5(file_save, data):
     f_lb.close()
 
 
-def create_rep(art):
-    data = []
-    keys = []
-    for k, v in tqdm.tqdm(art.items()):
-        v = v["sentence"]
-        if len(v) < sen_len + 1:
-            temp = np.zeros([300, len(v)])
-            for i, sents in enumerate(v):
-                temp[:, i] = get_word_vector(sents.lower())
-        else:
-            temp = np.zeros([300, sen_len + 1])
-            for i, sents in enumerate(v[:sen_len]):
-                temp[:, i] = get_word_vector(sents.lower())
-            temp[:, sen_len] = np.average(
-                [get_word_vector(sents.lower()) for sents in v[sen_len:]]
-            )
-        data.append(temp)
-        keys.append(k)
-    return keys, data
+def create_rep(art, processes, cache=None):
+    articles = ((k, v["sentence"]) for k, v in tqdm.tqdm(art.items(), total=len(art)))
+    engine = EmbeddingEngine(nlp)
+    return embed_articles(articles, engine, sen_len, processes, cache=cache)
 
 
 def main(params):
@@ -205,10 +192,16 @@ def main(params):
     json.dump(out, open(params["output_json"], "w"))
     print("Wrote ", params["output_json"])
 
-    articles = open_json(params["input_article_json"])
-    global sen_len
+    articles = open_articles(params["input_article_json"], fields=["sentence"])
+    global sen_len, nlp
     sen_len = params["sen_len"]
-    keys, data = create_rep(articles)
+    # only the tokenizer and the vectors are used
+    nlp = spacy.load("en_core_web_lg", disable=["parser", "tagger", "ner"])
+    cache = open_vector_cache(params["vector_cache"], nlp, params["vector_cache_size"])
+    keys, data = create_rep(articles, params["processes"], cache)
+    if cache is not None:
+        print(cache.report())
+        cache.close()
     json.dump(keys, open(params["output_keys_json"], "w"))
     save_h5(params["output_avg_h5"], data)
 
@@ -226,5 +219,39 @@ if __name__ == "__main__":
     parser.add_argument(
         "--max_length", default=31, type=int, help="Max length of a caption"
     )
-    parser.add
+    parser.add_argument(
+        "--word_count_threshold",
+        default=4,
+        type=int,
+        help="only words that occur more than this number of times will be put in vocab",
+    )
+    parser.add_argument(
+        "--input_article_json",
+        default="../data/articles.sqlite",
+        help="Article store of create_article_set.py (or an article JSON file)",
+    )
+    parser.add_argument(
+        "--output_keys_json", required=True, help="Output JSON file of the article keys"
+    )
+    parser.add_argument(
+        "--output_avg_h5", required=True, help="Output HDF5 file of the article vectors"
+    )
+    parser.add_argument(
+        "--sen_len",
+        type=int,
+        default=54,
+        help="Maximum number of sentences to consider for each article",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=0,
+        help="Processes embedding the articles. 0 = one per cpu",
+    )
+    add_vector_cache_arguments(parser)
 
+    args = parser.parse_args()
+    params = vars(args)  # convert to ordinary dict
+    print("parsed input parameters:")
+    print(json.dumps(params, indent=2))
+    main(params)
@@ -0,0 +1,81 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+
+import numpy as np
+import spacy
+import tqdm
+
+# the article store lives in misc/ of the repository root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from misc.article_store import open_articles  # noqa: E402
+from embedding_engine import EmbeddingEngine, embed_cached  # noqa: E402
+from vector_cache import add_vector_cache_arguments, open_vector_cache  # noqa: E402
+
+
+def normalize(vectors):
+    """L2-normalize the rows of vectors, zero rows stay zero."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def create_store(articles, nlp, output, batch_size, cache=None):
+    """Write the normalized spaCy vectors of the sentence_ner sentences of every article.
+
+    <output>.npy is one float32 matrix with the sentences of all articles, <output>.json
+    maps every article key to its [first row, number of rows], in the order of sentence_ner.
+    """
+    index = {}
+    total = 0
+    for key, article in articles.items():
+        index[key] = [total, len(article["sentence_ner"])]
+        total += len(article["sentence_ner"])
+    vectors = np.lib.format.open_memmap(
+        output + ".npy", mode="w+", dtype=np.float32, shape=(total, nlp.vocab.vectors_length)
+    )
+    engine = EmbeddingEngine(nlp, batch_size=batch_size)
+    sentences = (s for article in articles.values() for s in article["sentence_ner"])
+    for start in tqdm.tqdm(range(0, total, batch_size)):
+        batch = list(itertools.islice(sentences, batch_size))
+        batch_vectors = embed_cached(engine, batch, cache)
+        vectors[start : start + len(batch)] = normalize(batch_vectors)
+    vectors.flush()
+    with open(output + ".json", "w") as f:
+        json.dump(index, f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Precompute the sentence vectors insert.py ranks article sentences with."
+    )
+    parser.add_argument(
+        "--input_articles",
+        default="./data/articles.sqlite",
+        help="Path to the article store of create_article_set.py (or an article JSON file).",
+    )
+    parser.add_argument(
+        "--output",
+        default="./data/article_sentence_vectors",
+        help="Path prefix of the .npy matrix and the .json index to write.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1000,
+        help="Number of sentences spaCy processes at once.",
+    )
+    add_vector_cache_arguments(parser)
+
+    args = parser.parse_args()
+
+    # the pipeline insert.py compares captions and sentences with
+    nlp = spacy.load("en_core_web_lg", disable=["parser", "tagger", "ner"])
+    articles = open_articles(args.input_articles, fields=["sentence_ner"])
+    cache = open_vector_cache(args.vector_cache, nlp, args.vector_cache_size)
+    create_store(articles, nlp, args.output, args.batch_size, cache)
+    if cache is not None:
+        print(cache.report())
+        cache.close()
@@ -0,0 +1,248 @@
+import contextlib
+import hashlib
+import os
+import sqlite3
+
+import numpy as np
+
+# Sentence vectors of the article encoders kept on disk across runs and encoders, so a
+# sentence is only embedded once per model and weighting scheme:
+#   cache = VectorCache("../data/vector_cache.sqlite", dim=300, max_rows=2000000)
+#   keys = vector_keys(sentences, engine.model, engine.scheme)
+#   found = cache.get_many(keys)  # {key: float32 vector} of the keys in the cache
+#   cache.put_many(missing_keys, missing_vectors)
+# The vectors are the rows of a float32 table memory mapped from <path>.vectors, the
+# sqlite file maps sha1(model, scheme, sentence) to their row and when they were last
+# used. Past max_rows vectors the least recently used ones are evicted.
+# Several scripts can share a cache at the same time: rows are allocated, written and read
+# while holding the sqlite write lock (BEGIN IMMEDIATE), the others wait for it.
+
+
+def vector_keys(sentences, model, scheme):
+    """The cache key of every sentence embedded by model with scheme."""
+    prefix = hashlib.sha1(("%s\0%s\0" % (model, scheme)).encode("utf-8"))
+    keys = []
+    for sentence in sentences:
+        sha1 = prefix.copy()
+        sha1.update(sentence.encode("utf-8"))
+        keys.append(sha1.digest())
+    return keys
+
+
+def open_vector_cache(path, nlp, max_rows):
+    """The VectorCache at path for the vectors of nlp, None without a path."""
+    if not path:
+        return None
+    return VectorCache(path, nlp.vocab.vectors_length, max_rows)
+
+
+def add_vector_cache_arguments(parser):
+    """The --vector_cache and --vector_cache_size options of the embedding scripts."""
+    parser.add_argument(
+        "--vector_cache",
+        default="../data/vector_cache.sqlite",
+        help="Sentence vector cache shared by the article encoders. '' = no cache.",
+    )
+    parser.add_argument(
+        "--vector_cache_size",
+        type=int,
+        default=2000000,
+        help="Sentence vectors the cache keeps, the least recently used are evicted.",
+    )
+
+
+class VectorCache(object):
+    def __init__(self, path, dim, max_rows=2000000):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.vectors_path = path + ".vectors"
+        self.dim = dim
+        self.max_rows = max_rows
+        # transactions are explicit, see _locked; a writer waits up to 10 minutes for another
+        self.db = sqlite3.connect(path, timeout=600, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS vectors "
+            "(key BLOB PRIMARY KEY, row INTEGER UNIQUE, used INTEGER)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS vectors_used ON vectors (used)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value)"
+        )
+        with self._locked():
+            self.db.execute("INSERT OR IGNORE INTO meta VALUES ('dim', ?)", (dim,))
+        (stored_dim,) = self.db.execute(
+            "SELECT value FROM meta WHERE name = 'dim'"
+        ).fetchone()
+        assert stored_dim == dim, "%s holds vectors of %d values, not %d" % (
+            path,
+            stored_dim,
+            dim,
+        )
+        self.count = self._state()[0]
+        self.capacity = 0
+        self.table = None
+        self.lookups = 0
+        self.hits = 0
+        self.stored = 0
+        self.evicted = 0
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # a write transaction, other processes sharing the cache wait until it ends
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def _state(self):
+        # vectors stored, first row never used and last used time; read under _locked, as
+        # other processes change them
+        return self.db.execute(
+            "SELECT COUNT(*), COALESCE(MAX(row) + 1, 0), COALESCE(MAX(used), 0) "
+            "FROM vectors"
+        ).fetchone()
+
+    def _open_table(self, capacity):
+        self.capacity = capacity
+        self.table = None
+        if capacity:
+            self.table = np.memmap(
+                self.vectors_path,
+                dtype=np.float32,
+                mode="r+",
+                shape=(capacity, self.dim),
+            )
+
+    def _reserve(self, rows):
+        # map at least rows rows of the table: the file may have been grown by another
+        # process, or is grown here, doubling up to max_rows
+        if rows <= self.capacity:
+            return
+        capacity = 0
+        if os.path.isfile(self.vectors_path):
+            capacity = os.path.getsize(self.vectors_path) // (4 * self.dim)
+        if capacity < rows:
+            capacity = max(rows, min(self.max_rows, max(2 * capacity, 1024)))
+            if self.table is not None:
+                self.table.flush()
+            with open(self.vectors_path, "ab") as f:
+                f.truncate(capacity * self.dim * 4)
+        self._open_table(capacity)
+
+    def _rows(self, keys):
+        # {key: row} of the keys in the cache
+        unique = list(dict.fromkeys(keys))
+        rows = {}
+        for start in range(0, len(unique), 900):
+            batch = unique[start : start + 900]
+            query = "SELECT key, row FROM vectors WHERE key IN (%s)" % ",".join(
+                "?" * len(batch)
+            )
+            for key, row in self.db.execute(query, batch):
+                rows[bytes(key)] = row
+        return rows
+
+    def get_many(self, keys):
+        """{key: vector} of the keys in the cache, now the most recently used ones."""
+        # the rows are read under the lock, no other process evicts and overwrites them
+        with self._locked():
+            rows = self._rows(keys)
+            if rows:
+                clock = self._state()[2] + 1
+                self.db.executemany(
+                    "UPDATE vectors SET used = ? WHERE key = ?",
+                    ((clock, key) for key in rows),
+                )
+                indices = np.fromiter(rows.values(), dtype=np.int64, count=len(rows))
+                self._reserve(int(indices.max()) + 1)
+                vectors = self.table[indices]
+        self.lookups += len(keys)
+        self.hits += sum(key in rows for key in keys)
+        if not rows:
+            return {}
+        return dict(zip(rows.keys(), vectors))
+
+    def put_many(self, keys, vectors):
+        """Store the vectors of keys not in the cache yet, evicting the least used."""
+        new = {}
+        for key, vector in zip(keys, vectors):
+            new.setdefault(key, vector)
+        written = []
+        try:
+            with self._locked():
+                # stored since they were looked up, by another chunk of the same wave or
+                # another process
+                for key in self._rows(list(new)):
+                    del new[key]
+                new = list(new.items())[: self.max_rows]
+                count, next_row, clock = self._state()
+                evict = max(0, count + len(new) - self.max_rows) if new else 0
+                rows = []
+                if evict:
+                    evicted = self.db.execute(
+                        "SELECT key, row FROM vectors ORDER BY used LIMIT ?", (evict,)
+                    ).fetchall()
+                    self.db.executemany(
+                        "DELETE FROM vectors WHERE key = ?",
+                        ((key,) for key, _ in evicted),
+                    )
+                    rows = [row for _, row in evicted]
+                rows += range(next_row, next_row + len(new) - len(rows))
+                self.db.executemany(
+                    "INSERT INTO vectors VALUES (?, ?, ?)",
+                    ((key, row, clock + 1) for (key, _), row in zip(new, rows)),
+                )
+                if new:
+                    written = rows
+                    self._reserve(max(rows) + 1)
+                    self.table[rows] = np.asarray(
+                        [vector for _, vector in new], dtype=np.float32
+                    )
+                    self.table.flush()
+        except BaseException:
+            # rolled back: the evicted keys are back, but their rows may hold new vectors
+            if written:
+                with self._locked():
+                    for start in range(0, len(written), 900):
+                        batch = written[start : start + 900]
+                        self.db.execute(
+                            "DELETE FROM vectors WHERE row IN (%s)"
+                            % ",".join("?" * len(batch)),
+                            batch,
+                        )
+            raise
+        self.count = count - evict + len(new)
+        self.evicted += evict
+        self.stored += len(new)
+
+    def hit_rate(self):
+        """Fraction of the sentences looked up that were in the cache."""
+        return self.hits / float(max(self.lookups, 1))
+
+    def report(self):
+        return (
+            "vector cache: %d of %d sentences cached (hit rate %.1f%%), %d stored, "
+            "%d evicted, %d of at most %d vectors in %s"
+            % (
+                self.hits,
+                self.lookups,
+                100 * self.hit_rate(),
+                self.stored,
+                self.evicted,
+                self.count,
+                self.max_rows,
+                self.path,
+            )
+        )
+
+    def close(self):
+        if self.table is not None:
+            self.table.flush()
+        self.db.close()
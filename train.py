@@ -4,27 +4,29 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import time
+startup_start = time.time()
+import resource
+import functools
+import subprocess
+import sys
 import torch
 import torch.nn as nn
 from torch.autograd import Variable
 import torch.optim as optim
-import time
 from six.moves import cPickle
 import opts
 import models
 from dataloader import *
 import eval_utils
 import misc.utils as utils
-try:
-    import tensorflow as tf
-
-except ImportError:
-    print("Tensorflow not installed; No tensorboard logging.")
-    tf = None
+from misc.checkpoint import CheckpointWriter
+from misc.history import HistoryLog
+from misc.tensorboard import SummaryWriter
+from misc.profiler import Profiler
 
 def add_summary_value(writer, key, value, iteration):
-    summary = tf.Summary(value=[tf.Summary.Value(tag=key, simple_value=value)])
-    writer.add_summary(summary, iteration)
+    writer.add_scalar(key, value, iteration)
 
 # def unwrap_self(arg, **kwarg):
 #     return DataLoader.get_batch_one(*arg, **kwarg)
@@ -37,19 +39,15 @@ def train(opt):
     loader = DataLoader(opt)
     opt.vocab_size = loader.vocab_size
     opt.seq_length = loader.seq_length
+    if opt.adaptive_softmax_cutoffs:
+        assert loader.word_counts is not None, "%s has no word_counts, rerun scripts/prepro_labels.py" % opt.input_json
     # for debug purposes
     # a=get_batch_one(opt, [loader.split_ix, loader.shuffle, loader.iterators, loader.label_start_ix, loader.label_end_ix])
     # loader.get_batch('train')
-    if not os.path.exists(opt.checkpoint_path+'tensorboard/'):
-        os.makedirs(opt.checkpoint_path+'tensorboard/')
-
-    else:
-        for path in os.listdir(opt.checkpoint_path+'tensorboard/'):
-            os.remove(opt.checkpoint_path+'tensorboard/'+path)
-    tf_summary_writer = tf and tf.summary.FileWriter(opt.checkpoint_path+'tensorboard/')
+    # the event files of the previous run are removed by the writer's background thread
+    tf_summary_writer = SummaryWriter(opt.checkpoint_path+'tensorboard/', purge=True)
     np.random.seed(42)
     infos = {}
-    histories = {}
 
     if opt.start_from is not None:
         # open old infos and check if models are compatible
@@ -60,18 +58,13 @@ def train(opt):
             for checkme in need_be_same:
                 assert vars(saved_model_opt)[checkme] == vars(opt)[checkme], "Command line argument and saved model disagree on '%s' " % checkme
 
-        if os.path.isfile(os.path.join(opt.start_from, 'histories_'+opt.id+'.pkl')):
-            with open(os.path.join(opt.start_from, 'histories_'+opt.id+'.pkl')) as f:
-                histories = cPickle.load(f)
-
     iteration = infos.get('iter', 0)
     # iteration = 26540
     epoch = infos.get('epoch', 0)
 
-    val_result_history = histories.get('val_result_history', {})
-    loss_history = histories.get('loss_history', {})
-    lr_history = histories.get('lr_history', {})
-    ss_prob_history = histories.get('ss_prob_history', {})
+    # loss, lr, ss_prob and validation results are appended to history_<id>.jsonl
+    history = HistoryLog(opt.checkpoint_path + opt.caption_model, opt.id)
+    history.resume(opt.start_from, iteration)
 
     loader.iterators = infos.get('iterators', loader.iterators)
     if opt.load_best_score == 1:
@@ -79,14 +72,29 @@ def train(opt):
 
     cnn_model = utils.build_cnn(opt)
     cnn_model.cuda()
-    model = models.setup(opt)
+    # cnn_forward is what the images go through: the inference build while the cnn is frozen
+    cnn_forward = cnn_model
+    # the adaptive softmax ranking is a buffer of the model, saved with its state dict, not in opt
+    model = models.setup(opt, loader.word_counts if opt.adaptive_softmax_cutoffs else None)
     model.cuda()
 
     update_lr_flag = True
     # Assure in training mode
     model.train()
 
-    crit = utils.LanguageModelCriterion()
+    if opt.adaptive_softmax_cutoffs:
+        # the loss only evaluates the softmax clusters of the target words
+        model.return_hidden = True
+        crit = utils.AdaptiveLanguageModelCriterion(model.logit)
+    elif opt.crit_chunk_size > 0:
+        # the model hands its rnn outputs to the criterion, which never stores the full log-probs
+        model.return_hidden = True
+        crit = utils.FusedLanguageModelCriterion(model.logit, opt.crit_chunk_size)
+    else:
+        crit = utils.LanguageModelCriterion()
+
+    checkpoint_writer = CheckpointWriter(opt.checkpoint_path + opt.caption_model,
+                                         opt.keep_checkpoints, opt.async_checkpoint)
 
     optimizer = optim.Adam(model.parameters(), lr=opt.learning_rate)
     if opt.finetune_cnn_after != -1:
@@ -102,6 +110,18 @@ def train(opt):
         if opt.finetune_cnn_after != -1 and epoch >= opt.finetune_cnn_after:
             if os.path.isfile(os.path.join(opt.start_from, 'optimizer-cnn.pth')):
                 cnn_optimizer.load_state_dict(torch.load(os.path.join(opt.start_from, 'optimizer-cnn.pth')))
+    eval_worker = None
+    if opt.async_eval:
+        # validation runs in eval_worker.py, which follows the checkpoints logged to the history
+        eval_worker = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'eval_worker.py'),
+                                        '--checkpoint_dir', opt.checkpoint_path + opt.caption_model, '--id', opt.id,
+                                        '--device', opt.eval_device, '--parent_pid', str(os.getpid()),
+                                        '--offset', str(os.path.getsize(history.path))])
+    # traces go to a subdirectory, out of the way of the numbered checkpoint files
+    trace_dir = os.path.join(opt.checkpoint_path + opt.caption_model, 'traces') if opt.profile_trace else ''
+    profiler = Profiler(opt.profile_every, trace_dir)
+    print("startup took {:.1f}s, max RSS {:.0f} MB".format(
+        time.time() - startup_start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
     while True:
         if update_lr_flag:
                 # Assign the learning rate
@@ -122,7 +142,11 @@ def train(opt):
                 for p in cnn_model.parameters():
                     p.requires_grad = False
                 cnn_model.eval()
+                if opt.cnn_inference_build and cnn_forward is cnn_model:
+                    cnn_forward = utils.build_inference_cnn(cnn_model)
             else:
+                # switch back to the trainable cnn, the folded copy would go stale
+                cnn_forward = cnn_model
                 for p in cnn_model.parameters():
                     p.requires_grad = True
                 # Fix the first few layers:
@@ -136,20 +160,24 @@ def train(opt):
         # Load data from train split (0)
         # for validation training change the split to 'val'
         # data = loader.get_batch('val')
-        data = loader.get_batch('train')
+        with profiler.span('loader wait'):
+            data = loader.get_batch('train')
 
-        data['images'] = utils.prepro_images(data['images'], True)
+        with profiler.span('preprocess'):
+            data['images'] = utils.prepro_images(data['images'], True)
         # torch.cuda.synchronize()
         print('Read data:', time.time() - start)
 
         # torch.cuda.synchronize()
         start = time.time()
-        tmp = [data['images'], data['labels'], data['masks']]
-        tmp = [Variable(torch.from_numpy(_), requires_grad=False).cuda() for _ in tmp]
-        images, labels, masks = tmp
+        with profiler.span('host to device', gpu=True):
+            tmp = [data['images'], data['labels'], data['masks']]
+            tmp = [Variable(torch.from_numpy(_), requires_grad=False).cuda() for _ in tmp]
+            images, labels, masks = tmp
 
-        att_feats = cnn_model(images).permute(0, 2, 3, 1)
-        fc_feats = att_feats.mean(2).mean(1)
+        with profiler.span('cnn forward', gpu=True):
+            att_feats = cnn_forward(images).permute(0, 2, 3, 1)
+            fc_feats = att_feats.mean(2).mean(1)
 
         if not opt.use_att:
             att_feats = Variable(torch.FloatTensor(1, 1,1,1).cuda())
@@ -167,18 +195,25 @@ def train(opt):
 
         if opt.sentence_embed:
             sen_embed = Variable(torch.from_numpy(np.array(data['sen_embed'])).cuda())
-            out = model(fc_feats, att_feats, labels, sen_embed)
-            loss = crit(out, labels[:, 1:], masks[:, 1:])
+            with profiler.span('decoder forward', gpu=True):
+                out = model(fc_feats, att_feats, labels, sen_embed)
+            with profiler.span('loss', gpu=True):
+                loss = crit(out, labels[:, 1:], masks[:, 1:])
             # loss += cov
         else:
-            loss = crit(model(fc_feats, att_feats, labels), labels[:,1:], masks[:,1:])
+            with profiler.span('decoder forward', gpu=True):
+                out = model(fc_feats, att_feats, labels)
+            with profiler.span('loss', gpu=True):
+                loss = crit(out, labels[:,1:], masks[:,1:])
                # - 0.001 * crit(model(torch.zeros(fc_feats.size()).cuda(), torch.zeros(att_feats.size()).cuda(), labels), labels[:,1:], masks[:,1:])
-        loss.backward()
+        with profiler.span('backward', gpu=True):
+            loss.backward()
         # utils.clip_gradient(optimizer, opt.grad_clip)
-        optimizer.step()
-        if opt.finetune_cnn_after != -1 and epoch >= opt.finetune_cnn_after:
-            utils.clip_gradient(cnn_optimizer, opt.grad_clip)
-            cnn_optimizer.step()
+        with profiler.span('optimizer step', gpu=True):
+            optimizer.step()
+            if opt.finetune_cnn_after != -1 and epoch >= opt.finetune_cnn_after:
+                utils.clip_gradient(cnn_optimizer, opt.grad_clip)
+                cnn_optimizer.step()
         # train_loss = loss.data[0]
         train_loss = loss.item()
         # torch.cuda.synchronize()
@@ -196,54 +231,51 @@ def train(opt):
 
         # Write the training loss summary
         if (iteration % opt.losses_log_every == 0):
-            if tf is not None:
-                add_summary_value(tf_summary_writer, 'train_loss', train_loss, iteration)
-                add_summary_value(tf_summary_writer, 'learning_rate', opt.current_lr, iteration)
-                add_summary_value(tf_summary_writer, 'scheduled_sampling_prob', model.ss_prob, iteration)
-                tf_summary_writer.flush()
+            add_summary_value(tf_summary_writer, 'train_loss', train_loss, iteration)
+            add_summary_value(tf_summary_writer, 'learning_rate', opt.current_lr, iteration)
+            add_summary_value(tf_summary_writer, 'scheduled_sampling_prob', model.ss_prob, iteration)
 
-            loss_history[iteration] = train_loss
-            lr_history[iteration] = opt.current_lr
-            ss_prob_history[iteration] = model.ss_prob
+            history.log(iteration, loss=train_loss, lr=opt.current_lr, ss_prob=model.ss_prob)
 
         # make evaluation on validation set, and save model
         if (iteration % opt.save_checkpoint_every == 0):
-            # eval model
-            eval_kwargs = {'split': 'val',
-                            'dataset': opt.input_json}
-            eval_kwargs.update(vars(opt))
-            val_loss, predictions, lang_stats = eval_utils.eval_split(cnn_model, model, crit, loader, eval_kwargs)
-
-            # Write validation result into summary
-            if tf is not None:
+            best_flag = False
+            if not opt.async_eval:
+                # eval model
+                eval_kwargs = {'split': 'val',
+                                'dataset': opt.input_json}
+                eval_kwargs.update(vars(opt))
+                eval_cnn = cnn_forward
+                if opt.cnn_inference_build and eval_cnn is cnn_model:
+                    # finetuning: fold the current weights for this evaluation only
+                    eval_cnn = utils.build_inference_cnn(cnn_model)
+                with profiler.span('eval'):
+                    val_loss, predictions, lang_stats = eval_utils.eval_split(eval_cnn, model, crit, loader, eval_kwargs)
+                del eval_cnn
+
+                # Write validation result into summary
                 add_summary_value(tf_summary_writer, 'validation loss', val_loss, iteration)
                 for k,v in lang_stats.items():
                     add_summary_value(tf_summary_writer, k, v, iteration)
                 tf_summary_writer.flush()
-            val_result_history[iteration] = {'loss': val_loss, 'lang_stats': lang_stats, 'predictions': predictions}
+                history.log_val(iteration, val_loss, lang_stats, predictions)
 
-            # Save model if is improving on validation result
-            if opt.language_eval == 1:
-                current_score = lang_stats['CIDEr']
-            else:
-                current_score = - val_loss
-
-            best_flag = False
-            if True: # if true
+                # Save model if is improving on validation result
+                if opt.language_eval == 1:
+                    current_score = lang_stats['CIDEr']
+                else:
+                    current_score = - val_loss
                 if best_val_score is None or current_score > best_val_score:
                     best_val_score = current_score
                     best_flag = True
-                checkpoint_path = os.path.join(opt.checkpoint_path + opt.caption_model, 'model.pth')
-                cnn_checkpoint_path = os.path.join(opt.checkpoint_path + opt.caption_model, 'model-cnn.pth')
-                torch.save(model.state_dict(), checkpoint_path)
-                torch.save(cnn_model.state_dict(), cnn_checkpoint_path)
-                print("model saved to {}".format(checkpoint_path))
-                print("cnn model saved to {}".format(cnn_checkpoint_path))
-                optimizer_path = os.path.join(opt.checkpoint_path + opt.caption_model, 'optimizer.pth')
-                torch.save(optimizer.state_dict(), optimizer_path)
+
+            if True: # if true
+                save_start = time.time()
+                files = [('model.pth', model.state_dict()),
+                         ('model-cnn.pth', cnn_model.state_dict()),
+                         ('optimizer.pth', optimizer.state_dict())]
                 if opt.finetune_cnn_after != -1 and epoch >= opt.finetune_cnn_after:
-                    cnn_optimizer_path = os.path.join(opt.checkpoint_path + opt.caption_model, 'optimizer-cnn.pth')
-                    torch.save(cnn_optimizer.state_dict(), cnn_optimizer_path)
+                    files.append(('optimizer-cnn.pth', cnn_optimizer.state_dict()))
 
                 # Dump miscalleous informations
                 infos['iter'] = iteration
@@ -252,29 +284,26 @@ def train(opt):
                 infos['best_val_score'] = best_val_score
                 infos['opt'] = opt
                 infos['vocab'] = loader.get_vocab()
+                files.append(('infos_'+opt.id+'.pkl', infos))
+
+                # the best model is hard linked to the files just written, not saved a second time
+                best = ['model.pth', 'model-cnn.pth', 'infos_'+opt.id+'.pkl'] if best_flag else []
+                with profiler.span('checkpoint'):
+                    # logged once on disk, eval_worker.py picks the checkpoint up from the history
+                    checkpoint_writer.save(iteration, files, best, functools.partial(history.log, iteration, checkpoint=True))
+                print("checkpoint stall: {:.3f}s".format(time.time() - save_start))
 
-                histories['val_result_history'] = val_result_history
-                histories['loss_history'] = loss_history
-                histories['lr_history'] = lr_history
-                histories['ss_prob_history'] = ss_prob_history
-                with open(os.path.join(opt.checkpoint_path + opt.caption_model, 'infos_'+opt.id+'.pkl'), 'wb') as f:
-                    cPickle.dump(infos, f)
-                with open(os.path.join(opt.checkpoint_path + opt.caption_model, 'histories_'+opt.id+'.pkl'), 'wb') as f:
-                    cPickle.dump(histories, f)
-
-                if best_flag:
-                    checkpoint_path = os.path.join(opt.checkpoint_path+ opt.caption_model, 'model-best.pth')
-                    cnn_checkpoint_path = os.path.join(opt.checkpoint_path+ opt.caption_model, 'model-cnn-best.pth')
-                    torch.save(model.state_dict(), checkpoint_path)
-                    torch.save(cnn_model.state_dict(), cnn_checkpoint_path)
-                    print("model saved to {}".format(checkpoint_path))
-                    print("cnn model saved to {}".format(cnn_checkpoint_path))
-                    with open(os.path.join(opt.checkpoint_path+ opt.caption_model, 'infos_'+opt.id+'-best.pkl'), 'wb') as f:
-                        cPickle.dump(infos, f)
+        profiler.step(iteration)
 
         # Stop if reaching max epochs
         if epoch >= opt.max_epochs and opt.max_epochs != -1:
             break
+    checkpoint_writer.wait()
+    history.log(iteration, done=True)
+    tf_summary_writer.close()
+    if eval_worker is not None:
+        # let the worker evaluate the last checkpoint
+        eval_worker.wait()
 
 opt = opts.parse_opt()
 train(opt)